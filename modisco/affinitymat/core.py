@@ -4,10 +4,14 @@ import numpy as np
 from .. import util as modiscoutil
 from .. import core as modiscocore
 from . import transformers
+import os
 import sys
 import time
 import itertools
+from collections import OrderedDict
 import scipy.stats
+import scipy.sparse
+import scipy.special
 from joblib import Parallel, delayed
 
 
@@ -32,6 +36,13 @@ class AbstractTrackTransformer(object):
         """
         raise NotImplementedError() 
 
+    def batch_call(self, inps):
+        """
+            inps: array with the thing to transform (e.g. a seqlet) as the
+             first axis; override to transform the whole batch at once
+        """
+        return np.array([self(x) for x in inps])
+
     def chain(self, other_normalizer):        
         return AdhocTrackTransformer(
                 func=(lambda x: other_normalizer(
@@ -46,17 +57,30 @@ class AdhocTrackTransformer(AbstractTrackTransformer):
         return self.func(inp)
 
 
+def get_non_batch_axes(inps):
+    return tuple(range(1, len(inps.shape)))
+
+
 class MeanNormalizer(AbstractTrackTransformer):
 
     def __call__(self, inp):
         return inp - np.mean(inp)
 
+    def batch_call(self, inps):
+        return inps - np.mean(inps, axis=get_non_batch_axes(inps),
+                              keepdims=True)
+
 
 class MagnitudeNormalizer(AbstractTrackTransformer):
 
     def __call__(self, inp):
         return (inp / (np.linalg.norm(inp.ravel())+0.0000001))
 
+    def batch_call(self, inps):
+        return (inps / (np.sqrt(np.sum(np.square(inps),
+                                       axis=get_non_batch_axes(inps),
+                                       keepdims=True))+0.0000001))
+
 
 class AttenuateOutliers(AbstractTrackTransformer):
 
@@ -67,12 +91,21 @@ class AttenuateOutliers(AbstractTrackTransformer):
         return np.maximum(np.abs(inp)/np.mean(np.abs(inp)),
                           self.fold_above_mean_threshold)*np.sign(inp)
 
+    def batch_call(self, inps):
+        return np.maximum(np.abs(inps)/np.mean(np.abs(inps),
+                                               axis=get_non_batch_axes(inps),
+                                               keepdims=True),
+                          self.fold_above_mean_threshold)*np.sign(inps)
+
 
 class SquareMagnitude(AbstractTrackTransformer):
 
     def __call__(self, inp):
         return np.square(inp)*np.sign(inp) 
 
+    def batch_call(self, inps):
+        return self(inps)
+
 
 class L1Normalizer(AbstractTrackTransformer):
 
@@ -83,13 +116,78 @@ class L1Normalizer(AbstractTrackTransformer):
         else:
             return (inp/abs_sum)
 
+    def batch_call(self, inps):
+        abs_sums = np.sum(np.abs(inps), axis=get_non_batch_axes(inps),
+                          keepdims=True)
+        return inps/np.where(abs_sums==0, 1, abs_sums)
+
 
 class PatternComparisonSettings(object):
-    def __init__(self, track_names, track_transformer, min_overlap):
+    def __init__(self, track_names, track_transformer, min_overlap,
+                       max_cache_bytes=2**28):
         assert hasattr(track_names, '__iter__')
         self.track_names = track_names
         self.track_transformer = track_transformer
         self.min_overlap = min_overlap
+        #the 2d data of the most recently gathered lists of seqlets is
+        # kept, up to max_cache_bytes in total
+        self.max_cache_bytes = max_cache_bytes
+        self._2d_data_cache = OrderedDict()
+        self._2d_data_cache_bytes = 0
+
+    def __getstate__(self):
+        #the cache isn't worth sending to other processes
+        state = self.__dict__.copy()
+        state["_2d_data_cache"] = OrderedDict()
+        state["_2d_data_cache_bytes"] = 0
+        return state
+
+    def get_2d_data(self, patterns):
+        """
+        get_2d_data_from_patterns using these settings. Results for lists
+         of seqlets and for SeqletTables are memoized; the returned arrays
+         are read-only, as they may be shared with other callers.
+        """
+        if (isinstance(patterns, modiscocore.SeqletTable)):
+            #indexing a table creates new Seqlet objects each time, so the
+            # key is the coordinates, along with the identity of where the
+            # data comes from (which the cache entry holds on to)
+            data_source = (patterns.track_set
+                           if patterns.track_set is not None
+                           else patterns.track_name_to_fwd)
+            key = ("SeqletTable", id(data_source),
+                   patterns.coords.tobytes(), tuple(self.track_names))
+            return self._get_cached_2d_data(key=key, patterns=patterns)
+        patterns = list(patterns)
+        if (any([type(x).__name__ != "Seqlet" for x in patterns])):
+            #aggregated patterns change as seqlets are added, so they
+            # are never cached
+            return modiscocore.get_2d_data_from_patterns(
+                patterns=patterns, track_names=self.track_names,
+                track_transformer=self.track_transformer)
+        #the key is the identity of the seqlet objects, which the cache
+        # entry holds on to, as the data of a seqlet never changes
+        key = tuple([id(x) for x in patterns])
+        return self._get_cached_2d_data(key=key, patterns=patterns)
+
+    def _get_cached_2d_data(self, key, patterns):
+        if (key in self._2d_data_cache):
+            self._2d_data_cache[key] = self._2d_data_cache.pop(key)
+            return self._2d_data_cache[key][1]
+        fwd_data, rev_data = modiscocore.get_2d_data_from_patterns(
+            patterns=patterns, track_names=self.track_names,
+            track_transformer=self.track_transformer)
+        data = (modiscocore.get_readonly_view(fwd_data),
+                modiscocore.get_readonly_view(rev_data))
+        num_bytes = fwd_data.nbytes+(rev_data.nbytes
+                                     if rev_data is not None else 0)
+        if (num_bytes <= self.max_cache_bytes):
+            self._2d_data_cache[key] = (patterns, data, num_bytes)
+            self._2d_data_cache_bytes += num_bytes
+            while (self._2d_data_cache_bytes > self.max_cache_bytes):
+                self._2d_data_cache_bytes -=\
+                    self._2d_data_cache.popitem(last=False)[1][2]
+        return data
 
 
 class AbstractAffinityMatrixFromSeqlets(object):
@@ -104,6 +202,28 @@ class AbstractSeqletsToOnedEmbedder(object):
         raise NotImplementedError()
 
 
+#filter banks and compiled embedding functions of the GappedKmerEmbedders
+_gapped_kmer_filters_cache = {}
+_gapped_kmer_embedding_func_cache = {}
+
+
+def save_filter_bank(filter_bank, file_path):
+    filters, biases, revcomp_filter_idxs = filter_bank
+    tmp_file_path = file_path+".tmp%d"%os.getpid()
+    try:
+        if not os.path.exists(os.path.dirname(file_path)):
+            os.makedirs(os.path.dirname(file_path))
+        with open(tmp_file_path, "wb") as f:
+            np.savez_compressed(f, filters=filters.astype("uint8"),
+                                biases=biases,
+                                revcomp_filter_idxs=revcomp_filter_idxs)
+        #so that a partially written file is never loaded
+        os.rename(tmp_file_path, file_path)
+    except (IOError, OSError):
+        # Except permission denied.
+        pass
+
+
 class GappedKmerEmbedder(AbstractSeqletsToOnedEmbedder):
     
     def __init__(self, alphabet_size,
@@ -115,13 +235,27 @@ class GappedKmerEmbedder(AbstractSeqletsToOnedEmbedder):
                        batch_size,
                        num_filters_to_retain=None,
                        onehot_track_name=None,
-                       progress_update=None):
+                       progress_update=None,
+                       sparse=None,
+                       persist_filters=False):
+        #sparse: whether the embeddings are returned as scipy CSR
+        # matrices; None picks CSR when at most half the entries of the
+        # embedding can be nonzero (see get_max_embedding_density)
+        #persist_filters: whether the filter bank is also saved to (and
+        # loaded from) the gapped_kmer_filters folder of the tfmodisco dir
         self.alphabet_size = alphabet_size
         self.kmer_len = kmer_len
         self.num_gaps = num_gaps
         self.num_mismatches = num_mismatches
         self.num_filters_to_retain = num_filters_to_retain
-        self.filters, self.biases = self.prepare_gapped_kmer_filters()
+        self.persist_filters = persist_filters
+        (self.filters, self.biases,
+         self.revcomp_filter_idxs) = self.get_gapped_kmer_filters()
+        #number of positions from the first to the last letter of each
+        # filter (all filters start at the first position)
+        self.filter_widths = np.repeat(
+            [x[-1]+1 for x in self.get_nonzero_position_combos()],
+            self.alphabet_size**(self.kmer_len-self.num_gaps))
         self.onehot_track_name = onehot_track_name
         self.toscore_track_names_and_signs = toscore_track_names_and_signs
         assert len(toscore_track_names_and_signs) >= 0,\
@@ -129,25 +263,19 @@ class GappedKmerEmbedder(AbstractSeqletsToOnedEmbedder):
         self.normalizer = normalizer
         self.batch_size = batch_size
         self.progress_update = progress_update
+        self.sparse = sparse
         self.require_onehot_match = (True if self.onehot_track_name
                                      is not None else False)
-        self.gapped_kmer_embedding_func =\
-            B.get_gapped_kmer_embedding_func(
-                    filters=self.filters,
-                    biases=self.biases,
-                    require_onehot_match=self.require_onehot_match)
+        self.gapped_kmer_embedding_func = self.get_embedding_func()
 
-    def prepare_gapped_kmer_filters(self):
-        nonzero_position_combos = list(itertools.combinations(
-                            iterable=range(self.kmer_len),
-                            r=(self.kmer_len-self.num_gaps)))
-        letter_permutations = list(itertools.product(
-                                *[list(range(self.alphabet_size)) for x in
-                                  range(self.kmer_len-self.num_gaps)]))
-        filters = []
-        biases = []
+    def get_nonzero_position_combos(self):
+        """Positions of the letters in each gapped k-mer, one entry per
+         distinct arrangement of gaps, in the order of the filters"""
+        nonzero_position_combos = []
         unique_nonzero_positions = set()
-        for nonzero_positions in nonzero_position_combos:
+        for nonzero_positions in itertools.combinations(
+                            iterable=range(self.kmer_len),
+                            r=(self.kmer_len-self.num_gaps)):
             string_representation = [" " for x in range(self.kmer_len)]
             for nonzero_position in nonzero_positions:
                 string_representation[nonzero_position] = "X"
@@ -155,16 +283,169 @@ class GappedKmerEmbedder(AbstractSeqletsToOnedEmbedder):
                 ("".join(string_representation)).lstrip().rstrip()
             if (nonzero_positions_string not in unique_nonzero_positions):
                 unique_nonzero_positions.add(nonzero_positions_string) 
-                for letter_permutation in letter_permutations:
-                    assert len(nonzero_positions)==len(letter_permutation)
-                    the_filter = np.zeros((self.kmer_len, self.alphabet_size)) 
-                    for nonzero_position, letter\
-                        in zip(nonzero_positions, letter_permutation):
-                        the_filter[nonzero_position, letter] = 1 
-                    filters.append(the_filter)
-                    biases.append(-(len(nonzero_positions)-1
-                                    -self.num_mismatches))
-        return np.array(filters), np.array(biases)
+                nonzero_position_combos.append(nonzero_positions)
+        return nonzero_position_combos
+
+    def get_filter_bank_key(self):
+        return (self.alphabet_size, self.kmer_len,
+                self.num_gaps, self.num_mismatches)
+
+    def get_gapped_kmer_filters(self):
+        #the filter bank is built once per process for each setting of
+        # the parameters, and shared (read-only) by the embedders
+        key = self.get_filter_bank_key()
+        if (key not in _gapped_kmer_filters_cache):
+            filter_bank = None
+            if (self.persist_filters):
+                file_path = os.path.join(B._tfmodisco_dir,
+                    "gapped_kmer_filters", "a%d_k%d_g%d_m%d.npz"%key)
+                if (os.path.exists(file_path)):
+                    try:
+                        with np.load(file_path) as saved:
+                            filter_bank = (saved["filters"].astype("float"),
+                                           saved["biases"],
+                                           saved["revcomp_filter_idxs"])
+                    except (IOError, ValueError, KeyError):
+                        filter_bank = None
+            if (filter_bank is None):
+                filter_bank = self.prepare_gapped_kmer_filters()
+                if (self.persist_filters):
+                    save_filter_bank(filter_bank=filter_bank,
+                                     file_path=file_path)
+            for arr in filter_bank:
+                arr.flags.writeable = False
+            _gapped_kmer_filters_cache[key] = filter_bank
+        return _gapped_kmer_filters_cache[key]
+
+    def prepare_gapped_kmer_filters(self):
+        nonzero_position_combos = self.get_nonzero_position_combos()
+        num_letters = self.kmer_len-self.num_gaps
+        letter_permutations = np.array(list(itertools.product(
+                                range(self.alphabet_size),
+                                repeat=num_letters)))
+        num_kmers = len(letter_permutations)
+        letter_permutation_idxs = np.arange(num_kmers)
+        filters = np.zeros((len(nonzero_position_combos)*num_kmers,
+                            self.kmer_len, self.alphabet_size))
+        biases = np.full(len(filters), -(num_letters-1-self.num_mismatches))
+        #the reverse complement of each filter (reversed along both axes,
+        # then moved to start at the first position) is also in the bank
+        revcomp_filter_idxs = np.zeros(len(filters), dtype="int")
+        combo_to_idx = dict((x, idx) for idx,x
+                            in enumerate(nonzero_position_combos))
+        revcomp_letter_permutation_idxs = np.dot(
+            self.alphabet_size-1-letter_permutations[:,::-1],
+            self.alphabet_size**np.arange(num_letters-1, -1, -1))
+        for combo_idx, nonzero_positions in\
+            enumerate(nonzero_position_combos):
+            filter_idxs = combo_idx*num_kmers + letter_permutation_idxs
+            filters[filter_idxs[:,None], np.array(nonzero_positions)[None,:],
+                    letter_permutations] = 1
+            revcomp_combo_idx = combo_to_idx[tuple(
+                nonzero_positions[-1]-x for x in nonzero_positions[::-1])]
+            revcomp_filter_idxs[filter_idxs] =\
+                revcomp_combo_idx*num_kmers + revcomp_letter_permutation_idxs
+        return filters, biases, revcomp_filter_idxs
+
+    def get_max_embedding_density(self, seqlet_len):
+        #upper bound on the fraction of nonzero entries with a onehot
+        # match: each window matches the k-mers within num_mismatches of
+        # it, for every arrangement of gaps
+        num_letters = self.kmer_len-self.num_gaps
+        kmers_per_window = sum(
+            scipy.special.comb(num_letters, i)*(self.alphabet_size-1)**i
+            for i in range(min(self.num_mismatches, num_letters)+1))
+        return min(1.0, (seqlet_len-self.kmer_len+1)*kmers_per_window/
+                        float(self.alphabet_size**num_letters))
+
+    def get_embedding_func(self, width=None):
+        #embedding function of the filter bank (or, if width is specified,
+        # of only the filters that are width positions wide, trimmed to
+        # that width); compiled once per process and shared
+        key = (self.get_filter_bank_key()
+               +(self.require_onehot_match, width))
+        if (key not in _gapped_kmer_embedding_func_cache):
+            width_mask = (self.filter_widths==width if width is not None
+                          else np.ones(len(self.filters), dtype="bool"))
+            _gapped_kmer_embedding_func_cache[key] =\
+                B.get_gapped_kmer_embedding_func(
+                    filters=self.filters[width_mask][:,:width],
+                    biases=self.biases[width_mask],
+                    require_onehot_match=self.require_onehot_match)
+        return _gapped_kmer_embedding_func_cache[key]
+
+    def embed(self, onehot, to_embed, sparse, width=None):
+        #if width is specified, only the columns of the filters that are
+        # width positions wide are computed
+        if (sparse and onehot is not None
+            and np.all((onehot==0) | (onehot==1))):
+            #the gapped k-mers matched by each window are enumerated
+            # directly from the sequence
+            return get_sparse_gapped_kmer_embedding(
+                        onehot=onehot, to_embed=to_embed,
+                        nonzero_position_combos=[
+                         x for x in self.get_nonzero_position_combos()
+                         if (width is None or x[-1]+1==width)],
+                        kmer_len=(self.kmer_len if width is None
+                                  else width),
+                        alphabet_size=self.alphabet_size,
+                        num_mismatches=self.num_mismatches)
+        gapped_kmer_embedding_func = (
+            self.gapped_kmer_embedding_func if width is None
+            else self.get_embedding_func(width=width))
+        common_args = {'batch_size': self.batch_size,
+                       'progress_update': self.progress_update}
+        if (onehot is not None):
+            embedding = gapped_kmer_embedding_func(
+                            onehot=onehot, to_embed=to_embed, **common_args)
+        else:
+            embedding = gapped_kmer_embedding_func(
+                            to_embed=to_embed, **common_args)
+        return (scipy.sparse.csr_matrix(embedding)
+                if sparse else embedding)
+
+    def get_revcomp_embedding(self, embedding_fwd, onehot_fwd,
+                              data_to_embed_fwd, sparse):
+        """
+        Embedding of the reverse complements of the seqlets, from the
+         embedding of the seqlets themselves.
+
+        Filter j on the reverse strand matches where filter
+         revcomp_filter_idxs[j] matches on the forward strand. A filter
+         w positions wide is only scanned over the first
+         seqlet_len-kmer_len+1 windows on either strand though, so on the
+         forward strand it misses the last kmer_len-w windows that the
+         reverse strand sees, and sees the first kmer_len-w windows that
+         the reverse strand misses; these few windows at the two ends are
+         embedded separately (with only the filters of that width) and
+         added/subtracted.
+        """
+        seqlet_len = data_to_embed_fwd.shape[1]
+        embedding_rev = (scipy.sparse.csr_matrix(embedding_fwd) if sparse
+                         else np.array(embedding_fwd))
+        for width in sorted(set(self.filter_widths)):
+            if (width == self.kmer_len):
+                continue
+            edge_embeddings = []
+            for edge_start in [seqlet_len-self.kmer_len+1, 0]:
+                edge_end = edge_start+self.kmer_len-1
+                edge_embeddings.append(self.embed(
+                    onehot=(onehot_fwd[:,edge_start:edge_end]
+                            if (onehot_fwd is not None) else None),
+                    to_embed=data_to_embed_fwd[:,edge_start:edge_end],
+                    sparse=sparse, width=width))
+            edge_correction = edge_embeddings[0]-edge_embeddings[1]
+            width_idxs = np.nonzero(self.filter_widths==width)[0]
+            if (sparse):
+                edge_correction = scipy.sparse.csr_matrix(edge_correction)
+                embedding_rev = embedding_rev + scipy.sparse.csr_matrix(
+                    (edge_correction.data, width_idxs[edge_correction.indices],
+                     edge_correction.indptr), shape=embedding_rev.shape)
+            else:
+                embedding_rev[:,width_idxs] += edge_correction
+        if (sparse):
+            embedding_rev.eliminate_zeros()
+        return embedding_rev[:,self.revcomp_filter_idxs]
 
     def __call__(self, seqlets):
         print("Computing embeddings")
@@ -196,37 +477,53 @@ class GappedKmerEmbedder(AbstractSeqletsToOnedEmbedder):
         if (data_to_embed_rev is not None):
             data_to_embed_rev = np.array([self.normalizer(x) for x in
                                           data_to_embed_rev])
-        common_args = {'batch_size': self.batch_size,
-                       'progress_update': self.progress_update}
-        if (self.require_onehot_match):
-            embedding_fwd = self.gapped_kmer_embedding_func(
-                                  onehot=onehot_track_fwd,
-                                  to_embed=data_to_embed_fwd,
-                                  **common_args)
-            embedding_rev = (self.gapped_kmer_embedding_func(
-                                  onehot=onehot_track_rev,
-                                  to_embed=data_to_embed_rev,
-                                  **common_args)
-                             if (onehot_track_rev is not None) else None)
+        if (self.require_onehot_match==False):
+            onehot_track_fwd, onehot_track_rev = None, None
+        sparse = self.sparse
+        if (sparse is None):
+            sparse = (onehot_track_fwd is not None and
+                      self.get_max_embedding_density(
+                       onehot_track_fwd.shape[1]) <= 0.5)
+        embedding_fwd = self.embed(onehot=onehot_track_fwd,
+                                   to_embed=data_to_embed_fwd, sparse=sparse)
+        if (data_to_embed_rev is None):
+            embedding_rev = None
+        elif (data_to_embed_fwd.shape[1] >= 2*self.kmer_len-1
+              and np.allclose(data_to_embed_rev,
+                              data_to_embed_fwd[:,::-1,::-1])
+              and (onehot_track_rev is None or np.array_equal(
+                   onehot_track_rev, onehot_track_fwd[:,::-1,::-1]))):
+            #the reverse strand is the reverse complement of the forward
+            # strand, so its embedding is a permutation of the columns of
+            # the forward embedding (up to the windows at the ends)
+            embedding_rev = self.get_revcomp_embedding(
+                                embedding_fwd=embedding_fwd,
+                                onehot_fwd=onehot_track_fwd,
+                                data_to_embed_fwd=data_to_embed_fwd,
+                                sparse=sparse)
         else:
-            embedding_fwd = self.gapped_kmer_embedding_func(
-                                  to_embed=data_to_embed_fwd,
-                                  **common_args)
-            embedding_rev = (self.gapped_kmer_embedding_func(
-                                  to_embed=data_to_embed_rev,
-                                  **common_args)
-                             if (onehot_track_rev is not None) else None)
+            embedding_rev = self.embed(onehot=onehot_track_rev,
+                                       to_embed=data_to_embed_rev,
+                                       sparse=sparse)
         if (self.num_filters_to_retain is not None):
-            all_embeddings = (np.concatenate(
-                              [embedding_fwd, embedding_rev], axis=0)
+            all_embeddings = ([embedding_fwd, embedding_rev]
                               if (embedding_rev is not None)
-                              else np.array(embedding_fwd))
-            embeddings_denominators =\
-                np.sum(np.abs(all_embeddings) > 0, axis=0).astype("float")
+                              else [embedding_fwd])
+            if (scipy.sparse.issparse(embedding_fwd)):
+                all_embeddings = abs(scipy.sparse.vstack(all_embeddings))
+                embeddings_denominators = np.asarray(
+                    (all_embeddings > 0).sum(axis=0)).ravel().astype("float")
+                embeddings_impact = np.asarray(
+                    all_embeddings.sum(axis=0)).ravel()
+            else:
+                all_embeddings = np.abs(np.concatenate(all_embeddings,
+                                                       axis=0))
+                embeddings_denominators =\
+                    np.sum(all_embeddings > 0, axis=0).astype("float")
+                embeddings_impact = np.sum(all_embeddings, axis=0)
             embeddings_denominators += 10.0
             embeddings_mean_impact =\
-                (np.sum(np.abs(all_embeddings), axis=0)/
-                 embeddings_denominators)
+                (embeddings_impact/embeddings_denominators)
             top_embedding_indices = [
                 x[0] for x in sorted(enumerate(embeddings_mean_impact),
                 key=lambda x: -x[1])][:self.num_filters_to_retain]
@@ -236,6 +533,71 @@ class GappedKmerEmbedder(AbstractSeqletsToOnedEmbedder):
         return embedding_fwd, embedding_rev
 
 
+def get_sparse_gapped_kmer_embedding(onehot, to_embed,
+                                     nonzero_position_combos, kmer_len,
+                                     alphabet_size, num_mismatches,
+                                     batch_size=64):
+    """
+    The embedding that the filters and biases of
+     GappedKmerEmbedder.prepare_gapped_kmer_filters give with a onehot
+     match, computed without convolving with the filters: for every
+     window and arrangement of gaps, only the gapped k-mers within
+     num_mismatches of the letters in the window (onehot must be binary)
+     are enumerated, and each adds up to_embed at its own letters.
+
+    Column c*alphabet_size**m + i is the k-mer with the m positions
+     nonzero_position_combos[c] and the i-th combination of letters (in
+     the order of itertools.product). Returns a CSR matrix.
+    """
+    num_letters = len(nonzero_position_combos[0])
+    num_kmers = alphabet_size**num_letters
+    num_cols = len(nonzero_position_combos)*num_kmers
+    num_windows = onehot.shape[1]-kmer_len+1
+    powers = alphabet_size**np.arange(num_letters-1, -1, -1)
+    #the k-mers to enumerate differ from the observed letters by these
+    # (mod alphabet_size) at no more than num_mismatches positions
+    shifts = np.array([x for x in itertools.product(
+                        range(alphabet_size), repeat=num_letters)
+                       if np.sum(np.array(x) > 0) <= num_mismatches])
+    all_letters = np.argmax(onehot, axis=2)
+    all_valid = np.max(onehot, axis=2) > 0
+    to_embed = np.asarray(to_embed, dtype="float32")
+
+    batch_embeddings = []
+    for batch_start in range(0, len(onehot), batch_size):
+        letters = all_letters[batch_start:batch_start+batch_size]
+        valid = all_valid[batch_start:batch_start+batch_size]
+        batch_to_embed = to_embed[batch_start:batch_start+batch_size]
+        rows, cols, vals = [], [], []
+        for combo_idx, nonzero_positions in\
+            enumerate(nonzero_position_combos):
+            #(window, letter of the k-mer) -> position in the seqlet
+            positions = (np.arange(num_windows)[:,None]
+                         + np.array(nonzero_positions)[None,:])
+            kmer_letters = ((letters[:,positions][:,:,None,:]
+                             + shifts[None,None,:,:]) % alphabet_size)
+            #positions without a letter match no k-mer
+            num_mismatched = np.sum((shifts[None,None,:,:] > 0)
+                                    | (valid[:,positions]==False)[:,:,None,:],
+                                    axis=3)
+            keep = num_mismatched <= num_mismatches
+            kmer_vals = np.sum(batch_to_embed[
+                np.arange(len(letters))[:,None,None,None],
+                positions[None,:,None,:], kmer_letters], axis=3)
+            rows.append(np.broadcast_to(
+                np.arange(len(letters))[:,None,None], keep.shape)[keep])
+            cols.append(combo_idx*num_kmers
+                        + np.dot(kmer_letters, powers)[keep])
+            vals.append(kmer_vals[keep])
+        batch_embedding = scipy.sparse.coo_matrix(
+            (np.concatenate(vals), (np.concatenate(rows),
+                                    np.concatenate(cols))),
+            shape=(len(letters), num_cols)).tocsr()
+        batch_embedding.eliminate_zeros()
+        batch_embeddings.append(batch_embedding)
+    return scipy.sparse.vstack(batch_embeddings, format="csr")
+
+
 class AbstractAffinityMatrixFromOneD(object):
 
     def __call__(self, vecs1, vecs2):
@@ -251,6 +613,8 @@ class NumpyCosineSimilarity(AbstractAffinityMatrixFromOneD):
     def __call__(self, vecs1, vecs2):
 
         start_time = time.time()
+        if (scipy.sparse.issparse(vecs1)):
+            return self.sparse_cosine_similarity(vecs1=vecs1, vecs2=vecs2)
         normed_vecs1 = vecs1/np.linalg.norm(vecs1, axis=1)[:,None] 
         normed_vecs2 = vecs2/np.linalg.norm(vecs2, axis=1)[:,None] 
         if (self.verbose):
@@ -272,6 +636,32 @@ class NumpyCosineSimilarity(AbstractAffinityMatrixFromOneD):
 
         return to_return
 
+    def sparse_cosine_similarity(self, vecs1, vecs2,
+                                 max_entries_per_block=2**24):
+        #dense similarities of sparse (e.g. CSR) vectors, computed a block
+        # of rows of vecs1 at a time
+        start_time = time.time()
+        normed_vecs1 = get_sparse_normed_rows(vecs1)
+        normed_vecs2_transpose = get_sparse_normed_rows(vecs2).T.tocsc()
+        to_return = np.zeros((vecs1.shape[0], vecs2.shape[0]))
+        block_size = max(1, int(max_entries_per_block/max(vecs2.shape[0],1)))
+        for block_start in range(0, vecs1.shape[0], block_size):
+            to_return[block_start:block_start+block_size] =\
+                (normed_vecs1[block_start:block_start+block_size]
+                 .dot(normed_vecs2_transpose)).toarray()
+        if (self.verbose):
+            print("Cosine similarity mat computed in",
+                  round(time.time()-start_time,2),"s")
+            sys.stdout.flush()
+        return to_return
+
+
+def get_sparse_normed_rows(vecs):
+    vecs = scipy.sparse.csr_matrix(vecs, dtype="float64")
+    norms = np.sqrt(np.asarray(vecs.multiply(vecs).sum(axis=1)).ravel())
+    #all-zero rows stay zero
+    return scipy.sparse.diags(1.0/np.where(norms > 0, norms, 1.0)).dot(vecs)
+
 
 def contin_jaccard_vec_mat_sim(a_row, mat):
     union = np.sum(np.maximum(np.abs(a_row[None,:]),
@@ -372,6 +762,108 @@ class AffmatFromSeqletEmbeddings(AbstractAffinityMatrixFromSeqlets):
                 else np.array(affinity_mat_fwd))
 
 
+class NeighborsFromSeqletEmbeddings(object):
+    """
+    The n_neighbors seqlets (plus the seqlet itself) with the highest
+     coarse affinity to each seqlet, where the coarse affinity is what
+     AffmatFromSeqletEmbeddings computes: the max of the cosine
+     similarities of the embedding to the fwd and rev embeddings.
+
+    The similarities are computed a block of rows at a time, keeping only
+     the top neighbors of each row, so the n x n matrix is never held in
+     memory; max_entries_per_block bounds the size of a block.
+    Returns the (n, k) array of neighbor indices, most similar first, and
+     the (n, k) array of their coarse affinities.
+    """
+
+    def __init__(self, seqlets_to_1d_embedder, n_neighbors, verbose,
+                       max_entries_per_block=2**24):
+        self.seqlets_to_1d_embedder = seqlets_to_1d_embedder
+        self.n_neighbors = n_neighbors
+        self.verbose = verbose
+        self.max_entries_per_block = max_entries_per_block
+
+    def __call__(self, seqlets):
+
+        cp1_time = time.time()
+        if (self.verbose):
+            print("Beginning embedding computation")
+            sys.stdout.flush()
+
+        embedding_fwd, embedding_rev = self.seqlets_to_1d_embedder(seqlets)
+
+        cp2_time = time.time()
+        if (self.verbose):
+            print("Finished embedding computation in",
+                  round(cp2_time-cp1_time,2),"s")
+            sys.stdout.flush()
+
+        if (self.verbose):
+            print("Starting top neighbor computations")
+            sys.stdout.flush()
+
+        neighbors, neighbor_affs = get_top_cosine_neighbors(
+            vecs=embedding_fwd,
+            other_vecs_list=([embedding_fwd, embedding_rev]
+                             if (embedding_rev is not None)
+                             else [embedding_fwd]),
+            num_neighbors=min(self.n_neighbors+1, embedding_fwd.shape[0]),
+            max_entries_per_block=self.max_entries_per_block)
+
+        if (self.verbose):
+            print("Finished top neighbor computations in",
+                  round(time.time()-cp2_time,2),"s")
+            sys.stdout.flush()
+
+        return neighbors, neighbor_affs
+
+
+def get_normed_rows(vecs):
+    if (scipy.sparse.issparse(vecs)):
+        return get_sparse_normed_rows(vecs)
+    norms = np.linalg.norm(vecs, axis=1)
+    #all-zero rows stay zero
+    return vecs/np.where(norms > 0, norms, 1.0)[:,None]
+
+
+def get_top_cosine_neighbors(vecs, other_vecs_list, num_neighbors,
+                             max_entries_per_block=2**24):
+    #for each row of vecs, the num_neighbors rows with the highest cosine
+    # similarity (the max over other_vecs_list) and their similarities
+    normed_vecs = get_normed_rows(vecs)
+    normed_other_vecs_transpose_list = [
+        (get_normed_rows(x).T.tocsc() if scipy.sparse.issparse(x)
+         else get_normed_rows(x).T) for x in other_vecs_list]
+    num_others = other_vecs_list[0].shape[0]
+    neighbors = np.zeros((vecs.shape[0], num_neighbors), dtype="int")
+    neighbor_sims = np.zeros((vecs.shape[0], num_neighbors))
+    block_size = max(1, int(max_entries_per_block/max(num_others, 1)))
+    for block_start in range(0, vecs.shape[0], block_size):
+        block_sims = None
+        for normed_other_vecs_transpose in normed_other_vecs_transpose_list:
+            sims = normed_vecs[block_start:block_start+block_size].dot(
+                                normed_other_vecs_transpose)
+            sims = (sims.toarray() if scipy.sparse.issparse(sims)
+                    else np.asarray(sims))
+            block_sims = (sims if block_sims is None
+                          else np.maximum(block_sims, sims))
+        if (num_neighbors < num_others):
+            block_neighbors = np.argpartition(
+                -block_sims, num_neighbors-1, axis=1)[:,:num_neighbors]
+        else:
+            block_neighbors = np.tile(np.arange(num_others),
+                                      (len(block_sims),1))
+        block_neighbor_sims = np.take_along_axis(
+                                block_sims, block_neighbors, axis=1)
+        #most similar first
+        order = np.argsort(-block_neighbor_sims, axis=1, kind="stable")
+        neighbors[block_start:block_start+block_size] =\
+            np.take_along_axis(block_neighbors, order, axis=1)
+        neighbor_sims[block_start:block_start+block_size] =\
+            np.take_along_axis(block_neighbor_sims, order, axis=1)
+    return neighbors, neighbor_sims
+
+
 class MaxCrossMetricAffinityMatrixFromSeqlets(
         AbstractAffinityMatrixFromSeqlets):
 
@@ -382,11 +874,8 @@ class MaxCrossMetricAffinityMatrixFromSeqlets(
 
     def __call__(self, seqlets):
         (all_fwd_data, all_rev_data) =\
-            modiscocore.get_2d_data_from_patterns(
-                patterns=seqlets,
-                track_names=self.pattern_comparison_settings.track_names,
-                track_transformer=
-                    self.pattern_comparison_settings.track_transformer)
+            self.pattern_comparison_settings.get_2d_data(
+                patterns=seqlets)
         #apply the cross metric
         cross_metrics_fwd = self.cross_metric(
                      filters=all_fwd_data,
@@ -446,20 +935,14 @@ class AffmatFromSeqletsWithNNpairs(object):
 
     def __call__(self, seqlets, filter_seqlets=None, seqlet_neighbors=None):
         (all_fwd_data, all_rev_data) =\
-            modiscocore.get_2d_data_from_patterns(
-                patterns=seqlets,
-                track_names=self.pattern_comparison_settings.track_names,
-                track_transformer=
-                    self.pattern_comparison_settings.track_transformer)
+            self.pattern_comparison_settings.get_2d_data(
+                patterns=seqlets)
 
         if (filter_seqlets is None):
             filter_seqlets = seqlets
         (filters_all_fwd_data, filters_all_rev_data) =\
-            modiscocore.get_2d_data_from_patterns(
-                patterns=filter_seqlets,
-                track_names=self.pattern_comparison_settings.track_names,
-                track_transformer=
-                    self.pattern_comparison_settings.track_transformer)
+            self.pattern_comparison_settings.get_2d_data(
+                patterns=filter_seqlets)
 
         if (seqlet_neighbors is None):
             seqlet_neighbors = np.array([list(range(len(filter_seqlets)))
@@ -877,10 +1360,22 @@ class FilterMaskFromCorrelation(object):
         self.verbose = verbose
 
     def __call__(self, main_affmat, other_affmat):
+        #other_affmat may be a scipy sparse matrix (e.g. the coarse
+        # affinities to the nearest neighbors only), in which case the
+        # entries of main_affmat outside its stored entries must be zero
+        is_sparse = scipy.sparse.issparse(other_affmat)
+        if (is_sparse):
+            other_affmat = scipy.sparse.csr_matrix(other_affmat)
         correlations = []
         neg_log_pvals = []
-        for main_affmat_row, other_affmat_row\
-            in zip(main_affmat, other_affmat):
+        for row_idx, main_affmat_row in enumerate(main_affmat):
+            if (is_sparse):
+                row_start, row_end = other_affmat.indptr[row_idx:row_idx+2]
+                main_affmat_row = main_affmat_row[
+                    other_affmat.indices[row_start:row_end]]
+                other_affmat_row = other_affmat.data[row_start:row_end]
+            else:
+                other_affmat_row = other_affmat[row_idx]
             #compare correlation on the nonzero rows
             to_compare_mask = np.abs(main_affmat_row) > 0
             corr = scipy.stats.spearmanr(
@@ -329,17 +329,11 @@ class AssignSeqletsByBestMetric(object):
                        merge_into_existing_patterns):
 
         (pattern_fwd_data, pattern_rev_data) =\
-            core.get_2d_data_from_patterns(
-                patterns=patterns,
-                track_names=self.pattern_comparison_settings.track_names,
-                track_transformer=
-                    self.pattern_comparison_settings.track_transformer)
+            self.pattern_comparison_settings.get_2d_data(
+                patterns=patterns)
         (seqlet_fwd_data, seqlet_rev_data) =\
-            core.get_2d_data_from_patterns(
-                patterns=seqlets_to_assign,
-                track_names=self.pattern_comparison_settings.track_names,
-                track_transformer=
-                    self.pattern_comparison_settings.track_transformer)
+            self.pattern_comparison_settings.get_2d_data(
+                patterns=seqlets_to_assign)
 
         cross_metric_fwd = self.matrix_affinity_metric(
                      filters=pattern_fwd_data,
@@ -62,6 +62,9 @@ if _BACKEND == 'theano':
 elif _BACKEND == 'tensorflow':
     #sys.stderr.write('TF-MoDISco is using the TensorFlow backend.\n')
     from .tensorflow_backend import *
+elif _BACKEND == 'numpy':
+    #CPU only; needs neither tensorflow nor theano
+    from .numpy_backend import *
 else:
     raise ValueError('Unable to import backend : ' + str(_BACKEND))
 
@@ -0,0 +1,131 @@
+from __future__ import division, print_function
+import sys
+import numpy as np
+from joblib import Parallel, delayed, cpu_count
+
+
+def get_windows(data, window_len):
+    """Read-only view of every window of window_len positions in data.
+
+    data is (examples, positions, channels); the view is
+     (examples, positions-window_len+1, window_len*channels), so that
+     a valid 1d convolution with a bank of filters is a single matrix
+     product with the flattened filters.
+    """
+    data = np.ascontiguousarray(data)
+    num_windows = data.shape[1]-window_len+1
+    return np.lib.stride_tricks.as_strided(
+            data,
+            shape=(data.shape[0], num_windows, window_len*data.shape[2]),
+            strides=(data.strides[0], data.strides[1], data.strides[2]),
+            writeable=False)
+
+
+def run_function_in_batches(func, input_data_list, batch_size=10,
+                            progress_update=1000, n_jobs=1):
+    #func is run on the batches in a pool of n_jobs threads (numpy
+    # releases the GIL in the matrix products and elementwise operations);
+    # the first axis of its output is the batch
+    assert isinstance(input_data_list, list), "input_data_list must be a list"
+    batch_starts = list(range(0, len(input_data_list[0]), batch_size))
+    def run_batch(i):
+        if (progress_update is not None):
+            if (i%progress_update == 0):
+                print("Done",i)
+                sys.stdout.flush()
+        return func(*[x[i:i+batch_size] for x in input_data_list])
+    if (n_jobs is None):
+        n_jobs = cpu_count()
+    if (n_jobs == 1 or len(batch_starts) <= 1):
+        results = [run_batch(i) for i in batch_starts]
+    else:
+        results = Parallel(n_jobs=n_jobs, backend="threading")(
+                    delayed(run_batch)(i) for i in batch_starts)
+    return np.concatenate(results, axis=0)
+
+
+def get_gapped_kmer_embedding_func(filters, biases, require_onehot_match,
+                                   n_jobs=None):
+    """Same embedding as the tensorflow backend, computed with numpy.
+
+    Each batch is one matrix product of the windows of the input with the
+     flattened filters (and one more for the onehot match); n_jobs is the
+     number of threads the batches are run on (None for one per core).
+    """
+    #filters should be: out_channels, rows, ACGT
+    filter_len = filters.shape[1]
+    flat_filters = np.ascontiguousarray(
+        filters.reshape((len(filters), -1)).T.astype("float32"))
+    biases = biases.astype("float32")
+
+    def embed(to_embed, onehot=None):
+        conv_out = np.matmul(get_windows(
+            data=np.asarray(to_embed, dtype="float32"),
+            window_len=filter_len), flat_filters)
+        if (onehot is not None):
+            onehot_conv_out = np.matmul(get_windows(
+                data=np.asarray(onehot, dtype="float32"),
+                window_len=filter_len), flat_filters)
+            conv_out *= ((onehot_conv_out + biases[None,None,:]) > 0.0)
+        return np.sum(conv_out, axis=1)
+
+    if (require_onehot_match):
+        def batchwise_func(onehot, to_embed, batch_size, progress_update):
+            return run_function_in_batches(
+                    func=lambda onehot, to_embed: embed(to_embed=to_embed,
+                                                        onehot=onehot),
+                    input_data_list=[onehot, to_embed],
+                    batch_size=batch_size,
+                    progress_update=progress_update,
+                    n_jobs=n_jobs)
+    else:
+        def batchwise_func(to_embed, batch_size, progress_update):
+            return run_function_in_batches(
+                    func=embed,
+                    input_data_list=[to_embed],
+                    batch_size=batch_size,
+                    progress_update=progress_update,
+                    n_jobs=n_jobs)
+    return batchwise_func
+
+
+def max_cross_corrs(filters, things_to_scan, min_overlap,
+                       batch_size=50,
+                       func_params_size=1000000,
+                       progress_update=1000):
+    """
+        func_params_size: number of filter parameters per matrix product
+    """
+    assert len(filters.shape)==3,"Did you pass in filters of unequal len?"
+    assert filters.shape[-1]==things_to_scan.shape[-1]
+    filters = filters.astype("float32")
+    to_return = np.zeros((filters.shape[0], len(things_to_scan)))
+    params_per_filter = np.prod(filters[0].shape)
+    filter_batch_size = int(func_params_size/params_per_filter)
+    filter_length = filters.shape[1]
+    padding_amount = int((filter_length)*(1-min_overlap))
+    padded_input = np.pad(
+        np.asarray(things_to_scan, dtype="float32"),
+        pad_width=((0,0), (padding_amount, padding_amount), (0,0)),
+        mode="constant")
+    filter_idx = 0
+    while filter_idx < filters.shape[0]:
+        if (progress_update is not None):
+            print("On filters",filter_idx,"to",
+                  min((filter_idx+filter_batch_size),len(filters)))
+            sys.stdout.flush()
+        filter_batch = filters[filter_idx:
+                              min((filter_idx+filter_batch_size),len(filters))]
+        flat_filters = filter_batch.reshape((len(filter_batch), -1)).T
+        max_cross_corrs = run_function_in_batches(
+            func=lambda x: np.max(np.matmul(
+                get_windows(data=x, window_len=filter_length),
+                flat_filters), axis=1),
+            input_data_list=[padded_input],
+            batch_size=batch_size,
+            progress_update=progress_update)
+        to_return[filter_idx:
+                  min((filter_idx+filter_batch_size),len(filters)),:] =\
+                  np.transpose(max_cross_corrs)
+        filter_idx += filter_batch_size
+    return to_return
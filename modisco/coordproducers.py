@@ -1,5 +1,5 @@
 from __future__ import division, print_function, absolute_import
-from .core import SeqletCoordinates
+from .core import SeqletCoordinates, PackedTracks
 from modisco import util
 import numpy as np
 from collections import defaultdict, Counter
@@ -66,6 +66,8 @@ class SeqletCoordsFWAP(SeqletCoordinates):
     """
         Coordinates for the FixedWindowAroundChunks CoordProducer 
     """
+    __slots__ = ["score"]
+
     def __init__(self, example_idx, start, end, score):
         self.score = score 
         super(SeqletCoordsFWAP, self).__init__(
@@ -82,34 +84,220 @@ class CoordProducerResults(object):
 
     @classmethod
     def from_hdf5(cls, grp):
-        coord_strings = util.load_string_list(dset_name="coords",
-                                              grp=grp)  
-        coords = [SeqletCoordinates.from_string(x) for x in coord_strings] 
+        coords = util.load_coords(dset_name="coords", grp=grp)
         tnt_results = TransformAndThresholdResults.from_hdf5(
                                 grp["tnt_results"])
         return CoordProducerResults(coords=coords,
                                     tnt_results=tnt_results)
 
     def save_hdf5(self, grp):
-        util.save_string_list(
-            string_list=[str(x) for x in self.coords],
-            dset_name="coords",
-            grp=grp) 
+        util.save_coords(coords=self.coords, dset_name="coords", grp=grp)
         self.tnt_results.save_hdf5(
               grp=grp.create_group("tnt_results"))
 
 
+def get_packed_window_sums(tracks, window_size):
+    """Sums of every window of window_size in every example of tracks.
+
+    tracks is a PackedTracks or a list of 1d arrays. All the window sums
+     are computed from a single cumulative sum over the packed buffer.
+     Returns a PackedTracks in which example i has
+     max(len_i-window_size+1, 0) windows.
+    """
+    tracks = PackedTracks.from_tracks(tracks)
+    num_vals = len(tracks.packed)
+    #accumulate in float64, as the running sum spans all the examples
+    cumsum = np.zeros(num_vals+1)
+    np.cumsum(tracks.packed, dtype="float64", out=cumsum[1:])
+    all_window_sums = cumsum[window_size:]-cumsum[:-window_size]
+    #drop the windows that run past the end of their example; these start
+    # in the last (up to) window_size-1 positions of each example
+    num_windows = np.maximum(tracks.lengths-window_size+1, 0)
+    num_invalid = tracks.lengths-num_windows
+    invalid_offsets = np.concatenate([[0], np.cumsum(num_invalid)])\
+                        .astype("int64")
+    invalid_starts = (np.arange(invalid_offsets[-1])
+                      + np.repeat(tracks.offsets[:-1]+num_windows
+                                  -invalid_offsets[:-1], num_invalid))
+    is_valid = np.ones(len(all_window_sums), dtype=bool)
+    is_valid[invalid_starts[invalid_starts < len(is_valid)]] = False
+    return PackedTracks(
+            packed=all_window_sums[is_valid],
+            offsets=np.concatenate([[0], np.cumsum(num_windows)]))
+
+
+def iter_chunked_window_sums(tracks, window_size, examples_per_chunk=1000):
+    #yields the packed window sums of examples_per_chunk examples at a
+    # time, so that the window sums of all the examples are never held
+    # in memory together
+    for chunk_start in range(0, len(tracks), examples_per_chunk):
+        chunk_end = min(chunk_start+examples_per_chunk, len(tracks))
+        if (isinstance(tracks, PackedTracks)):
+            chunk = PackedTracks(
+                packed=tracks.packed[tracks.offsets[chunk_start]:
+                                     tracks.offsets[chunk_end]],
+                offsets=(tracks.offsets[chunk_start:chunk_end+1]
+                         -tracks.offsets[chunk_start]))
+        else:
+            chunk = tracks[chunk_start:chunk_end]
+        yield get_packed_window_sums(tracks=chunk,
+                                     window_size=window_size).packed
+
+
 def get_simple_window_sum_function(window_size):
     def window_sum_function(arrs):
-        to_return = []
-        for arr in arrs:
-            cumsum = np.cumsum(arr)
-            cumsum = np.array([0]+list(cumsum))
-            to_return.append(cumsum[window_size:]-cumsum[:-window_size])
-        return to_return
+        return list(get_packed_window_sums(tracks=arrs,
+                                           window_size=window_size))
     return window_sum_function
 
 
+def get_first_passing_val(vals, passing):
+    #returns the first entry of vals for which passing is True, falling
+    # back on the last entry of vals if nothing passes
+    passing_idxs = np.nonzero(passing)[0]
+    if (len(passing_idxs) > 0):
+        return vals[passing_idxs[0]]
+    else:
+        return vals[-1]
+
+
+def get_greedy_peaks(score_tracks, flank, suppress):
+    """Greedy peak selection with suppression, over all examples at once.
+
+    Equivalent to repeatedly taking the argmax of each track and setting
+     the positions within +- suppress of it to -np.inf, but every candidate
+     is sorted only once rather than rescanning the whole track per peak.
+
+    Arguments:
+        score_tracks: PackedTracks or list of 1d arrays, one per example.
+            Positions that should never be picked must be set to -np.inf.
+        flank: positions closer than this to either end are never picked.
+        suppress: a pick at position i suppresses positions in
+            [floor(i+0.5-suppress), ceil(i+0.5+suppress)).
+
+    Returns:
+        (example_idxs, positions) of the picked peaks, as lists of ints,
+         ordered by example and then by decreasing score (ties broken by
+         position).
+    """
+    score_tracks = PackedTracks.from_tracks(score_tracks)
+    example_lens = score_tracks.lengths
+    if (np.sum(example_lens)==0):
+        return [], []
+    offsets = score_tracks.offsets
+    all_scores = score_tracks.packed
+    all_example_idxs = score_tracks.example_idxs
+    all_positions = (np.arange(len(all_scores))
+                     - offsets[all_example_idxs])
+
+    candidates = np.nonzero(
+        (all_scores > -np.inf)
+        & (all_positions >= flank)
+        & (all_positions < (example_lens[all_example_idxs]-flank)))[0]
+    cand_example_idxs = all_example_idxs[candidates]
+    cand_positions = all_positions[candidates]
+    order = np.lexsort((cand_positions, -all_scores[candidates],
+                        cand_example_idxs))
+    candidates = candidates[order]
+    cand_example_idxs = cand_example_idxs[order]
+    cand_positions = cand_positions[order]
+
+    #suppression bounds, clipped to the example and shifted into the
+    # coordinates of the concatenated tracks
+    left_supp_idxs = (np.maximum(np.floor(cand_positions+0.5-suppress), 0)
+                      .astype("int64") + offsets[cand_example_idxs])
+    right_supp_idxs = (np.minimum(np.ceil(cand_positions+0.5+suppress),
+                                  example_lens[cand_example_idxs])
+                       .astype("int64") + offsets[cand_example_idxs])
+
+    suppressed = np.zeros(len(all_scores), dtype=bool)
+    peak_idxs = []
+    for cand_idx, candidate, left_supp_idx, right_supp_idx in zip(
+            range(len(candidates)), candidates.tolist(),
+            left_supp_idxs.tolist(), right_supp_idxs.tolist()):
+        if (suppressed[candidate]==False):
+            peak_idxs.append(cand_idx)
+            suppressed[left_supp_idx:right_supp_idx] = True
+    return (cand_example_idxs[peak_idxs].tolist(),
+            cand_positions[peak_idxs].tolist())
+
+
+class AbsBinnedHistogram(object):
+    """Fixed-size histogram of window sums, binned by absolute value.
+
+    Positive and negative values are counted separately but share the same
+     bins over [0, max_abs_val], so that both the signed and the absolute
+     value distributions can be recovered. Memory use depends only on
+     num_bins, not on how many values are added.
+    """
+    def __init__(self, max_abs_val, num_bins):
+        self.num_bins = int(num_bins)
+        #guard against a degenerate range if every value is 0
+        self.bin_edges = np.linspace(0, max(max_abs_val, 1e-7),
+                                     self.num_bins+1)
+        self.pos_counts = np.zeros(self.num_bins)
+        self.neg_counts = np.zeros(self.num_bins)
+
+    @property
+    def bin_centers(self):
+        return 0.5*(self.bin_edges[1:]+self.bin_edges[:-1])
+
+    @property
+    def abs_counts(self):
+        return self.pos_counts + self.neg_counts
+
+    def add(self, vals):
+        vals = np.asarray(vals)
+        bin_idxs = np.minimum(
+            (np.abs(vals)*(self.num_bins/self.bin_edges[-1])).astype("int64"),
+            self.num_bins-1)
+        self.pos_counts += np.bincount(bin_idxs[vals >= 0],
+                                       minlength=self.num_bins)
+        self.neg_counts += np.bincount(bin_idxs[vals < 0],
+                                       minlength=self.num_bins)
+        return self
+
+    def get_quantiles(self, counts, quantiles):
+        """Values at the given quantiles (in [0,1]) of the distribution
+         described by counts, interpolating linearly within bins"""
+        cdf = np.concatenate([[0], np.cumsum(counts)])/max(np.sum(counts), 1)
+        return np.interp(quantiles, cdf, self.bin_edges)
+
+    def get_sketch(self, counts, sketch_size):
+        """Evenly spaced quantiles of counts, usable in place of the sorted
+         values by the percentile-based val transformers"""
+        if (np.sum(counts)==0):
+            return np.zeros(0)
+        return self.get_quantiles(
+            counts=counts, quantiles=(np.arange(sketch_size)+0.5)/sketch_size)
+
+    def get_fdr_abs_threshold(self, orig_counts, null_counts, target_fdr):
+        """Smallest absolute value at which the precision, estimated by an
+         isotonic regression over the bins, reaches 1-target_fdr"""
+        from sklearn.isotonic import IsotonicRegression
+        orig_nonzero_bins = np.nonzero(orig_counts)[0]
+        if (len(orig_nonzero_bins)==0):
+            return self.bin_edges[-1]
+        null_weight = np.sum(orig_counts)/max(np.sum(null_counts), 1)
+        bin_weights = orig_counts + null_weight*null_counts
+        nonempty = bin_weights > 0
+        ir = IsotonicRegression().fit(
+            X=self.bin_centers[nonempty],
+            y=orig_counts[nonempty]/bin_weights[nonempty],
+            sample_weight=bin_weights[nonempty])
+        bin_precisions = ir.transform(self.bin_centers)
+        passing_bins = np.nonzero(
+            (orig_counts > 0) & (bin_precisions >= (1-target_fdr)))[0]
+        if (len(passing_bins) > 0):
+            return self.bin_edges[passing_bins[0]]
+        else:
+            #fall back on the largest observed value
+            return self.bin_edges[orig_nonzero_bins[-1]+1]
+
+    def get_count_at_or_above(self, counts, abs_val):
+        return np.sum(counts[self.bin_edges[:-1] >= abs_val])
+
+
 class GenerateNullDist(object):
 
     def __call__(self, score_track):
@@ -159,22 +347,32 @@ class LaplaceNullDist(GenerateNullDist):
     def from_hdf5(cls, grp):
         verbose = grp.attrs["verbose"]
         percentiles_to_use = np.array(grp["percentiles_to_use"][:])
-        return cls(verbose=verbose)
+        if ("num_to_samp" in grp.attrs):
+            num_to_samp = grp.attrs["num_to_samp"]
+            random_seed = grp.attrs["random_seed"]
+        else:
+            num_to_samp = 10000
+            random_seed = 1234
+        return cls(num_to_samp=num_to_samp, verbose=verbose,
+                   percentiles_to_use=percentiles_to_use,
+                   random_seed=random_seed)
 
     def save_hdf5(self, grp):
         grp.attrs["class"] = type(self).__name__
         grp.attrs["verbose"] = self.verbose 
+        grp.attrs["num_to_samp"] = self.num_to_samp
+        grp.attrs["random_seed"] = self.random_seed
         grp.create_dataset('percentiles_to_use',
                            data=self.percentiles_to_use)
 
     def __call__(self, score_track, windowsize, original_summed_score_track):
 
         #original_summed_score_track is supplied to avoid recomputing it 
-        window_sum_function = get_simple_window_sum_function(windowsize)
-        if (original_summed_score_track is not None):
-            original_summed_score_track = window_sum_function(arrs=score_track) 
+        if (original_summed_score_track is None):
+            original_summed_score_track = get_packed_window_sums(
+                tracks=score_track, window_size=windowsize)
 
-        values = np.concatenate(original_summed_score_track, axis=0)
+        values = PackedTracks.from_tracks(original_summed_score_track).packed
        
         # first estimate mu, using two level histogram to get to 1e-6
         hist1, bin_edges1 = np.histogram(values, bins=1000)
@@ -190,8 +388,8 @@ class LaplaceNullDist(GenerateNullDist):
         if (self.verbose):
             print("peak(mu)=", mu)
 
-        pos_values = [x for x in values if x >= mu]
-        neg_values = [x for x in values if x <= mu] 
+        pos_values = values[values >= mu]
+        neg_values = values[values <= mu]
         #for an exponential distribution:
         # cdf = 1 - exp(-lambda*x)
         # exp(-lambda*x) = 1-cdf
@@ -207,19 +405,16 @@ class LaplaceNullDist(GenerateNullDist):
             (np.abs(np.percentile(a=neg_values,
                                   q=100-self.percentiles_to_use)-mu)))
 
+        #draw all the signs, and then all the cdfs, in one batch each
         self.rng.seed(self.random_seed)
         prob_pos = float(len(pos_values))/(len(pos_values)+len(neg_values)) 
-        sampled_vals = []
-        for i in range(self.num_to_samp):
-            sign = 1 if (self.rng.uniform() < prob_pos) else -1
-            if (sign == 1):
-                sampled_cdf = self.rng.uniform()
-                val = -np.log(1-sampled_cdf)/pos_laplace_lambda + mu 
-            else:
-                sampled_cdf = self.rng.uniform() 
-                val = mu + np.log(1-sampled_cdf)/neg_laplace_lambda
-            sampled_vals.append(val)
-        return np.array(sampled_vals)
+        is_pos = self.rng.uniform(size=self.num_to_samp) < prob_pos
+        sampled_cdfs = self.rng.uniform(size=self.num_to_samp)
+        sampled_vals = np.where(
+            is_pos,
+            mu - np.log(1-sampled_cdfs)/pos_laplace_lambda,
+            mu + np.log(1-sampled_cdfs)/neg_laplace_lambda)
+        return sampled_vals
         
 
 class FlipSignNullDist(GenerateNullDist):
@@ -245,60 +440,75 @@ class FlipSignNullDist(GenerateNullDist):
 
     def __call__(self, score_track, windowsize, original_summed_score_track):
         #summed_score_track is supplied to avoid recomputing it 
-
-        window_sum_function = get_simple_window_sum_function(windowsize)
-        if (original_summed_score_track is not None):
-            original_summed_score_track = window_sum_function(arrs=score_track) 
-
-        all_orig_summed_scores = np.concatenate(
-            original_summed_score_track, axis=0)
+        score_track = PackedTracks.from_tracks(score_track)
+        if (original_summed_score_track is None):
+            original_summed_score_track = get_packed_window_sums(
+                tracks=score_track, window_size=windowsize)
+        original_summed_score_track = PackedTracks.from_tracks(
+                                        original_summed_score_track)
+
+        all_orig_summed_scores = original_summed_score_track.packed
         pos_threshold = np.percentile(a=all_orig_summed_scores,
                                       q=self.upper_null_percentile)
         neg_threshold = np.percentile(a=all_orig_summed_scores,
                                       q=self.lower_null_percentile)
 
         #retain only the portions of the tracks that are under the
-        # thresholds
-        retained_track_portions = []
-        num_pos_vals = 0
-        num_neg_vals = 0
-        for (single_score_track, single_summed_score_track)\
-             in zip(score_track, original_summed_score_track):
-            window_passing_track = [
-                (1.0 if (x > neg_threshold and x < pos_threshold) else 0)
-                for x in single_summed_score_track]
-            padded_window_passing_track = [0.0]*int(windowsize-1) 
-            padded_window_passing_track.extend(window_passing_track)
-            padded_window_passing_track.extend([0.0]*int(windowsize-1))
-            pos_in_passing_window = window_sum_function(
-                                      [padded_window_passing_track])[0] 
-            assert len(single_score_track)==len(pos_in_passing_window) 
-            single_retained_track = []
-            for (val, pos_passing) in zip(single_score_track,
-                                          pos_in_passing_window):
-                if (pos_passing > 0):
-                    single_retained_track.append(val) 
-                    num_pos_vals += (1 if val > 0 else 0)
-                    num_neg_vals += (1 if val < 0 else 0)
-            retained_track_portions.append(single_retained_track)
+        # thresholds, i.e. positions covered by at least one window whose
+        # sum falls between the thresholds. The passing windows of each
+        # example are padded by windowsize-1 zeros on both sides, so that
+        # their window sums line up with the positions of the example.
+        pad = int(windowsize-1)
+        window_lengths = original_summed_score_track.lengths
+        padded_offsets = np.concatenate(
+            [[0], np.cumsum(window_lengths+2*pad)]).astype("int64")
+        padded_window_passing = np.zeros(padded_offsets[-1])
+        padded_window_passing[
+            np.arange(len(all_orig_summed_scores))
+            + np.repeat(padded_offsets[:-1]+pad
+                        -original_summed_score_track.offsets[:-1],
+                        window_lengths)] = (
+            (all_orig_summed_scores > neg_threshold)
+            & (all_orig_summed_scores < pos_threshold))
+        pos_in_passing_window = get_packed_window_sums(
+            tracks=PackedTracks(packed=padded_window_passing,
+                                offsets=padded_offsets),
+            window_size=windowsize)
+        assert np.all(pos_in_passing_window.lengths==score_track.lengths)
+        is_retained = pos_in_passing_window.packed > 0
+        retained_track_portions = PackedTracks(
+            packed=np.asarray(score_track.packed)[is_retained],
+            offsets=np.concatenate([[0], np.cumsum(is_retained)])[
+                     score_track.offsets])
+        all_retained_vals = retained_track_portions.packed
+        num_pos_vals = np.sum(all_retained_vals > 0)
+        num_neg_vals = np.sum(all_retained_vals < 0)
 
         print("Fraction of positions retained:",
-              sum(len(x) for x in retained_track_portions)/
-              sum(len(x) for x in score_track))
+              len(all_retained_vals)/len(score_track.packed))
             
         prob_pos = num_pos_vals/float(num_pos_vals + num_neg_vals)
         self.rng.seed(self.seed)
-        null_tracks = []
-        for i in range(self.num_seq_to_samp):
-            random_track = retained_track_portions[
-             int(self.rng.randint(0,len(retained_track_portions)))]
-            track_with_sign_flips = np.array([
-             abs(x)*(1 if self.rng.uniform() < prob_pos else -1)
-             for x in random_track])
-            if (self.shuffle_pos):
+        #draw the tracks, gather them into one buffer, then draw the sign
+        # flips for all of their positions in one batch
+        sampled_track_idxs = self.rng.randint(
+            0, len(retained_track_portions), size=self.num_seq_to_samp)
+        sampled_lengths = retained_track_portions.lengths[sampled_track_idxs]
+        sampled_offsets = np.concatenate(
+            [[0], np.cumsum(sampled_lengths)]).astype("int64")
+        all_sampled_vals = all_retained_vals[
+            np.arange(sampled_offsets[-1])
+            + np.repeat(retained_track_portions.offsets[sampled_track_idxs]
+                        -sampled_offsets[:-1], sampled_lengths)]
+        all_sampled_vals = np.abs(all_sampled_vals)*np.where(
+            self.rng.uniform(size=len(all_sampled_vals)) < prob_pos, 1, -1)
+        null_tracks = PackedTracks(packed=all_sampled_vals,
+                                   offsets=sampled_offsets)
+        if (self.shuffle_pos):
+            for track_with_sign_flips in null_tracks:
                 self.rng.shuffle(track_with_sign_flips) 
-            null_tracks.append(track_with_sign_flips)
-        return np.concatenate(window_sum_function(null_tracks), axis=0)
+        return get_packed_window_sums(tracks=null_tracks,
+                                      window_size=windowsize).packed
 
 
 class FixedWindowAroundChunks(AbstractCoordProducer):
@@ -313,6 +523,8 @@ class FixedWindowAroundChunks(AbstractCoordProducer):
                        max_seqlets_total=None,
                        progress_update=5000,
                        verbose=True,
+                       threshold_histogram_bins=None,
+                       percentile_sketch_size=10000,
                        ):
         self.sliding = sliding
         self.flank = flank
@@ -325,6 +537,11 @@ class FixedWindowAroundChunks(AbstractCoordProducer):
         self.max_seqlets_total = None
         self.progress_update = progress_update
         self.verbose = verbose
+        #if threshold_histogram_bins is not None, thresholds and percentiles
+        # are estimated from fixed-size histograms of the window sums
+        # rather than from the full sorted set of window sums
+        self.threshold_histogram_bins = threshold_histogram_bins
+        self.percentile_sketch_size = percentile_sketch_size
 
     @classmethod
     def from_hdf5(cls, grp):
@@ -342,13 +559,21 @@ class FixedWindowAroundChunks(AbstractCoordProducer):
         #TODO: load min_seqlets feature
         progress_update = grp.attrs["progress_update"]
         verbose = grp.attrs["verbose"]
+        if ("threshold_histogram_bins" in grp.attrs):
+            threshold_histogram_bins = grp.attrs["threshold_histogram_bins"]
+            percentile_sketch_size = grp.attrs["percentile_sketch_size"]
+        else:
+            threshold_histogram_bins = None
+            percentile_sketch_size = 10000
         return cls(sliding=sliding, flank=flank, suppress=suppress,
                     target_fdr=target_fdr,
                     min_passing_windows_frac=min_passing_windows_frac,
                     max_passing_windows_frac=max_passing_windows_frac,
                     separate_pos_neg_thresholds=separate_pos_neg_thresholds,
                     max_seqlets_total=max_seqlets_total,
-                    progress_update=progress_update, verbose=verbose) 
+                    progress_update=progress_update, verbose=verbose,
+                    threshold_histogram_bins=threshold_histogram_bins,
+                    percentile_sketch_size=percentile_sketch_size) 
 
     def save_hdf5(self, grp):
         grp.attrs["class"] = type(self).__name__
@@ -365,17 +590,172 @@ class FixedWindowAroundChunks(AbstractCoordProducer):
             grp.attrs["max_seqlets_total"] = self.max_seqlets_total 
         grp.attrs["progress_update"] = self.progress_update
         grp.attrs["verbose"] = self.verbose
+        if (self.threshold_histogram_bins is not None):
+            grp.attrs["threshold_histogram_bins"] =\
+                self.threshold_histogram_bins
+            grp.attrs["percentile_sketch_size"] = self.percentile_sketch_size
+
+    def _show_or_save_plot(self):
+        from matplotlib import pyplot as plt
+        if plt.isinteractive():
+            plt.show()
+        else:
+            import os, errno
+            try:
+                os.makedirs("figures")
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            fname = ("figures/scoredist_" +
+                     str(FixedWindowAroundChunks.count) + ".png")
+            plt.savefig(fname)
+            print("saving plot to " + fname)
+            FixedWindowAroundChunks.count += 1
+
+    def _get_histogram_tnt_results(self, score_track, null_track,
+                                         original_summed_score_track):
+        if (self.verbose):
+            print("Generating null dist")
+            sys.stdout.flush()
+        #the observed window sums stay in memory, as the peaks are called
+        # on them; the null window sums are computed a chunk of examples
+        # at a time, once for the range of the bins and once to count them
+        if (hasattr(null_track, '__call__')):
+            null_vals = np.asarray(null_track(
+                score_track=score_track,
+                windowsize=self.sliding,
+                original_summed_score_track=original_summed_score_track))
+            get_null_val_chunks = lambda: [null_vals]
+        else:
+            if (isinstance(null_track, PackedTracks)==False):
+                null_track = list(null_track)
+            get_null_val_chunks = lambda: iter_chunked_window_sums(
+                tracks=null_track, window_size=self.sliding)
+        orig_vals = original_summed_score_track.packed
+
+        if (self.verbose):
+            print("Computing threshold from histograms with "
+                  +str(self.threshold_histogram_bins)+" bins")
+            sys.stdout.flush()
+        max_abs_val = max([np.max(np.abs(orig_vals))
+                           if len(orig_vals) > 0 else 0]
+                          +[np.max(np.abs(x)) for x in get_null_val_chunks()
+                            if len(x) > 0])
+        orig_hist = AbsBinnedHistogram(max_abs_val=max_abs_val,
+                                       num_bins=self.threshold_histogram_bins)
+        orig_hist.add(orig_vals)
+        null_hist = AbsBinnedHistogram(max_abs_val=max_abs_val,
+                                       num_bins=self.threshold_histogram_bins)
+        for null_val_chunk in get_null_val_chunks():
+            null_hist.add(null_val_chunk)
+        num_windows = np.sum(orig_hist.abs_counts)
+
+        pos_threshold = orig_hist.get_fdr_abs_threshold(
+            orig_counts=orig_hist.pos_counts,
+            null_counts=null_hist.pos_counts, target_fdr=self.target_fdr)
+        neg_threshold = -orig_hist.get_fdr_abs_threshold(
+            orig_counts=orig_hist.neg_counts,
+            null_counts=null_hist.neg_counts, target_fdr=self.target_fdr)
+        frac_passing_windows = (
+            orig_hist.get_count_at_or_above(counts=orig_hist.pos_counts,
+                                           abs_val=pos_threshold)
+            + orig_hist.get_count_at_or_above(counts=orig_hist.neg_counts,
+                                             abs_val=-neg_threshold)
+            )/float(num_windows)
+
+        if (self.verbose):
+            print("Thresholds from null dist were",
+                  neg_threshold," and ",pos_threshold)
+
+        #adjust the thresholds if the fall outside the min/max
+        # windows frac
+        for (frac, is_too_few) in [(self.min_passing_windows_frac, True),
+                                   (self.max_passing_windows_frac, False)]:
+            if ((is_too_few and frac_passing_windows < frac) or
+                (is_too_few==False and frac_passing_windows > frac)):
+                if (self.verbose):
+                    print("Passing windows frac was",
+                          frac_passing_windows,", which is "
+                          +("below " if is_too_few else "above "),
+                          frac,"; adjusting")
+                if (self.separate_pos_neg_thresholds):
+                    pos_threshold = orig_hist.get_quantiles(
+                        counts=orig_hist.pos_counts, quantiles=1-frac)
+                    neg_threshold = -orig_hist.get_quantiles(
+                        counts=orig_hist.neg_counts, quantiles=1-frac)
+                else:
+                    pos_threshold = orig_hist.get_quantiles(
+                        counts=orig_hist.abs_counts, quantiles=1-frac)
+                    neg_threshold = -pos_threshold
+
+        #the percentile maps only keep a fixed-size sketch of the
+        # distribution of window sums
+        if (self.separate_pos_neg_thresholds):
+            val_transformer = SignedPercentileValTransformer(
+                distribution=np.concatenate([
+                    orig_hist.get_sketch(
+                        counts=orig_hist.pos_counts,
+                        sketch_size=self.percentile_sketch_size),
+                    -orig_hist.get_sketch(
+                        counts=orig_hist.neg_counts,
+                        sketch_size=self.percentile_sketch_size)], axis=0))
+        else:
+            val_transformer = AbsPercentileValTransformer(
+                distribution=orig_hist.get_sketch(
+                    counts=orig_hist.abs_counts,
+                    sketch_size=self.percentile_sketch_size))
+
+        if (self.verbose):
+            print("Final raw thresholds are",
+                  neg_threshold," and ",pos_threshold)
+            print("Final transformed thresholds are",
+                  val_transformer(neg_threshold)," and ",
+                  val_transformer(pos_threshold))
+
+        from matplotlib import pyplot as plt
+        plt.figure()
+        signed_bin_centers = np.concatenate(
+            [-orig_hist.bin_centers[::-1], orig_hist.bin_centers], axis=0)
+        orig_signed_counts = np.concatenate(
+            [orig_hist.neg_counts[::-1], orig_hist.pos_counts], axis=0)
+        null_signed_counts = np.concatenate(
+            [null_hist.neg_counts[::-1], null_hist.pos_counts], axis=0)
+        plt.plot(signed_bin_centers, orig_signed_counts)
+        plt.plot(signed_bin_centers, null_signed_counts*(
+            num_windows/max(np.sum(null_signed_counts), 1)))
+        plt.plot([neg_threshold, neg_threshold],
+                 [0, np.max(orig_signed_counts)], color="red")
+        plt.plot([pos_threshold, pos_threshold],
+                 [0, np.max(orig_signed_counts)], color="red")
+        self._show_or_save_plot()
+
+        return TransformAndThresholdResults(
+            neg_threshold=neg_threshold,
+            transformed_neg_threshold=val_transformer(neg_threshold),
+            pos_threshold=pos_threshold,
+            transformed_pos_threshold=val_transformer(pos_threshold),
+            val_transformer=val_transformer)
 
     def __call__(self, score_track, null_track, tnt_results=None):
     
-        # score_track now can be a list of arrays,
-        assert all([len(x.shape)==1 for x in score_track]) 
-        window_sum_function = get_simple_window_sum_function(self.sliding)
+        # score_track can be a list of arrays or a PackedTracks; it is
+        # packed once so that all the examples are processed together
+        score_track = PackedTracks.from_tracks(score_track)
+        assert len(score_track.packed.shape)==1
 
+        start_time = time.time()
         if (self.verbose):
             print("Computing windowed sums on original")
             sys.stdout.flush()
-        original_summed_score_track = window_sum_function(arrs=score_track) 
+        original_summed_score_track = get_packed_window_sums(
+            tracks=score_track, window_size=self.sliding)
+        num_windows = len(original_summed_score_track.packed)
+
+        if ((tnt_results is None) and
+            (self.threshold_histogram_bins is not None)):
+            tnt_results = self._get_histogram_tnt_results(
+                score_track=score_track, null_track=null_track,
+                original_summed_score_track=original_summed_score_track)
 
         #Determine the window thresholds
         if (tnt_results is None):
@@ -389,46 +769,49 @@ class FixedWindowAroundChunks(AbstractCoordProducer):
                     windowsize=self.sliding,
                     original_summed_score_track=original_summed_score_track)
             else:
-                null_summed_score_track = window_sum_function(arrs=null_track) 
-                null_vals = list(np.concatenate(null_summed_score_track, axis=0))
+                null_vals = get_packed_window_sums(
+                    tracks=null_track, window_size=self.sliding).packed
+            null_vals = np.asarray(null_vals)
 
             if (self.verbose):
                 print("Computing threshold")
                 sys.stdout.flush()
             from sklearn.isotonic import IsotonicRegression
-            orig_vals = list(
-                np.concatenate(original_summed_score_track, axis=0))
-            pos_orig_vals = np.array(sorted([x for x in orig_vals if x >= 0]))
-            neg_orig_vals = np.array(sorted([x for x in orig_vals if x < 0],
-                                      key=lambda x: abs(x)))
-            pos_null_vals = [x for x in null_vals if x >= 0]
-            neg_null_vals = [x for x in null_vals if x < 0]
+            #copied, as orig_vals is shuffled in place for plotting below
+            orig_vals = np.array(original_summed_score_track.packed)
+            pos_orig_vals = np.sort(orig_vals[orig_vals >= 0])
+            #sorted by increasing magnitude, i.e. decreasing value
+            neg_orig_vals = np.sort(orig_vals[orig_vals < 0])[::-1]
+            pos_null_vals = null_vals[null_vals >= 0]
+            neg_null_vals = null_vals[null_vals < 0]
             pos_ir = IsotonicRegression().fit(
                 X=np.concatenate([pos_orig_vals,pos_null_vals], axis=0),
-                y=([1.0 for x in pos_orig_vals]
-                   +[0.0 for x in pos_null_vals]),
-                sample_weight=([1.0 for x in pos_orig_vals]+
-                         [len(pos_orig_vals)/len(pos_null_vals)
-                          for x in pos_null_vals]))
+                y=np.concatenate([np.ones(len(pos_orig_vals)),
+                                  np.zeros(len(pos_null_vals))], axis=0),
+                sample_weight=np.concatenate([
+                    np.ones(len(pos_orig_vals)),
+                    np.full(len(pos_null_vals),
+                            len(pos_orig_vals)/len(pos_null_vals))], axis=0))
             pos_val_precisions = pos_ir.transform(pos_orig_vals)
             neg_ir = IsotonicRegression(increasing=False).fit(
                 X=np.concatenate([neg_orig_vals,neg_null_vals], axis=0),
-                y=([1.0 for x in neg_orig_vals]
-                   +[0.0 for x in neg_null_vals]),
-                sample_weight=([1.0 for x in neg_orig_vals]+
-                         [len(neg_orig_vals)/len(neg_null_vals)
-                          for x in neg_null_vals]))
+                y=np.concatenate([np.ones(len(neg_orig_vals)),
+                                  np.zeros(len(neg_null_vals))], axis=0),
+                sample_weight=np.concatenate([
+                    np.ones(len(neg_orig_vals)),
+                    np.full(len(neg_null_vals),
+                            len(neg_orig_vals)/len(neg_null_vals))], axis=0))
             neg_val_precisions = neg_ir.transform(neg_orig_vals)
 
-            pos_threshold = ([x[1] for x in
-             zip(pos_val_precisions, pos_orig_vals) if x[0]
-              >= (1-self.target_fdr)]+[pos_orig_vals[-1]])[0]
-            neg_threshold = ([x[1] for x in
-             zip(neg_val_precisions, neg_orig_vals) if x[0]
-              >= (1-self.target_fdr)]+[neg_orig_vals[-1]])[0]
+            pos_threshold = get_first_passing_val(
+                vals=pos_orig_vals,
+                passing=(pos_val_precisions >= (1-self.target_fdr)))
+            neg_threshold = get_first_passing_val(
+                vals=neg_orig_vals,
+                passing=(neg_val_precisions >= (1-self.target_fdr)))
             frac_passing_windows =(
-                sum(pos_orig_vals >= pos_threshold)
-                 + sum(neg_orig_vals <= neg_threshold))/float(len(orig_vals))
+                np.sum(pos_orig_vals >= pos_threshold)
+                 + np.sum(neg_orig_vals <= neg_threshold))/float(len(orig_vals))
 
             if (self.verbose):
                 print("Thresholds from null dist were",
@@ -443,10 +826,10 @@ class FixedWindowAroundChunks(AbstractCoordProducer):
                           self.min_passing_windows_frac,"; adjusting")
                 if (self.separate_pos_neg_thresholds):
                     pos_threshold = np.percentile(
-                        a=[x for x in orig_vals if x > 0],
+                        a=orig_vals[orig_vals > 0],
                         q=100*(1-self.min_passing_windows_frac))
                     neg_threshold = np.percentile(
-                        a=[x for x in orig_vals if x < 0],
+                        a=orig_vals[orig_vals < 0],
                         q=100*(self.min_passing_windows_frac))
                 else:
                     pos_threshold = np.percentile(
@@ -460,10 +843,10 @@ class FixedWindowAroundChunks(AbstractCoordProducer):
                           self.max_passing_windows_frac,"; adjusting")
                 if (self.separate_pos_neg_thresholds):
                     pos_threshold = np.percentile(
-                        a=[x for x in orig_vals if x > 0],
+                        a=orig_vals[orig_vals > 0],
                         q=100*(1-self.max_passing_windows_frac))
                     neg_threshold = np.percentile(
-                        a=[x for x in orig_vals if x < 0],
+                        a=orig_vals[orig_vals < 0],
                         q=100*(self.max_passing_windows_frac))
                 else:
                     pos_threshold = np.percentile(
@@ -498,11 +881,11 @@ class FixedWindowAroundChunks(AbstractCoordProducer):
                                bins=histbins, alpha=0.5)
 
             bincenters = 0.5*(histbins[1:]+histbins[:-1])
-            poshistvals,posbins = zip(*[x for x in zip(hist,bincenters)
-                                         if x[1] > 0])
+            poshistvals = hist[bincenters > 0]
+            posbins = bincenters[bincenters > 0]
             posbin_precisions = pos_ir.transform(posbins) 
-            neghistvals, negbins = zip(*[x for x in zip(hist,bincenters)
-                                         if x[1] < 0])
+            neghistvals = hist[bincenters < 0]
+            negbins = bincenters[bincenters < 0]
             negbin_precisions = neg_ir.transform(negbins) 
             plt.plot(list(negbins)+list(posbins),
                      (list(np.minimum(neghistvals,
@@ -516,21 +899,7 @@ class FixedWindowAroundChunks(AbstractCoordProducer):
                      color="red")
             plt.plot([pos_threshold, pos_threshold], [0, np.max(hist)],
                      color="red")
-
-            if plt.isinteractive():
-                plt.show()
-            else:
-                import os, errno
-                try:
-                    os.makedirs("figures")
-                except OSError as e:
-                    if e.errno != errno.EEXIST:
-                        raise
-                fname = ("figures/scoredist_" +
-                         str(FixedWindowAroundChunks.count) + ".png")
-                plt.savefig(fname)
-                print("saving plot to " + fname)
-                FixedWindowAroundChunks.count += 1
+            self._show_or_save_plot()
 
             tnt_results = TransformAndThresholdResults(
                 neg_threshold=neg_threshold,
@@ -542,56 +911,42 @@ class FixedWindowAroundChunks(AbstractCoordProducer):
         neg_threshold = tnt_results.neg_threshold
         pos_threshold = tnt_results.pos_threshold
 
-        summed_score_track = [np.array(x) for x in original_summed_score_track]
-
         #if a position is less than the threshold, set it to -np.inf
-        summed_score_track = [
-            np.array([np.abs(y) if (y > pos_threshold
-                            or y < neg_threshold)
-                           else -np.inf for y in x])
-            for x in summed_score_track]
-
+        orig_vals = original_summed_score_track.packed
+        summed_score_track = PackedTracks(
+            packed=np.where((orig_vals > pos_threshold)
+                            | (orig_vals < neg_threshold),
+                            np.abs(orig_vals), -np.inf),
+            offsets=original_summed_score_track.offsets)
+
+        #greedily pick the highest-scoring windows in each example,
+        # suppressing the chunks within +- self.suppress of each pick and
+        # never picking windows that can't be expanded by self.flank
+        peak_example_idxs, peak_positions = get_greedy_peaks(
+            score_tracks=summed_score_track,
+            flank=self.flank, suppress=self.suppress)
+        peak_scores = orig_vals[
+            original_summed_score_track.offsets[peak_example_idxs]
+            +np.array(peak_positions, dtype="int64")]
         coords = []
-        for example_idx,single_score_track in enumerate(summed_score_track):
-            #set the stuff near the flanks to -np.inf so that we
-            # don't pick it up during argmax
-            single_score_track[0:self.flank] = -np.inf
-            single_score_track[len(single_score_track)-(self.flank):
-                               len(single_score_track)] = -np.inf
-            while True:
-                argmax = np.argmax(single_score_track,axis=0)
-                max_val = single_score_track[argmax]
-
-                #bail if exhausted everything that passed the threshold
-                #and was not suppressed
-                if (max_val == -np.inf):
-                    break
-
-                #need to be able to expand without going off the edge
-                if ((argmax >= self.flank) and
-                    (argmax < (len(single_score_track)-self.flank))): 
-
-                    coord = SeqletCoordsFWAP(
-                        example_idx=example_idx,
-                        start=argmax-self.flank,
-                        end=argmax+self.sliding+self.flank,
-                        score=original_summed_score_track[example_idx][argmax]) 
-                    assert (coord.score > pos_threshold
-                            or coord.score < neg_threshold)
-                    coords.append(coord)
-                else:
-                    assert False,\
-                     ("This shouldn't happen because I set stuff near the"
-                      "border to -np.inf early on")
-                #suppress the chunks within +- self.suppress
-                left_supp_idx = int(max(np.floor(argmax+0.5-self.suppress),
-                                                 0))
-                right_supp_idx = int(min(np.ceil(argmax+0.5+self.suppress),
-                                     len(single_score_track)))
-                single_score_track[left_supp_idx:right_supp_idx] = -np.inf 
+        for example_idx, peak_pos, peak_score in zip(
+                peak_example_idxs, peak_positions, peak_scores):
+            coord = SeqletCoordsFWAP(
+                example_idx=example_idx,
+                start=peak_pos-self.flank,
+                end=peak_pos+self.sliding+self.flank,
+                score=peak_score) 
+            assert (coord.score > pos_threshold
+                    or coord.score < neg_threshold)
+            coords.append(coord)
 
         if (self.verbose):
             print("Got "+str(len(coords))+" coords")
+            elapsed = time.time()-start_time
+            print("Processed "+str(num_windows)+" windows in "
+                  +("%.2f"%elapsed)+" s ("
+                  +("%.1f"%(num_windows/max(elapsed, 1e-9)))
+                  +" windows/s)")
             sys.stdout.flush()
 
         if ((self.max_seqlets_total is not None) and
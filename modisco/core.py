@@ -11,8 +11,31 @@ from . import util
 from .value_provider import AbstractValueProvider
 
 
+def get_readonly_view(arr):
+    """Read-only view sharing memory with arr (None if arr is None)"""
+    if (arr is None):
+        return None
+    view = np.asarray(arr).view()
+    view.flags.writeable = False
+    return view
+
+
+def get_writeable(arr):
+    """Returns arr if it can be modified in place, else a copy of it.
+
+    Used for copy-on-write of arrays that are shared through read-only
+     views: the first in-place modification makes the private copy.
+    """
+    if (arr is None or arr.flags.writeable):
+        return arr
+    return np.array(arr)
+
+
 class Snippet(object):
 
+    #slotted, as there is one snippet per seqlet and track
+    __slots__ = ["fwd", "rev", "has_pos_axis"]
+
     def __init__(self, fwd, rev, has_pos_axis):
         if (rev is not None):
             assert len(fwd)==len(rev),str(len(fwd))+" "+str(len(rev))
@@ -46,7 +69,10 @@ class Snippet(object):
         return len(self.fwd)
 
     def revcomp(self):
-        return Snippet(fwd=np.copy(self.rev), rev=np.copy(self.fwd),
+        #the strands are swapped without copying; the read-only views
+        # guard the memory shared with this snippet
+        return Snippet(fwd=get_readonly_view(self.rev),
+                       rev=get_readonly_view(self.fwd),
                        has_pos_axis=self.has_pos_axis)
 
 
@@ -69,6 +95,9 @@ class DataTrack(object):
     def __len__(self):
         return len(self.fwd_tracks)
 
+    def get_example_len(self, example_idx):
+        return len(self.fwd_tracks[example_idx])
+
     def get_snippet(self, coor):
         if (self.has_pos_axis==False):
             snippet = Snippet(
@@ -91,6 +120,159 @@ class DataTrack(object):
             snippet = snippet.revcomp()
         return snippet
 
+    def get_snippet_arrays(self, example_idxs, starts, ends, is_revcomp):
+        """
+        fwd and rev data of many snippets at once, each stacked into one
+         array with the snippet as the first axis (rev is None if there is
+         no rev track). All the snippets must have the same length. When
+         the tracks are arrays, the snippets are gathered with a single
+         fancy index per strand.
+        """
+        if (isinstance(self.fwd_tracks, np.ndarray) and
+            (self.rev_tracks is None
+             or isinstance(self.rev_tracks, np.ndarray))):
+            if (self.has_pos_axis):
+                assert len(set((ends-starts).tolist())) <= 1
+                positions = np.arange(ends[0]-starts[0]
+                                      if len(starts) > 0 else 0)
+                fwd = self.fwd_tracks[example_idxs[:,None],
+                                      starts[:,None]+positions[None,:]]
+                rev = (self.rev_tracks[
+                        example_idxs[:,None],
+                        (self.fwd_tracks.shape[1]-ends)[:,None]
+                        +positions[None,:]]
+                       if self.rev_tracks is not None else None)
+            else:
+                fwd = self.fwd_tracks[example_idxs]
+                rev = (self.rev_tracks[example_idxs]
+                       if self.rev_tracks is not None else None)
+            if (np.any(is_revcomp)):
+                assert rev is not None
+                swap = np.reshape(is_revcomp,
+                                  [len(is_revcomp)]+[1]*(len(fwd.shape)-1))
+                fwd, rev = np.where(swap, rev, fwd), np.where(swap, fwd, rev)
+            return fwd, rev
+        snippets = [self.get_snippet(coor=SeqletCoordinates(
+                        example_idx=example_idx, start=start, end=end,
+                        is_revcomp=rc))
+                    for (example_idx, start, end, rc) in
+                    zip(example_idxs, starts, ends, is_revcomp)]
+        return (np.array([x.fwd for x in snippets]),
+                (np.array([x.rev for x in snippets])
+                 if self.rev_tracks is not None else None))
+
+
+class BlockCachedExamples(object):
+    """
+    Read-only, list-like view of the examples in an array-like source
+     (e.g. an h5py dataset or np.memmap) whose first axis is the example.
+     Examples are read from the source in blocks of block_size, and the
+     max_cached_blocks most recently used blocks are kept in memory.
+    """
+    def __init__(self, source, block_size=256, max_cached_blocks=64):
+        self.source = source
+        self.block_size = block_size
+        self.max_cached_blocks = max_cached_blocks
+        self._block_cache = OrderedDict()
+
+    def __len__(self):
+        return len(self.source)
+
+    def _get_block(self, block_idx):
+        if (block_idx in self._block_cache):
+            block = self._block_cache.pop(block_idx)
+        else:
+            block = np.array(self.source[
+                     block_idx*self.block_size:
+                     min((block_idx+1)*self.block_size, len(self.source))])
+            if (len(self._block_cache) >= self.max_cached_blocks):
+                self._block_cache.popitem(last=False)
+        self._block_cache[block_idx] = block
+        return block
+
+    def __getitem__(self, example_idx):
+        if (example_idx < 0):
+            example_idx += len(self)
+        if (example_idx < 0 or example_idx >= len(self)):
+            raise IndexError("example_idx "+str(example_idx)
+                             +" out of range for "+str(len(self))
+                             +" examples")
+        #the returned example is a view into the cached block
+        return self._get_block(int(example_idx)//self.block_size)[
+                int(example_idx)%self.block_size]
+
+    def __iter__(self):
+        for example_idx in range(len(self)):
+            yield self[example_idx]
+
+
+class ReversedExamples(object):
+    """
+    List-like view returning each example of examples with every axis
+     reversed (e.g. the reverse complement of a length x ACGT track),
+     without copying
+    """
+    def __init__(self, examples):
+        self.examples = examples
+
+    def __len__(self):
+        return len(self.examples)
+
+    def __getitem__(self, example_idx):
+        example = self.examples[example_idx]
+        return example[tuple([slice(None, None, -1)]*len(example.shape))]
+
+    def __iter__(self):
+        for example_idx in range(len(self)):
+            yield self[example_idx]
+
+
+class LazyDataTrack(DataTrack):
+
+    """
+    DataTrack that reads examples on demand from source, an array-like of
+     shape (examples, positions, ...) such as an h5py dataset or a
+     np.memmap, rather than holding every example in memory. If revcomp is
+     True, the reverse strand is served as a reversed view of the forward
+     strand. At most block_size*max_cached_blocks examples are held in
+     memory per track (e.g. 256 float32 examples of 1kb x 4 are ~4MB a
+     block, so ~256MB with the default 64 blocks).
+    """
+    def __init__(self, name, source, has_pos_axis, revcomp=True,
+                       block_size=256, max_cached_blocks=64):
+        self.name = name
+        self.source = source
+        self.fwd_tracks = BlockCachedExamples(
+                            source=source, block_size=block_size,
+                            max_cached_blocks=max_cached_blocks)
+        self.rev_tracks = (ReversedExamples(self.fwd_tracks)
+                           if revcomp else None)
+        self.has_pos_axis = has_pos_axis
+
+    def get_example_len(self, example_idx):
+        #all examples in the source have the same length
+        return self.source.shape[1]
+
+    def get_snippet(self, coor):
+        #the window is copied out of the cached block, so that snippets
+        # don't keep whole blocks in memory after they are evicted; the
+        # rev strand is a reversed view of the copy
+        example = self.fwd_tracks[coor.example_idx]
+        if (self.has_pos_axis):
+            assert coor.start >= 0
+            assert len(example) >= coor.end, coor.end
+            fwd = np.array(example[coor.start:coor.end])
+        else:
+            fwd = np.array(example)
+        snippet = Snippet(
+                fwd=fwd,
+                rev=(fwd[tuple([slice(None, None, -1)]*len(fwd.shape))]
+                     if self.rev_tracks is not None else None),
+                has_pos_axis=self.has_pos_axis)
+        if (coor.is_revcomp):
+            snippet = snippet.revcomp()
+        return snippet
+
 
 class TrackSet(object):
 
@@ -104,12 +286,12 @@ class TrackSet(object):
                 = attribute_provider 
 
     def get_example_idx_len(self, example_idx):
-        return len(self.track_name_to_data_track[
-                    list(self.track_name_to_data_track.keys())[0]]
-                    .fwd_tracks[example_idx])
+        return self.track_name_to_data_track[
+                list(self.track_name_to_data_track.keys())[0]]\
+                .get_example_len(example_idx)
 
     def add_track(self, data_track):
-        assert type(data_track).__name__=="DataTrack"
+        assert isinstance(data_track, DataTrack)
         if len(self.track_name_to_data_track)==0:
             self.num_items = len(data_track) 
         else:
@@ -147,6 +329,26 @@ class TrackSet(object):
                  self.attribute_name_to_attribute_provider[attribute_name])
         return seqlet
 
+    def materialize_seqlets(self, seqlets, track_names=None,
+                                  attribute_names=None):
+        """Add to each seqlet the snippets and attributes it doesn't have.
+
+        Used to fill in seqlets that were created from coordinates alone
+         (or with a subset of tracks) once it is known which are needed.
+        """
+        if (track_names is None):
+            track_names=self.track_name_to_data_track.keys()
+        if (attribute_names is None):
+            attribute_names=self.attribute_name_to_attribute_provider.keys()
+        for seqlet in seqlets:
+            self.augment_seqlet(
+                seqlet=seqlet,
+                track_names=[x for x in track_names
+                             if x not in seqlet.track_name_to_snippet],
+                attribute_names=[x for x in attribute_names if x not in
+                                 seqlet.attribute_name_to_attribute])
+        return seqlets
+
 
 class CoordOverlapDetector(object):
 
@@ -212,30 +414,97 @@ class SeqletsOverlapResolver(object):
         self.overlap_detector.save_hdf5(grp.create_group("overlap_detector"))
         self.seqlet_comparator.save_hdf5(grp.create_group("seqlet_comparator"))
 
+    def _can_sweep(self):
+        return (isinstance(self.overlap_detector, CoordOverlapDetector)
+                and self.overlap_detector.min_overlap_fraction >= 0
+                and isinstance(self.seqlet_comparator, SeqletComparator))
+
+    def _resolve_pairwise(self, seqlets):
+        final_seqlets_set = OrderedDict([(x,1) for x in seqlets])
+        for i in range(len(seqlets)):
+            seqlet1 = seqlets[i]
+            for seqlet2 in seqlets[i+1:]:
+                if (seqlet1 not in final_seqlets_set):
+                    break
+                if ((seqlet2 in final_seqlets_set)
+                     and self.overlap_detector(seqlet1.coor,
+                                               seqlet2.coor)):
+                    del final_seqlets_set[
+                         self.seqlet_comparator.get_smaller(
+                          seqlet1, seqlet2)]
+        return list(final_seqlets_set.keys())
+
+    def _resolve_with_sweep(self, seqlets):
+        #Gives the same result as _resolve_pairwise, but only visits the
+        # pairs whose intervals can overlap, found by sorting on the start
+        # coordinate, and calls the value provider once per seqlet.
+        #Since min_overlap_fraction >= 0, two seqlets can only overlap if
+        # start2 <= end1 and start2 >= start1 - (max seqlet length)
+        min_overlap_fraction = self.overlap_detector.min_overlap_fraction
+        value_provider = self.seqlet_comparator.value_provider
+        starts = np.array([x.coor.start for x in seqlets])
+        ends = np.array([x.coor.end for x in seqlets])
+        lengths = ends - starts
+        values = [value_provider(x) for x in seqlets]
+        max_length = np.max(lengths)
+        order_by_start = np.argsort(starts, kind="mergesort")
+        sorted_starts = starts[order_by_start]
+        is_retained = np.ones(len(seqlets), dtype=bool)
+        for i in range(len(seqlets)):
+            if (is_retained[i]==False):
+                continue
+            window_start = np.searchsorted(sorted_starts,
+                                           starts[i]-max_length, side="left")
+            window_end = np.searchsorted(sorted_starts, ends[i],
+                                         side="right")
+            candidates = order_by_start[window_start:window_end]
+            #only the seqlets after i in the original order are compared,
+            # and they are compared in that order
+            candidates = np.sort(candidates[candidates > i])
+            overlap_amts = (np.minimum(ends[candidates], ends[i])
+                            - np.maximum(starts[candidates], starts[i]))
+            min_overlaps = min_overlap_fraction*np.minimum(
+                                lengths[candidates], lengths[i])
+            for j in candidates[overlap_amts >= min_overlaps]:
+                if (is_retained[j]):
+                    #same tie-breaking as SeqletComparator.get_smaller
+                    if (values[i] <= values[j]):
+                        is_retained[i] = False
+                        break
+                    else:
+                        is_retained[j] = False
+        return [seqlet for seqlet, retained in zip(seqlets, is_retained)
+                if retained]
+
     def __call__(self, all_seqlets):
         example_idx_to_seqlets = OrderedDict() 
         for seqlet in all_seqlets:
             if (seqlet.coor.example_idx not in example_idx_to_seqlets):
                 example_idx_to_seqlets[seqlet.coor.example_idx] = []
             example_idx_to_seqlets[seqlet.coor.example_idx].append(seqlet)
+        can_sweep = self._can_sweep()
         for example_idx, seqlets in example_idx_to_seqlets.items():
-            final_seqlets_set = OrderedDict([(x,1) for x in seqlets])
-            for i in range(len(seqlets)):
-                seqlet1 = seqlets[i]
-                for seqlet2 in seqlets[i+1:]:
-                    if (seqlet1 not in final_seqlets_set):
-                        break
-                    if ((seqlet2 in final_seqlets_set)
-                         and self.overlap_detector(seqlet1.coor,
-                                                   seqlet2.coor)):
-                        del final_seqlets_set[
-                             self.seqlet_comparator.get_smaller(
-                              seqlet1, seqlet2)]
-            example_idx_to_seqlets[example_idx] =\
-                list(final_seqlets_set.keys())
+            if (can_sweep):
+                example_idx_to_seqlets[example_idx] =\
+                    self._resolve_with_sweep(seqlets)
+            else:
+                example_idx_to_seqlets[example_idx] =\
+                    self._resolve_pairwise(seqlets)
         return list(itertools.chain(*example_idx_to_seqlets.values())) 
 
 
+def load_seqlets(dset_name, grp, track_set, lazy=False):
+    """Seqlets at the coordinates saved in dset_name; if lazy, a
+     SeqletTable that only creates a seqlet when it is indexed"""
+    if (lazy):
+        return SeqletTable(
+            coords=util.load_coord_array(dset_name=dset_name, grp=grp),
+            track_names=track_set.track_name_to_data_track.keys(),
+            track_set=track_set)
+    return track_set.create_seqlets(
+        coords=util.load_seqlet_coords(dset_name=dset_name, grp=grp))
+
+
 class MultiTaskSeqletCreationResults(object):
 
     def __init__(self, multitask_seqlet_creator, 
@@ -253,13 +522,12 @@ class MultiTaskSeqletCreationResults(object):
                 in self.task_name_to_coord_producer_results.items()]) 
 
     @classmethod
-    def from_hdf5(cls, grp, track_set):
+    def from_hdf5(cls, grp, track_set, lazy=False):
         from . import coordproducers
         multitask_seqlet_creator =\
             MultiTaskSeqletCreator.from_hdf5(grp["multitask_seqlet_creator"])
-        seqlet_coords = util.load_seqlet_coords(dset_name="final_seqlets",
-                                                grp=grp) 
-        seqlets = track_set.create_seqlets(coords=seqlet_coords)
+        seqlets = load_seqlets(dset_name="final_seqlets", grp=grp,
+                               track_set=track_set, lazy=lazy)
         task_names = util.load_string_list(dset_name="task_names",grp=grp)
         tntcpr = OrderedDict()
         tntcpr_grp = grp["task_name_to_coord_producer_results"]
@@ -285,13 +553,91 @@ class MultiTaskSeqletCreationResults(object):
             coord_producer_results.save_hdf5(tntcpg.create_group(task_name))
 
 
+def pack_tracks(tracks):
+    """Concatenate a list of per-example arrays into one contiguous array.
+
+    Returns (packed, offsets), where example i is
+     packed[offsets[i]:offsets[i+1]].
+    """
+    offsets = np.concatenate([[0], np.cumsum([len(x) for x in tracks])])
+    packed = (np.concatenate(tracks, axis=0) if len(tracks) > 0
+              else np.zeros(0))
+    return packed, offsets.astype("int64")
+
+
+class PackedTracks(object):
+    """
+    Variable-length per-example arrays stored in one contiguous buffer.
+     Example i is packed[offsets[i]:offsets[i+1]]; indexing and iterating
+     return views, so a PackedTracks can be used wherever a list of
+     per-example arrays is expected, while vectorized code can work on
+     packed directly.
+    """
+    def __init__(self, packed, offsets):
+        self.packed = packed
+        self.offsets = np.asarray(offsets, dtype="int64")
+        assert self.offsets[-1]==len(self.packed)
+
+    @classmethod
+    def from_tracks(cls, tracks):
+        if (isinstance(tracks, PackedTracks)):
+            return tracks
+        packed, offsets = pack_tracks(tracks)
+        return cls(packed=packed, offsets=offsets)
+
+    @property
+    def lengths(self):
+        return self.offsets[1:]-self.offsets[:-1]
+
+    @property
+    def example_idxs(self):
+        #the example that each entry of packed belongs to
+        return np.repeat(np.arange(len(self)), self.lengths)
+
+    def __len__(self):
+        return len(self.offsets)-1
+
+    def __getitem__(self, example_idx):
+        return self.packed[self.offsets[example_idx]:
+                           self.offsets[example_idx+1]]
+
+    def __iter__(self):
+        for example_idx in range(len(self)):
+            yield self[example_idx]
+
+
+def _run_coord_producer_on_packed_tracks(coord_producer, packed_score_track,
+                                         score_track_offsets, null_track,
+                                         tnt_results, plot_count):
+    #runs in a worker process; the packed arrays are memory-mapped by
+    # joblib rather than pickled, and PackedTracks only creates views
+    score_track = PackedTracks(packed=packed_score_track,
+                               offsets=score_track_offsets)
+    if (isinstance(null_track, tuple)):
+        null_track = PackedTracks(packed=null_track[0],
+                                  offsets=null_track[1])
+    #keep the names of the saved plots the same as in a serial run
+    if (hasattr(type(coord_producer), "count")):
+        type(coord_producer).count = plot_count
+    if (tnt_results is None):
+        return coord_producer(score_track=score_track,
+                              null_track=null_track)
+    else:
+        return coord_producer(score_track=score_track,
+                              null_track=null_track,
+                              tnt_results=tnt_results)
+
+
 class MultiTaskSeqletCreator(object):
 
     def __init__(self, coord_producer,
-                       overlap_resolver, verbose=True):
+                       overlap_resolver, verbose=True, n_cores=1):
         self.coord_producer = coord_producer
         self.overlap_resolver = overlap_resolver
         self.verbose = verbose
+        #if n_cores > 1, the coord producer is run on the different tasks
+        # in separate processes
+        self.n_cores = n_cores
 
     @classmethod
     def from_hdf5(cls, grp):
@@ -310,41 +656,119 @@ class MultiTaskSeqletCreator(object):
         self.overlap_resolver.save_hdf5(grp.create_group("overlap_resolver"))
         grp.attrs["verbose"] = self.verbose
 
+    def _get_null_track(self, null_tracks, task_name):
+        if (hasattr(null_tracks, '__call__')):
+            #if a function, then just pass the function on
+            return null_tracks
+        else:
+            return null_tracks[task_name]
+
+    def _get_coord_producer_results_in_parallel(
+            self, task_name_to_score_track, null_tracks,
+            task_name_to_tnt_results):
+        from joblib import Parallel, delayed
+        if (self.verbose):
+            print("Running the coord producer on "
+                  +str(len(task_name_to_score_track))+" tasks with "
+                  +str(self.n_cores)+" cores")
+            sys.stdout.flush()
+        task_names = list(task_name_to_score_track.keys())
+        first_plot_count = getattr(type(self.coord_producer), "count", 0)
+        def job_generator():
+            #tracks are packed lazily so that only the tasks that have been
+            # dispatched hold an extra copy
+            for task_idx, task_name in enumerate(task_names):
+                if (self.verbose):
+                    print("On task",task_name)
+                    sys.stdout.flush()
+                packed_score_track, score_track_offsets = pack_tracks(
+                    task_name_to_score_track[task_name])
+                null_track = self._get_null_track(null_tracks=null_tracks,
+                                                  task_name=task_name)
+                if (hasattr(null_track, '__call__')==False):
+                    null_track = pack_tracks(null_track)
+                yield delayed(_run_coord_producer_on_packed_tracks)(
+                    coord_producer=self.coord_producer,
+                    packed_score_track=packed_score_track,
+                    score_track_offsets=score_track_offsets,
+                    null_track=null_track,
+                    tnt_results=(None if task_name_to_tnt_results is None
+                                 else task_name_to_tnt_results[task_name]),
+                    plot_count=first_plot_count+task_idx)
+        #large arrays are passed to the workers as read-only memmaps
+        all_coord_producer_results = Parallel(
+            n_jobs=self.n_cores, max_nbytes="1M", mmap_mode="r")(
+                job_generator())
+        if (hasattr(type(self.coord_producer), "count")):
+            type(self.coord_producer).count += len(task_names)
+        return OrderedDict(zip(task_names, all_coord_producer_results))
+
+    def _get_overlap_resolution_track_names(self):
+        #the tracks, if any, that the overlap resolver reads when
+        # comparing seqlets
+        value_provider = getattr(self.overlap_resolver.seqlet_comparator,
+                                 "value_provider", None)
+        if (hasattr(value_provider, "track_name")):
+            return [value_provider.track_name]
+        else:
+            return []
+
     def __call__(self, task_name_to_score_track,
                        null_tracks,
-                       track_set, task_name_to_tnt_results=None):
-        task_name_to_coord_producer_results = OrderedDict()
+                       track_set, task_name_to_tnt_results=None,
+                       track_names=None):
+        """
+            track_names: the tracks to extract snippets from for the
+                final seqlets. If None, all the tracks in track_set are used.
+        """
+        if (self.n_cores > 1):
+            task_name_to_coord_producer_results =\
+                self._get_coord_producer_results_in_parallel(
+                    task_name_to_score_track=task_name_to_score_track,
+                    null_tracks=null_tracks,
+                    task_name_to_tnt_results=task_name_to_tnt_results)
+        else:
+            task_name_to_coord_producer_results = OrderedDict()
+            for task_name in task_name_to_score_track:
+                if (self.verbose):
+                    print("On task",task_name)
+                    sys.stdout.flush()
+                score_track = task_name_to_score_track[task_name]
+                null_track = self._get_null_track(null_tracks=null_tracks,
+                                                  task_name=task_name)
+                if (task_name_to_tnt_results is None):
+                    coord_producer_results =\
+                        self.coord_producer(
+                            score_track=score_track,
+                            null_track = null_track)
+                else:
+                    coord_producer_results =\
+                        self.coord_producer(
+                         score_track=score_track,
+                         null_track = null_track,
+                         tnt_results=
+                          task_name_to_tnt_results[task_name])
+                task_name_to_coord_producer_results[task_name] =\
+                    coord_producer_results
+        #overlaps are resolved on the coordinates alone; snippets are only
+        # extracted for the seqlets that survive
+        overlap_resolution_track_names =\
+            self._get_overlap_resolution_track_names()
         task_name_to_seqlets = OrderedDict()
         for task_name in task_name_to_score_track:
-            print("On task",task_name)
-            score_track = task_name_to_score_track[task_name]
-            if (hasattr(null_tracks, '__call__')):
-                #if a function, then just pass the function on
-                null_track = null_tracks
-            else:
-                null_track = null_tracks[task_name]
-            if (task_name_to_tnt_results is None):
-                coord_producer_results =\
-                    self.coord_producer(
-                        score_track=score_track,
-                        null_track = null_track)
-            else:
-                coord_producer_results =\
-                    self.coord_producer(
-                     score_track=score_track,
-                     null_track = null_track,
-                     tnt_results=
-                      task_name_to_tnt_results[task_name])
-            task_name_to_coord_producer_results[task_name] =\
-                coord_producer_results
             seqlets = track_set.create_seqlets(
-                        coords=coord_producer_results.coords) 
+                        coords=task_name_to_coord_producer_results[
+                                task_name].coords,
+                        track_names=overlap_resolution_track_names,
+                        attribute_names=[]) 
             task_name_to_seqlets[task_name] = seqlets
         final_seqlets = self.overlap_resolver(
             itertools.chain(*task_name_to_seqlets.values()))
         if (self.verbose):
             print("After resolving overlaps, got "
                   +str(len(final_seqlets))+" seqlets")
+        track_set.materialize_seqlets(seqlets=final_seqlets,
+                                      track_names=track_names)
         return MultiTaskSeqletCreationResults(
                 multitask_seqlet_creator=self,
                 final_seqlets=final_seqlets,
@@ -354,12 +778,23 @@ class MultiTaskSeqletCreator(object):
             
 class SeqletCoordinates(object):
 
+    #slotted, as coordinates are created for every candidate seqlet
+    __slots__ = ["example_idx", "start", "end", "is_revcomp"]
+
     def __init__(self, example_idx, start, end, is_revcomp):
         self.example_idx = example_idx
         self.start = start
         self.end = end
         self.is_revcomp = is_revcomp
 
+    def get_identity_key(self):
+        """
+        Integer identifying the example, start and end (but not the
+         strand) of the coordinates; start and end must be below 2**32
+        """
+        return ((int(self.example_idx) << 64) | (int(self.start) << 32)
+                | int(self.end))
+
     def revcomp(self):
         return SeqletCoordinates(
                 example_idx=self.example_idx,
@@ -422,6 +857,7 @@ class Seqlet(Pattern):
 
     def __init__(self, coor):
         self.coor = coor
+        self._identity_key = None
         super(Seqlet, self).__init__()
 
     def add_snippet_from_data_track(self, data_track): 
@@ -475,14 +911,218 @@ class Seqlet(Pattern):
     def __len__(self):
         return len(self.coor)
 
+    @property
+    def identity_key(self):
+        #used to test seqlets for membership and deduplicate them; cached,
+        # as the coordinates of a seqlet don't change (seqlets pickled
+        # before the key was added don't have _identity_key)
+        if (getattr(self, "_identity_key", None) is None):
+            self._identity_key = self.coor.get_identity_key()
+        return self._identity_key
+
     @property
     def exidx_start_end_string(self):
+        #for display only; use identity_key to compare seqlets
         return (str(self.coor.example_idx)+"_"
                 +str(self.coor.start)+"_"+str(self.coor.end))
  
         
+class SeqletTable(object):
+    """
+    Columnar storage for seqlets of the same length. The coordinates are
+     one structured array (with the fields of coord_dtype). Track data
+     is either held as a single (num seqlets, length, ...) array per
+     track and strand, or, if the table was made from coordinates
+     without materializing, gathered from track_set when it is needed, so
+     that the table itself only stores the coordinates.
+
+    Indexing with an int returns a Seqlet (whose snippets are views into
+     the table or into the tracks), so a SeqletTable can be passed to
+     code that expects a list of seqlets (the metaclusterers, the
+     aggregators); indexing with a slice, mask or index array returns a
+     SeqletTable. If scores is given (one per seqlet), the seqlets have
+     the scored coordinates made by the coord producers
+     (SeqletCoordsFWAP).
+    """
+    coord_dtype = np.dtype([("example_idx", "int64"), ("start", "int64"),
+                            ("end", "int64"), ("is_revcomp", "bool")])
+
+    def __init__(self, coords, track_names, track_set=None,
+                       track_name_to_fwd=None, track_name_to_rev=None,
+                       track_name_to_has_pos_axis=None,
+                       scores=None):
+        self.coords = coords
+        self.track_names = list(track_names)
+        self.track_set = track_set
+        self.scores = scores
+        #the materialized track data, if any
+        self.track_name_to_fwd = track_name_to_fwd
+        self.track_name_to_rev = track_name_to_rev
+        self.track_name_to_has_pos_axis = track_name_to_has_pos_axis
+        assert (track_set is not None) or (track_name_to_fwd is not None)
+
+    @property
+    def is_materialized(self):
+        return self.track_name_to_fwd is not None
+
+    @classmethod
+    def get_coord_array(cls, coords):
+        coord_array = np.zeros(len(coords), dtype=cls.coord_dtype)
+        coord_array["example_idx"] = [x.example_idx for x in coords]
+        coord_array["start"] = [x.start for x in coords]
+        coord_array["end"] = [x.end for x in coords]
+        coord_array["is_revcomp"] = [x.is_revcomp for x in coords]
+        return coord_array
+
+    @classmethod
+    def from_coords(cls, coords, track_set, track_names=None,
+                         materialize=False):
+        if (track_names is None):
+            track_names = track_set.track_name_to_data_track.keys()
+        seqlet_table = cls(coords=cls.get_coord_array(coords),
+                           track_names=track_names, track_set=track_set)
+        if (materialize):
+            seqlet_table = seqlet_table.materialize()
+        return seqlet_table
+
+    @classmethod
+    def from_seqlets(cls, seqlets, track_names=None):
+        if (track_names is None):
+            track_names = (list(seqlets[0].track_name_to_snippet.keys())
+                           if len(seqlets) > 0 else [])
+        track_name_to_fwd = OrderedDict()
+        track_name_to_rev = OrderedDict()
+        track_name_to_has_pos_axis = OrderedDict()
+        for track_name in track_names:
+            snippets = [seqlet[track_name] for seqlet in seqlets]
+            track_name_to_fwd[track_name] = np.array(
+                [x.fwd for x in snippets])
+            track_name_to_rev[track_name] = (
+                np.array([x.rev for x in snippets])
+                if snippets[0].rev is not None else None)
+            track_name_to_has_pos_axis[track_name] = snippets[0].has_pos_axis
+        return cls(coords=cls.get_coord_array([x.coor for x in seqlets]),
+                   track_names=track_names,
+                   track_name_to_fwd=track_name_to_fwd,
+                   track_name_to_rev=track_name_to_rev,
+                   track_name_to_has_pos_axis=track_name_to_has_pos_axis)
+
+    def get_track_arrays(self, track_name):
+        """(fwd, rev, has_pos_axis) of track_name for all the seqlets"""
+        if (self.is_materialized):
+            return (self.track_name_to_fwd[track_name],
+                    self.track_name_to_rev[track_name],
+                    self.track_name_to_has_pos_axis[track_name])
+        data_track = self.track_set.track_name_to_data_track[track_name]
+        fwd, rev = data_track.get_snippet_arrays(
+            example_idxs=self.coords["example_idx"],
+            starts=self.coords["start"], ends=self.coords["end"],
+            is_revcomp=self.coords["is_revcomp"])
+        return fwd, rev, data_track.has_pos_axis
+
+    def materialize(self):
+        """Table holding the gathered arrays of all its tracks"""
+        if (self.is_materialized):
+            return self
+        track_name_to_fwd = OrderedDict()
+        track_name_to_rev = OrderedDict()
+        track_name_to_has_pos_axis = OrderedDict()
+        for track_name in self.track_names:
+            (track_name_to_fwd[track_name], track_name_to_rev[track_name],
+             track_name_to_has_pos_axis[track_name]) =\
+                self.get_track_arrays(track_name)
+        return SeqletTable(
+                coords=self.coords, track_names=self.track_names,
+                track_set=self.track_set,
+                track_name_to_fwd=track_name_to_fwd,
+                track_name_to_rev=track_name_to_rev,
+                track_name_to_has_pos_axis=track_name_to_has_pos_axis,
+                scores=self.scores)
+
+    def __len__(self):
+        return len(self.coords)
+
+    def get_coor(self, idx):
+        example_idx, start, end, is_revcomp = self.coords[idx].tolist()
+        if (self.scores is not None):
+            from .coordproducers import SeqletCoordsFWAP
+            coor = SeqletCoordsFWAP(example_idx=example_idx, start=start,
+                                    end=end, score=float(self.scores[idx]))
+            coor.is_revcomp = is_revcomp
+            return coor
+        return SeqletCoordinates(example_idx=example_idx, start=start,
+                                 end=end, is_revcomp=is_revcomp)
+
+    def __getitem__(self, idx):
+        if (isinstance(idx, (int, np.integer))):
+            if (self.is_materialized==False):
+                return self.track_set.create_seqlet(
+                        coor=self.get_coor(idx),
+                        track_names=self.track_names, attribute_names=[])
+            seqlet = Seqlet(coor=self.get_coor(idx))
+            for track_name in self.track_names:
+                rev = self.track_name_to_rev[track_name]
+                seqlet.add_snippet(
+                    data_track_name=track_name,
+                    snippet=Snippet(
+                        fwd=get_readonly_view(
+                             self.track_name_to_fwd[track_name][idx]),
+                        rev=(get_readonly_view(rev[idx])
+                             if rev is not None else None),
+                        has_pos_axis=
+                         self.track_name_to_has_pos_axis[track_name]))
+            return seqlet
+        elif (self.is_materialized==False):
+            return SeqletTable(coords=self.coords[idx],
+                               track_names=self.track_names,
+                               track_set=self.track_set,
+                               scores=(self.scores[idx]
+                                       if self.scores is not None
+                                       else None))
+        else:
+            return SeqletTable(
+                coords=self.coords[idx], track_names=self.track_names,
+                track_set=self.track_set,
+                track_name_to_fwd=OrderedDict([
+                    (x, self.track_name_to_fwd[x][idx])
+                    for x in self.track_names]),
+                track_name_to_rev=OrderedDict([
+                    (x, (self.track_name_to_rev[x][idx]
+                         if self.track_name_to_rev[x] is not None else None))
+                    for x in self.track_names]),
+                track_name_to_has_pos_axis=self.track_name_to_has_pos_axis,
+                scores=(self.scores[idx] if self.scores is not None
+                        else None))
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def to_seqlets(self):
+        return list(self)
+
+    def get_2d_data(self, track_names, track_transformer):
+        """Same output as get_2d_data_from_patterns on the seqlets"""
+        all_fwd_data = []
+        all_rev_data = []
+        for track_name in track_names:
+            fwd, rev, _ = self.get_track_arrays(track_name)
+            for data, all_data in [(fwd, all_fwd_data),
+                                   (rev, all_rev_data)]:
+                if (data is None):
+                    continue
+                all_data.append(apply_track_transformer(
+                    track_transformer=track_transformer,
+                    data=np.reshape(data, (len(self), data.shape[1], -1))))
+        return (np.concatenate(all_fwd_data, axis=2),
+                (np.concatenate(all_rev_data, axis=2)
+                 if len(all_rev_data)==len(track_names) else None))
+
+
 class SeqletAndAlignment(object):
 
+    __slots__ = ["seqlet", "alnmt"]
+
     def __init__(self, seqlet, alnmt):
         self.seqlet = seqlet
         #alnmt is the position of the beginning of seqlet
@@ -574,16 +1214,16 @@ class SeqletsAndAlignments(object):
         return self.arr[idx]
 
     def __contains__(self, seqlet):
-        return (seqlet.exidx_start_end_string in self.unique_seqlets)
+        return (seqlet.identity_key in self.unique_seqlets)
 
     def append(self, seqlet_and_alnmt):
         seqlet = seqlet_and_alnmt.seqlet
-        if (seqlet.exidx_start_end_string in self.unique_seqlets):
+        if (seqlet.identity_key in self.unique_seqlets):
             raise RuntimeError("Seqlet "
              +seqlet.exidx_start_end_string
              +" is already in SeqletsAndAlignments array")
         self.arr.append(seqlet_and_alnmt)
-        self.unique_seqlets[seqlet.exidx_start_end_string] = seqlet
+        self.unique_seqlets[seqlet.identity_key] = seqlet
 
     def get_seqlets(self):
         return [x.seqlet for x in self.arr]
@@ -606,6 +1246,9 @@ class AggregatedSeqlet(Pattern):
     def __init__(self, seqlets_and_alnmts_arr):
         super(AggregatedSeqlet, self).__init__()
         self._seqlets_and_alnmts = SeqletsAndAlignments()
+        self._owns_seqlets_and_alnmts = True
+        self.length = 0
+        self._initialize_track_name_to_aggregation(sample_seqlet=None)
         if (len(seqlets_and_alnmts_arr)>0):
             #make sure the start is 0
             start_idx = min([x.alnmt for x in seqlets_and_alnmts_arr])
@@ -632,8 +1275,48 @@ class AggregatedSeqlet(Pattern):
              grp.create_group("seqlets_and_alnmts"))
 
     def copy(self):
-        return AggregatedSeqlet(seqlets_and_alnmts_arr=
-                                self._seqlets_and_alnmts.copy())
+        #the copy shares the aggregates and the seqlets with this pattern;
+        # whichever of the two is extended first duplicates them
+        self._share_buffers()
+        the_copy = AggregatedSeqlet(seqlets_and_alnmts_arr=[])
+        the_copy.length = self.length
+        the_copy._capacity = self._capacity
+        the_copy._origin = self._origin
+        the_copy._per_position_counts_buffer =\
+            self._per_position_counts_buffer
+        the_copy._track_name_to_agg_buffers = OrderedDict(
+            self._track_name_to_agg_buffers)
+        the_copy._track_name_to_has_pos_axis = OrderedDict(
+            self._track_name_to_has_pos_axis)
+        the_copy._track_name_to_normalized_snippet = OrderedDict(
+            self._track_name_to_normalized_snippet)
+        the_copy._seqlets_and_alnmts = self._seqlets_and_alnmts
+        the_copy._owns_seqlets_and_alnmts = False
+        self._owns_seqlets_and_alnmts = False
+        return the_copy
+
+    def _get_own_seqlets_and_alnmts(self):
+        #duplicates the seqlets and alignments if they are shared with a
+        # copy; the alignments are new objects as _pad_before shifts them
+        if (self._owns_seqlets_and_alnmts==False):
+            seqlets_and_alnmts = SeqletsAndAlignments()
+            for seqlet_and_alnmt in self._seqlets_and_alnmts:
+                seqlets_and_alnmts.append(SeqletAndAlignment(
+                    seqlet=seqlet_and_alnmt.seqlet,
+                    alnmt=seqlet_and_alnmt.alnmt))
+            self._seqlets_and_alnmts = seqlets_and_alnmts
+            self._owns_seqlets_and_alnmts = True
+        return self._seqlets_and_alnmts
+
+    def _share_buffers(self):
+        #turns the aggregates into read-only views so that they can be
+        # shared with another pattern; see get_writeable
+        self._per_position_counts_buffer = get_readonly_view(
+                                    self._per_position_counts_buffer)
+        for x in self._track_name_to_agg_buffers:
+            self._track_name_to_agg_buffers[x] = tuple(
+                get_readonly_view(buf)
+                for buf in self._track_name_to_agg_buffers[x])
 
     def get_fwd_seqlet_data(self, track_names, track_transformer):
         to_return = []
@@ -758,6 +1441,7 @@ class AggregatedSeqlet(Pattern):
     def seqlets_and_alnmts(self, val):
         assert type(val).__name__ == "SeqletsAndAlignments"
         self._seqlets_and_alnmts = val
+        self._owns_seqlets_and_alnmts = True
 
     @property
     def num_seqlets(self):
@@ -771,7 +1455,6 @@ class AggregatedSeqlet(Pattern):
     def _compute_aggregation(self,seqlets_and_alnmts_arr):
         self._initialize_track_name_to_aggregation(
               sample_seqlet=seqlets_and_alnmts_arr[0].seqlet)
-        self.per_position_counts = np.zeros((self.length,))
         for seqlet_and_alnmt in seqlets_and_alnmts_arr:
             if (seqlet_and_alnmt.seqlet not in self.seqlets_and_alnmts): 
                 self._add_pattern_with_valid_alnmt(
@@ -779,22 +1462,85 @@ class AggregatedSeqlet(Pattern):
                         alnmt=seqlet_and_alnmt.alnmt)
 
     def _initialize_track_name_to_aggregation(self, sample_seqlet): 
-        self._track_name_to_agg = OrderedDict() 
-        self._track_name_to_agg_revcomp = OrderedDict() 
+        #The aggregates live in buffers of length self._capacity; the
+        # pattern occupies [self._origin, self._origin+self.length) and the
+        # buffers double in size when it is extended past either end.
+        # The revcomp aggregates are stored in the forward orientation so
+        # that both share the same origin.
+        self._capacity = self.length
+        self._origin = 0
+        self._per_position_counts_buffer = np.zeros((self.length,))
+        self._track_name_to_agg_buffers = OrderedDict()
+        self._track_name_to_has_pos_axis = OrderedDict()
+        self._track_name_to_normalized_snippet = OrderedDict()
+        if (sample_seqlet is None):
+            return
         for track_name in sample_seqlet.track_name_to_snippet:
-            track_shape = tuple([self.length]
-                           +list(sample_seqlet[track_name].fwd.shape[1:]))
-            self._track_name_to_agg[track_name] =\
-                np.zeros(track_shape).astype("float") 
-            if (sample_seqlet[track_name].rev is not None):
-                self._track_name_to_agg_revcomp[track_name] =\
-                    np.zeros(track_shape).astype("float") 
+            has_pos_axis = sample_seqlet[track_name].has_pos_axis
+            track_shape = (tuple([self.length]
+                            +list(sample_seqlet[track_name].fwd.shape[1:]))
+                           if has_pos_axis else
+                           sample_seqlet[track_name].fwd.shape)
+            fwd_buffer = np.zeros(track_shape).astype("float") 
+            rev_buffer = (np.zeros(track_shape).astype("float")
+                          if (sample_seqlet[track_name].rev is not None)
+                          else None)
+            self._track_name_to_agg_buffers[track_name] =\
+                (fwd_buffer, rev_buffer)
+            self._track_name_to_has_pos_axis[track_name] = has_pos_axis
+
+    @property
+    def per_position_counts(self):
+        return self._per_position_counts_buffer[
+                self._origin:self._origin+self.length]
+
+    def _get_agg(self, track_name):
+        fwd_buffer = self._track_name_to_agg_buffers[track_name][0]
+        if (self._track_name_to_has_pos_axis[track_name]==False):
+            return fwd_buffer
+        return fwd_buffer[self._origin:self._origin+self.length]
+
+    def _get_agg_revcomp(self, track_name):
+        rev_buffer = self._track_name_to_agg_buffers[track_name][1]
+        if (rev_buffer is None
+            or self._track_name_to_has_pos_axis[track_name]==False):
+            return rev_buffer
+        return rev_buffer[self._origin:self._origin+self.length][::-1]
+
+    def _get_normalized_snippet(self, track_name):
+        #the normalized snippets are only computed when read, and are
+        # discarded whenever the aggregates change
+        if (track_name not in self._track_name_to_normalized_snippet):
+            fwd_agg = self._get_agg(track_name)
+            rev_agg = self._get_agg_revcomp(track_name)
+            if (self._track_name_to_has_pos_axis[track_name]):
+                counts = self.per_position_counts.reshape(
+                            (self.length,)+(1,)*(len(fwd_agg.shape)-1))
+                rev_counts = counts[::-1]
             else:
-                self._track_name_to_agg_revcomp[track_name] = None
-            self.track_name_to_snippet[track_name] = Snippet(
-                fwd=self._track_name_to_agg[track_name],
-                rev=self._track_name_to_agg_revcomp[track_name],
-                has_pos_axis=sample_seqlet[track_name].has_pos_axis) 
+                counts = rev_counts = float(self.num_seqlets)
+            self._track_name_to_normalized_snippet[track_name] = Snippet(
+                fwd=fwd_agg/(counts + 1E-7*(counts==0)),
+                rev=((rev_agg/(rev_counts + 1E-7*(rev_counts==0)))
+                     if (rev_agg is not None) else None),
+                has_pos_axis=self._track_name_to_has_pos_axis[track_name])
+        return self._track_name_to_normalized_snippet[track_name]
+
+    @property
+    def track_name_to_snippet(self):
+        return OrderedDict([(x, self._get_normalized_snippet(x))
+                            for x in self._track_name_to_agg_buffers])
+
+    @track_name_to_snippet.setter
+    def track_name_to_snippet(self, val):
+        #the snippets are derived from the aggregates; Pattern.__init__
+        # is the only place that sets them
+        assert len(val)==0
+
+    def __getitem__(self, key):
+        if (key in self._track_name_to_agg_buffers):
+            return self._get_normalized_snippet(key)
+        return super(AggregatedSeqlet, self).__getitem__(key)
 
     def get_nonzero_average(self, track_name, pseudocount):
         fwd_nonzero_count = np.zeros_like(self[track_name].fwd)
@@ -813,55 +1559,56 @@ class AggregatedSeqlet(Pattern):
                 rev_nonzero_count[motif_length-(alnmt+seqlet_length):
                                   motif_length-alnmt] += (
                  (np.abs(seqlet_and_alnmt.seqlet[track_name].rev) > 0.0))
-        return Snippet(fwd=self._track_name_to_agg[track_name]
+        return Snippet(fwd=self._get_agg(track_name)
                            /(fwd_nonzero_count+pseudocount),
-                       rev=((self._track_name_to_agg_revcomp[track_name]
+                       rev=((self._get_agg_revcomp(track_name)
                             /(rev_nonzero_count+pseudocount))
                             if (rev_nonzero_count is not None) else None) ,
                        has_pos_axis=has_pos_axis)
 
+    def _reserve(self, num_before, num_after):
+        #makes room for num_before positions before the origin and
+        # num_after positions after the end, at least doubling the
+        # capacity whenever the buffers have to be reallocated
+        if (num_before <= self._origin and
+            self._origin+self.length+num_after <= self._capacity):
+            return
+        needed = num_before+self.length+num_after
+        new_capacity = max(2*self._capacity, needed)
+        #split the spare room evenly between the two ends
+        new_origin = num_before + (new_capacity-needed)//2
+        def grow(buf):
+            new_buf = np.zeros((new_capacity,)+buf.shape[1:])
+            new_buf[new_origin:new_origin+self.length] =\
+                buf[self._origin:self._origin+self.length]
+            return new_buf
+        self._per_position_counts_buffer = grow(
+            self._per_position_counts_buffer)
+        for track_name in self._track_name_to_agg_buffers:
+            if (self._track_name_to_has_pos_axis[track_name]):
+                fwd_buffer, rev_buffer =\
+                    self._track_name_to_agg_buffers[track_name]
+                self._track_name_to_agg_buffers[track_name] = (
+                    grow(fwd_buffer),
+                    grow(rev_buffer) if (rev_buffer is not None) else None)
+        self._capacity = new_capacity
+        self._origin = new_origin
 
     def _pad_before(self, num_zeros):
         assert num_zeros > 0
+        #the positions before the origin are always zero
+        self._reserve(num_before=num_zeros, num_after=0)
+        self._origin -= num_zeros
         self.length += num_zeros
-        for seqlet_and_alnmt in self.seqlets_and_alnmts:
+        for seqlet_and_alnmt in self._get_own_seqlets_and_alnmts():
             seqlet_and_alnmt.alnmt += num_zeros
-        self.per_position_counts =\
-            np.concatenate([np.zeros((num_zeros,)),
-                            self.per_position_counts],axis=0) 
-        for track_name in self.track_name_to_snippet:
-            track = self._track_name_to_agg[track_name]
-            if (self.track_name_to_snippet[track_name].has_pos_axis):
-                rev_track = self._track_name_to_agg_revcomp[track_name]
-                padding_shape = tuple([num_zeros]+list(track.shape[1:])) 
-                extended_track = np.concatenate(
-                    [np.zeros(padding_shape), track], axis=0)
-                extended_rev_track = (np.concatenate(
-                    [rev_track, np.zeros(padding_shape)], axis=0)
-                    if (rev_track is not None) else None)
-                self._track_name_to_agg[track_name] = extended_track
-                self._track_name_to_agg_revcomp[track_name] =\
-                    extended_rev_track
+        self._track_name_to_normalized_snippet = OrderedDict()
 
     def _pad_after(self, num_zeros):
         assert num_zeros > 0
+        self._reserve(num_before=0, num_after=num_zeros)
         self.length += num_zeros 
-        self.per_position_counts =\
-            np.concatenate([self.per_position_counts,
-                            np.zeros((num_zeros,))],axis=0) 
-        for track_name in self.track_name_to_snippet:
-            track = self._track_name_to_agg[track_name]
-            if (self.track_name_to_snippet[track_name].has_pos_axis):
-                rev_track = self._track_name_to_agg_revcomp[track_name]
-                padding_shape = tuple([num_zeros]+list(track.shape[1:])) 
-                extended_track = np.concatenate(
-                    [track, np.zeros(padding_shape)], axis=0)
-                extended_rev_track = (np.concatenate(
-                    [np.zeros(padding_shape),rev_track], axis=0)
-                    if (rev_track is not None) else None)
-                self._track_name_to_agg[track_name] = extended_track
-                self._track_name_to_agg_revcomp[track_name] =\
-                    extended_rev_track
+        self._track_name_to_normalized_snippet = OrderedDict()
 
     def merge_aggregated_seqlet(self, agg_seqlet, aligner):
         self.merge_seqlets_and_alnmts(
@@ -893,63 +1640,63 @@ class AggregatedSeqlet(Pattern):
         assert alnmt >= 0
         assert alnmt + len(pattern) <= self.length
 
-        slice_obj = slice(alnmt, alnmt+len(pattern))
-        rev_slice_obj = slice(self.length-(alnmt+len(pattern)),
-                              self.length-alnmt)
+        slice_obj = slice(self._origin+alnmt,
+                          self._origin+alnmt+len(pattern))
 
-        self.seqlets_and_alnmts.append(
+        self._get_own_seqlets_and_alnmts().append(
              SeqletAndAlignment(seqlet=pattern, alnmt=alnmt))
-        self.per_position_counts[slice_obj] += 1.0 
-
-        for track_name in self._track_name_to_agg:
-            if (self.track_name_to_snippet[track_name].has_pos_axis==False):
-                self._track_name_to_agg[track_name] +=\
-                    pattern[track_name].fwd
-                if (self._track_name_to_agg_revcomp[track_name] is not None):
-                    self._track_name_to_agg_revcomp[track_name] +=\
-                        pattern[track_name].rev
+        #buffers shared with a reverse complement or a copy are copied
+        # on write
+        self._per_position_counts_buffer = get_writeable(
+            self._per_position_counts_buffer)
+        self._per_position_counts_buffer[slice_obj] += 1.0 
+
+        for track_name in self._track_name_to_agg_buffers:
+            fwd_buffer, rev_buffer =\
+                self._track_name_to_agg_buffers[track_name]
+            fwd_buffer = get_writeable(fwd_buffer)
+            rev_buffer = get_writeable(rev_buffer)
+            if (self._track_name_to_has_pos_axis[track_name]==False):
+                fwd_buffer += pattern[track_name].fwd
+                if (rev_buffer is not None):
+                    rev_buffer += pattern[track_name].rev
             else:
-                self._track_name_to_agg[track_name][slice_obj] +=\
-                    pattern[track_name].fwd 
-                if (self._track_name_to_agg_revcomp[track_name] is not None):
-                    self._track_name_to_agg_revcomp[track_name]\
-                         [rev_slice_obj] += pattern[track_name].rev
-            self.track_name_to_snippet[track_name] =\
-             Snippet(
-              fwd=(self._track_name_to_agg[track_name]
-                   /(self.per_position_counts[:,None]
-                     + 1E-7*(self.per_position_counts[:,None]==0))),
-              rev=((self._track_name_to_agg_revcomp[track_name]
-                   /(self.per_position_counts[::-1,None]
-                     + 1E-7*(self.per_position_counts[::-1,None]==0)))
-                   if (self._track_name_to_agg_revcomp[track_name]
-                       is not None) else None),
-              has_pos_axis=
-               self.track_name_to_snippet[track_name].has_pos_axis) 
+                fwd_buffer[slice_obj] += pattern[track_name].fwd 
+                if (rev_buffer is not None):
+                    rev_buffer[slice_obj] += pattern[track_name].rev[::-1]
+            self._track_name_to_agg_buffers[track_name] =\
+                (fwd_buffer, rev_buffer)
+        self._track_name_to_normalized_snippet = OrderedDict()
 
     def __len__(self):
         return self.length
 
     def revcomp(self):
+        #the buffers are shared with this pattern, in both directions, so
+        # that whichever of the two patterns is extended first makes its
+        # own copy
+        self._share_buffers()
         rev_agg_seqlet = AggregatedSeqlet(seqlets_and_alnmts_arr=[])
-        rev_agg_seqlet.per_position_counts = self.per_position_counts[::-1]
-        rev_agg_seqlet._track_name_to_agg = OrderedDict(
-         [(x, np.copy(self._track_name_to_agg_revcomp[x]))
-           for x in self._track_name_to_agg])
-        rev_agg_seqlet._track_name_to_agg_revcomp = OrderedDict(
-         [(x, np.copy(self._track_name_to_agg[x]))
-           for x in self._track_name_to_agg_revcomp])
-        rev_agg_seqlet.track_name_to_snippet = OrderedDict([
-         (x, Snippet(
-             fwd=np.copy(self.track_name_to_snippet[x].rev),
-             rev=np.copy(self.track_name_to_snippet[x].fwd),
-             has_pos_axis=self.track_name_to_snippet[x].has_pos_axis)) 
-         for x in self.track_name_to_snippet]) 
+        rev_agg_seqlet.length = self.length
+        rev_agg_seqlet._capacity = self._capacity
+        rev_agg_seqlet._origin = self._capacity-(self._origin+self.length)
+        rev_agg_seqlet._per_position_counts_buffer =\
+            self._per_position_counts_buffer[::-1]
+        rev_agg_seqlet._track_name_to_has_pos_axis = OrderedDict(
+            self._track_name_to_has_pos_axis)
+        for x in self._track_name_to_agg_buffers:
+            fwd_buffer, rev_buffer = self._track_name_to_agg_buffers[x]
+            if (self._track_name_to_has_pos_axis[x]):
+                rev_agg_seqlet._track_name_to_agg_buffers[x] = (
+                    rev_buffer[::-1] if (rev_buffer is not None) else None,
+                    fwd_buffer[::-1])
+            else:
+                rev_agg_seqlet._track_name_to_agg_buffers[x] =\
+                    (rev_buffer, fwd_buffer)
         rev_seqlets_and_alignments_arr = [
             SeqletAndAlignment(seqlet=x.seqlet.revcomp(),
                                alnmt=self.length-(x.alnmt+len(x.seqlet)))
             for x in self.seqlets_and_alnmts] 
-        rev_agg_seqlet._set_length(rev_seqlets_and_alignments_arr)
         for seqlet_and_alnmt in rev_seqlets_and_alignments_arr:
             rev_agg_seqlet.seqlets_and_alnmts.append(seqlet_and_alnmt)
         return rev_agg_seqlet 
@@ -964,6 +1711,131 @@ class AggregatedSeqlet(Pattern):
         plt.show()
 
 
+class LazyAggregatedSeqlet(Pattern):
+    """
+    An AggregatedSeqlet saved with save_hdf5, read from grp as it is
+     accessed. The aggregated snippets are read one track at a time, and
+     the seqlets are a SeqletTable over their coordinates, whose snippets
+     are gathered from track_set when a seqlet is indexed. grp must stay
+     open while the pattern is used; materialize() gives the
+     AggregatedSeqlet, for anything beyond reading.
+    """
+
+    def __init__(self, grp, track_set):
+        super(LazyAggregatedSeqlet, self).__init__()
+        self.grp = grp
+        self.track_set = track_set
+        self._seqlets = None
+
+    @property
+    def track_names(self):
+        return [x for x in self.grp.keys() if x != "seqlets_and_alnmts"]
+
+    def _load_snippet(self, track_name):
+        return Snippet.from_hdf5(grp=self.grp[track_name],
+                                 track_set=self.track_set)
+
+    def _load_coord_array(self):
+        return util.load_coord_array(dset_name="seqlets",
+                                     grp=self.grp["seqlets_and_alnmts"])
+
+    def _load_alnmts(self):
+        return np.array(self.grp["seqlets_and_alnmts"]["alnmts"])
+
+    def __getitem__(self, key):
+        if (key not in self.track_name_to_snippet
+            and key in self.track_names):
+            self.track_name_to_snippet[key] = self._load_snippet(key)
+        return super(LazyAggregatedSeqlet, self).__getitem__(key)
+
+    def __len__(self):
+        return len(self.grp[self.track_names[0]]["fwd"])
+
+    @property
+    def num_seqlets(self):
+        return len(self.grp["seqlets_and_alnmts"]["alnmts"])
+
+    @property
+    def alnmts(self):
+        return self._load_alnmts()
+
+    @property
+    def seqlets(self):
+        if (self._seqlets is None):
+            self._seqlets = SeqletTable(
+                coords=self._load_coord_array(),
+                track_names=self.track_set.track_name_to_data_track.keys(),
+                track_set=self.track_set)
+        return self._seqlets
+
+    @property
+    def seqlets_and_alnmts(self):
+        seqlets_and_alnmts = SeqletsAndAlignments()
+        for seqlet, alnmt in zip(self.seqlets, self.alnmts):
+            seqlets_and_alnmts.append(
+                SeqletAndAlignment(seqlet=seqlet, alnmt=alnmt))
+        return seqlets_and_alnmts
+
+    def materialize(self):
+        #same as AggregatedSeqlet.from_hdf5
+        seqlets = self.track_set.create_seqlets(
+                    coords=[self.seqlets.get_coor(idx)
+                            for idx in range(len(self.seqlets))])
+        return AggregatedSeqlet(seqlets_and_alnmts_arr=[
+            SeqletAndAlignment(seqlet=seqlet, alnmt=alnmt)
+            for seqlet, alnmt in zip(seqlets, self.alnmts)])
+
+    def revcomp(self):
+        return self.materialize().revcomp()
+
+
+class PackedLazyAggregatedSeqlet(LazyAggregatedSeqlet):
+    """
+    LazyAggregatedSeqlet for pattern pattern_idx of the patterns saved
+     with util.save_packed_patterns; only the slices of the packed
+     datasets that belong to the pattern are read.
+    """
+
+    def __init__(self, grp, pattern_idx, track_set):
+        super(PackedLazyAggregatedSeqlet, self).__init__(
+            grp=grp, track_set=track_set)
+        self.pattern_idx = pattern_idx
+
+    def _get_slice(self, offsets_dset):
+        start, end = offsets_dset[self.pattern_idx:self.pattern_idx+2]
+        return slice(start, end)
+
+    @property
+    def track_names(self):
+        return util.load_string_list(dset_name="track_names", grp=self.grp)
+
+    def _load_snippet(self, track_name):
+        track_grp = self.grp["tracks"][track_name]
+        the_slice = self._get_slice(track_grp["offsets"])
+        return Snippet(fwd=track_grp["fwd"][the_slice],
+                       rev=(track_grp["rev"][the_slice]
+                            if "rev" in track_grp else None),
+                       has_pos_axis=track_grp.attrs["has_pos_axis"])
+
+    def _load_coord_array(self):
+        the_slice = self._get_slice(self.grp["seqlet_offsets"])
+        return np.array(self.grp["seqlets"][the_slice],
+                        dtype=SeqletTable.coord_dtype)
+
+    def _load_alnmts(self):
+        return self.grp["alnmts"][self._get_slice(self.grp["seqlet_offsets"])]
+
+    def __len__(self):
+        the_slice = self._get_slice(
+            self.grp["tracks"][self.track_names[0]]["offsets"])
+        return the_slice.stop - the_slice.start
+
+    @property
+    def num_seqlets(self):
+        the_slice = self._get_slice(self.grp["seqlet_offsets"])
+        return the_slice.stop - the_slice.start
+
+
 def get_1d_data_from_patterns(patterns, attribute_names):
     to_return = []
     for pattern in patterns:
@@ -972,7 +1844,51 @@ def get_1d_data_from_patterns(patterns, attribute_names):
     return np.array(to_return)
 
 
+def apply_track_transformer(track_transformer, data):
+    #data has the pattern as its first axis; transformers that can work
+    # on a whole batch at once provide batch_call
+    if (track_transformer is None):
+        return data
+    elif (hasattr(track_transformer, "batch_call")):
+        return track_transformer.batch_call(data)
+    else:
+        return np.array([track_transformer(x) for x in data])
+
+
 def get_2d_data_from_patterns(patterns, track_names, track_transformer):
+    if (isinstance(patterns, SeqletTable)):
+        return patterns.get_2d_data(track_names=track_names,
+                                    track_transformer=track_transformer)
+    patterns = list(patterns)
+    track_name_to_snippets = OrderedDict([
+        (track_name, [pattern[track_name] for pattern in patterns])
+        for track_name in track_names])
+    if (len(patterns)==0 or any([
+            len(set([x.fwd.shape for x in snippets])) > 1
+            for snippets in track_name_to_snippets.values()])):
+        #patterns of different lengths can't be stacked into one array
+        return get_2d_data_from_patterns_individually(
+                patterns=patterns, track_names=track_names,
+                track_transformer=track_transformer)
+    #gather every track for all the patterns at once
+    has_rev = all([all([x.rev is not None for x in snippets])
+                   for snippets in track_name_to_snippets.values()])
+    all_fwd_data = []
+    all_rev_data = []
+    for snippets in track_name_to_snippets.values():
+        for (strand, all_data) in ([("fwd", all_fwd_data)]
+                                   +([("rev", all_rev_data)]
+                                     if has_rev else [])):
+            data = np.array([getattr(x, strand) for x in snippets])
+            all_data.append(apply_track_transformer(
+                track_transformer=track_transformer,
+                data=np.reshape(data, (len(patterns), data.shape[1], -1))))
+    return (np.concatenate(all_fwd_data, axis=2),
+            (np.concatenate(all_rev_data, axis=2) if has_rev else None))
+
+
+def get_2d_data_from_patterns_individually(patterns, track_names,
+                                           track_transformer):
     all_fwd_data = []
     all_rev_data = []
     for pattern in patterns:
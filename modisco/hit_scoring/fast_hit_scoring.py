@@ -75,20 +75,14 @@ class PatternsToSeqletsSimComputer(object):
         #gets the data from the underlying seqlets for the
         # appropriate tracks and with the appropriate normalization
         (fwd_seqlets2ddata, rev_seqlets2ddata) =\
-            core.get_2d_data_from_patterns(
-                patterns=trimmed_seqlets,
-                track_names=self.pattern_comparison_settings.track_names,
-                track_transformer=
-                    self.pattern_comparison_settings.track_transformer)
+            self.pattern_comparison_settings.get_2d_data(
+                patterns=trimmed_seqlets)
         
         #gets the data from the underlying patterns for the
         # appropriate tracks and with the appropriate normalization
         fwd_patterns2ddata, rev_patterns2ddata =\
-            core.get_2d_data_from_patterns(
-                patterns=patterns,
-                track_names=self.pattern_comparison_settings.track_names,
-                track_transformer=
-                    self.pattern_comparison_settings.track_transformer)
+            self.pattern_comparison_settings.get_2d_data(
+                patterns=patterns)
             
         #apply the cross metric 
         # min_overlap is a fraction of "filters"
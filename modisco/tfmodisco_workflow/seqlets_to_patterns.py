@@ -7,6 +7,7 @@ from .. import core
 from .. import util
 from collections import defaultdict, OrderedDict, Counter
 import numpy as np
+import scipy.sparse
 import time
 import sys
 import gc
@@ -34,6 +35,7 @@ class TfModiscoSeqletsToPatternsFactory(object):
                        alphabet_size=4,
                        kmer_len=8, num_gaps=3, num_mismatches=2,
                        gpu_batch_size=20,
+                       persist_gapped_kmer_filters=False,
 
                        nn_n_jobs=4,
                        nearest_neighbors_to_compute=500,
@@ -79,6 +81,7 @@ class TfModiscoSeqletsToPatternsFactory(object):
         self.num_gaps = num_gaps
         self.num_mismatches = num_mismatches
         self.gpu_batch_size = gpu_batch_size
+        self.persist_gapped_kmer_filters = persist_gapped_kmer_filters
 
         self.nn_n_jobs = nn_n_jobs
         self.nearest_neighbors_to_compute = nearest_neighbors_to_compute
@@ -133,6 +136,8 @@ class TfModiscoSeqletsToPatternsFactory(object):
                 ('kmer_len', self.kmer_len),
                 ('num_gaps', self.num_gaps),
                 ('num_mismatches', self.num_mismatches),
+                ('persist_gapped_kmer_filters',
+                 self.persist_gapped_kmer_filters),
                 ('nn_n_jobs', self.nn_n_jobs),
                 ('nearest_neighbors_to_compute',
                  self.nearest_neighbors_to_compute),
@@ -202,7 +207,8 @@ class TfModiscoSeqletsToPatternsFactory(object):
             toscore_track_names_and_signs=list(
                 zip(hypothetical_contribs_track_names,
                     [np.sign(x) for x in track_signs])),
-            normalizer=affinitymat.core.MeanNormalizer())
+            normalizer=affinitymat.core.MeanNormalizer(),
+            persist_filters=self.persist_gapped_kmer_filters)
 
         #affinity matrix from embeddings
         coarse_affmat_computer =\
@@ -218,6 +224,14 @@ class TfModiscoSeqletsToPatternsFactory(object):
             n_neighbors=self.nearest_neighbors_to_compute,
             nn_n_jobs=self.nn_n_jobs)  
 
+        #nearest neighbors straight from the embeddings, without the
+        # dense coarse affmat
+        coarse_neighbors_computer =\
+            affinitymat.core.NeighborsFromSeqletEmbeddings(
+                seqlets_to_1d_embedder=gkmer_embedder,
+                n_neighbors=self.nearest_neighbors_to_compute,
+                verbose=self.verbose)
+
         affmat_from_seqlets_with_nn_pairs =\
             affinitymat.core.AffmatFromSeqletsWithNNpairs(
                 pattern_comparison_settings=pattern_comparison_settings,
@@ -421,7 +435,8 @@ class TfModiscoSeqletsToPatternsFactory(object):
                 similar_patterns_collapser=similar_patterns_collapser,
                 seqlet_reassigner=seqlet_reassigner,
                 final_postprocessor=final_postprocessor,
-                verbose=self.verbose)
+                verbose=self.verbose,
+                coarse_neighbors_computer=coarse_neighbors_computer)
 
     def save_hdf5(self, grp):
         grp.attrs['jsonable_config'] =\
@@ -440,10 +455,11 @@ class SeqletsToPatternsResults(object):
         self.__dict__.update(**kwargs)
 
     @classmethod
-    def from_hdf5(cls, grp, track_set):
+    def from_hdf5(cls, grp, track_set, lazy=False):
         success = grp.attrs.get("success", False)
         if (success):
-            patterns = util.load_patterns(grp=grp["patterns"], track_set=track_set) 
+            patterns = util.load_patterns(grp=grp["patterns"],
+                                          track_set=track_set, lazy=lazy) 
             cluster_results = None
             total_time_taken = None
             return cls(patterns=patterns, cluster_results=cluster_results,
@@ -452,11 +468,15 @@ class SeqletsToPatternsResults(object):
             return cls(success=False, patterns=None, cluster_results=None,
                        total_time_taken=None)
 
-    def save_hdf5(self, grp):
+    def save_hdf5(self, grp, packed_patterns=False):
         grp.attrs["success"] = self.success
         if (self.success):
-            util.save_patterns(self.patterns,
-                               grp.create_group("patterns"))
+            if (packed_patterns):
+                util.save_packed_patterns(self.patterns,
+                                          grp.create_group("patterns"))
+            else:
+                util.save_patterns(self.patterns,
+                                   grp.create_group("patterns"))
             self.cluster_results.save_hdf5(grp.create_group("cluster_results"))   
             grp.attrs['total_time_taken'] = self.total_time_taken
 
@@ -484,7 +504,12 @@ class TfModiscoSeqletsToPatterns(AbstractSeqletsToPatterns):
                        similar_patterns_collapser,
                        seqlet_reassigner,
                        final_postprocessor,
-                       verbose=True):
+                       verbose=True,
+                       coarse_neighbors_computer=None):
+        #if coarse_neighbors_computer is specified, it is used instead of
+        # coarse_affmat_computer and nearest_neighbors_computer when the
+        # fine-grained affmat is computed; it returns the nearest neighbors
+        # and their coarse affinities
 
         self.seqlets_sorter = seqlets_sorter
         self.coarse_affmat_computer = coarse_affmat_computer
@@ -506,6 +531,7 @@ class TfModiscoSeqletsToPatterns(AbstractSeqletsToPatterns):
         self.final_postprocessor = final_postprocessor
 
         self.verbose = verbose
+        self.coarse_neighbors_computer = coarse_neighbors_computer
 
 
     def __call__(self, seqlets):
@@ -553,7 +579,20 @@ class TfModiscoSeqletsToPatterns(AbstractSeqletsToPatterns):
             print("")
             print("(Round %d) step3: embedding+coarse_affmat computation."%round_num)
             t1=time.time()
-            coarse_affmat = self.coarse_affmat_computer(seqlets)
+            use_coarse_neighbors = (self.coarse_neighbors_computer
+                                    is not None
+                                    and self.skip_fine_grained==False)
+            if (use_coarse_neighbors):
+                seqlet_neighbors, coarse_neighbor_affs =\
+                    self.coarse_neighbors_computer(seqlets)
+                #the coarse affinities to the nearest neighbors only
+                coarse_affmat = scipy.sparse.csr_matrix(
+                    (coarse_neighbor_affs.ravel(), seqlet_neighbors.ravel(),
+                     np.arange(0, seqlet_neighbors.size+1,
+                               seqlet_neighbors.shape[1])),
+                    shape=(len(seqlets), len(seqlets)))
+            else:
+                coarse_affmat = self.coarse_affmat_computer(seqlets)
             #coarse_affmats.append(coarse_affmat)
             t2=time.time()
             print("(Round %d) step3 completed in: %.2f s, metacluster total %.2f s, current memory usage %.2f gb."%(round_num, t2-t1, t2-start, return_memory()))
@@ -569,7 +608,9 @@ class TfModiscoSeqletsToPatterns(AbstractSeqletsToPatterns):
                     print_memory_use()
                     sys.stdout.flush()
 
-                seqlet_neighbors = self.nearest_neighbors_computer(coarse_affmat)
+                if (use_coarse_neighbors==False):
+                    seqlet_neighbors =\
+                        self.nearest_neighbors_computer(coarse_affmat)
 
                 if (self.verbose):
                     print("Computed nearest neighbors in",
@@ -710,7 +751,7 @@ class TfModiscoSeqletsToPatterns(AbstractSeqletsToPatterns):
                         cluster_to_eliminated_motif[i] = motif
 
             #obtain unique seqlets from adjusted motifs
-            seqlets = dict([(y.exidx_start_end_string, y)
+            seqlets = dict([(y.identity_key, y)
                              for x in cluster_to_motif.values()
                              for y in x.seqlets]).values()
             
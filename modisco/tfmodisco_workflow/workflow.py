@@ -6,7 +6,7 @@ import time
 import sys
 import h5py
 import json
-import pickle
+import threading
 from . import seqlets_to_patterns
 from .. import core
 from .. import coordproducers
@@ -45,13 +45,16 @@ class TfModiscoResults(object):
         self.__dict__.update(**kwargs)
 
     @classmethod
-    def from_hdf5(cls, grp, track_set):
+    def from_hdf5(cls, grp, track_set, lazy=False):
+        """If lazy, seqlets are SeqletTables and patterns are
+         LazyAggregatedSeqlets, which read from grp (which must then stay
+         open) and create snippets only as they are accessed"""
         task_names = util.load_string_list(dset_name="task_names",
                                            grp=grp)
         multitask_seqlet_creation_results =\
             core.MultiTaskSeqletCreationResults.from_hdf5(
                 grp=grp["multitask_seqlet_creation_results"],
-                track_set=track_set)
+                track_set=track_set, lazy=lazy)
         metaclustering_results =\
             metaclusterers.MetaclusteringResults.from_hdf5(
                 grp["metaclustering_results"])
@@ -63,7 +66,7 @@ class TfModiscoResults(object):
              SubMetaclusterResults.from_hdf5(
                 grp=metacluster_idx_to_submetacluster_results_group[
                      metacluster_idx],
-                track_set=track_set)
+                track_set=track_set, lazy=lazy)
 
         return cls(task_names=task_names,
                    multitask_seqlet_creation_results=
@@ -72,7 +75,9 @@ class TfModiscoResults(object):
                    metacluster_idx_to_submetacluster_results=
                     metacluster_idx_to_submetacluster_results)
 
-    def save_hdf5(self, grp):
+    def save_hdf5(self, grp, packed_patterns=False):
+        """If packed_patterns, the patterns are saved with
+         util.save_packed_patterns"""
         util.save_string_list(string_list=self.task_names, 
                               dset_name="task_names", grp=grp)
         self.multitask_seqlet_creation_results.save_hdf5(
@@ -85,7 +90,8 @@ class TfModiscoResults(object):
         for idx in self.metacluster_idx_to_submetacluster_results:
             self.metacluster_idx_to_submetacluster_results[idx].save_hdf5(
                 grp=metacluster_idx_to_submetacluster_results_group
-                    .create_group("metacluster_"+str(idx))) 
+                    .create_group("metacluster_"+str(idx)),
+                packed_patterns=packed_patterns) 
 
 
 class SubMetaclusterResults(object):
@@ -98,55 +104,156 @@ class SubMetaclusterResults(object):
         self.seqlets_to_patterns_result = seqlets_to_patterns_result
 
     @classmethod
-    def from_hdf5(cls, grp, track_set):
+    def from_hdf5(cls, grp, track_set, lazy=False):
         metacluster_size = int(grp.attrs['size'])
         activity_pattern = np.array(grp['activity_pattern'])
-        seqlet_coords = util.load_seqlet_coords(dset_name="seqlets", grp=grp)
-        seqlets = track_set.create_seqlets(coords=seqlet_coords)
+        seqlets = core.load_seqlets(dset_name="seqlets", grp=grp,
+                                    track_set=track_set, lazy=lazy)
         seqlets_to_patterns_result =\
             seqlets_to_patterns.SeqletsToPatternsResults.from_hdf5(
                 grp=grp["seqlets_to_patterns_result"],
-                track_set=track_set) 
+                track_set=track_set, lazy=lazy) 
         return cls(metacluster_size=metacluster_size,
                    activity_pattern=activity_pattern,
                    seqlets=seqlets,
                    seqlets_to_patterns_result=seqlets_to_patterns_result) 
 
-    def save_hdf5(self, grp):
+    def save_hdf5(self, grp, packed_patterns=False):
         grp.attrs['size'] = self.metacluster_size
         grp.create_dataset('activity_pattern', data=self.activity_pattern)
         util.save_seqlet_coords(seqlets=self.seqlets,
                                 dset_name="seqlets", grp=grp)   
         self.seqlets_to_patterns_result.save_hdf5(
-            grp=grp.create_group('seqlets_to_patterns_result'))
+            grp=grp.create_group('seqlets_to_patterns_result'),
+            packed_patterns=packed_patterns)
+
+
+def make_data_track(name, tracks, revcomp=True, block_size=256,
+                          max_cached_blocks=64):
+    #arrays backed by disk (h5py datasets, memmaps) are read on demand
+    # instead of being loaded into memory; at most
+    # block_size*max_cached_blocks examples of each such track are cached
+    if (isinstance(tracks, (h5py.Dataset, np.memmap))):
+        return core.LazyDataTrack(name=name, source=tracks,
+                                  has_pos_axis=True, revcomp=revcomp,
+                                  block_size=block_size,
+                                  max_cached_blocks=max_cached_blocks)
+    if (revcomp==False):
+        rev_tracks = None
+    elif (isinstance(tracks, np.ndarray) and len(tracks.shape)==3):
+        #a single reversed view keeps the tracks an array, which lets
+        # snippets be gathered for many seqlets at once
+        rev_tracks = tracks[:, ::-1, ::-1]
+    else:
+        rev_tracks = [x[::-1, ::-1] for x in tracks]
+    return core.DataTrack(name=name, fwd_tracks=tracks,
+                          rev_tracks=rev_tracks, has_pos_axis=True)
+
+
+def get_seqlets_checkpoint_arrays(seqlets):
+    """The coordinates of seqlets as a structured array, and their scores
+     if all the coordinates have one (else None)"""
+    coords = [x.coor for x in seqlets]
+    coord_array = core.SeqletTable.get_coord_array(coords)
+    scores = (np.array([x.score for x in coords])
+              if all([hasattr(x, "score") for x in coords]) else None)
+    return coord_array, scores
+
+
+def write_seqlets_checkpoint(coord_array, scores, path):
+    with h5py.File(path, "w") as f:
+        util.save_coord_array(coord_array=coord_array,
+                              dset_name="coords", grp=f)
+        if (scores is not None):
+            f.create_dataset("scores", data=scores)
+
+
+def save_seqlets_checkpoint(seqlets, path):
+    """Saves the coordinates and scores of seqlets (but not their
+     snippets) to the hdf5 file at path"""
+    coord_array, scores = get_seqlets_checkpoint_arrays(seqlets)
+    write_seqlets_checkpoint(coord_array=coord_array, scores=scores,
+                             path=path)
+
+
+def load_seqlets_checkpoint(path, track_set, track_names=None,
+                                  lazy=False):
+    """Recreates the seqlets saved by save_seqlets_checkpoint from the
+     tracks in track_set; if lazy, returns a SeqletTable (which keeps
+     the scores, if they were saved)"""
+    with h5py.File(path, "r") as f:
+        coord_array = util.load_coord_array(dset_name="coords", grp=f)
+        scores = (np.array(f["scores"]) if "scores" in f else None)
+    if (track_names is None):
+        track_names = track_set.track_name_to_data_track.keys()
+    if (lazy):
+        return core.SeqletTable(coords=coord_array,
+                                track_names=track_names,
+                                track_set=track_set, scores=scores)
+    if (scores is not None):
+        #the scored coordinates made by the coord producer
+        coords = [coordproducers.SeqletCoordsFWAP(
+                    example_idx=example_idx, start=start, end=end,
+                    score=score)
+                  for (example_idx, start, end, is_revcomp), score
+                  in zip(coord_array.tolist(), scores.tolist())]
+    else:
+        coords = [core.SeqletCoordinates(example_idx=example_idx,
+                                         start=start, end=end,
+                                         is_revcomp=is_revcomp)
+                  for (example_idx, start, end, is_revcomp)
+                  in coord_array.tolist()]
+    return track_set.create_seqlets(coords=coords, track_names=track_names)
+
+
+class BackgroundSeqletsCheckpoint(object):
+    """
+    Writes a seqlets checkpoint in a background thread. The coordinates
+     are gathered when it is created, so that the seqlets can be used
+     (and materialized) while the file is written; join() waits for the
+     write and re-raises any error from it.
+    """
+
+    def __init__(self, seqlets, path):
+        self.path = path
+        self.coord_array, self.scores = get_seqlets_checkpoint_arrays(
+                                         seqlets)
+        self.error = None
+        self.thread = threading.Thread(target=self._write)
+        self.thread.start()
+
+    def _write(self):
+        try:
+            write_seqlets_checkpoint(coord_array=self.coord_array,
+                                     scores=self.scores, path=self.path)
+        except Exception as e:
+            self.error = e
+
+    def join(self):
+        self.thread.join()
+        if (self.error is not None):
+            raise self.error
 
 
 def prep_track_set(task_names, contrib_scores,
                     hypothetical_contribs, one_hot,
-                    revcomp=True, other_tracks=[]):
+                    revcomp=True, other_tracks=[],
+                    block_size=256, max_cached_blocks=64):
     contrib_scores_tracks = [
-        core.DataTrack(
-            name=key+"_contrib_scores",
-            fwd_tracks=contrib_scores[key],
-            rev_tracks=(([x[::-1, ::-1] for x in 
-                         contrib_scores[key]])
-                        if revcomp else
-                         None),
-            has_pos_axis=True) for key in task_names] 
+        make_data_track(name=key+"_contrib_scores",
+                        tracks=contrib_scores[key], revcomp=revcomp,
+                        block_size=block_size,
+                        max_cached_blocks=max_cached_blocks)
+        for key in task_names] 
     hypothetical_contribs_tracks = [
-        core.DataTrack(name=key+"_hypothetical_contribs",
-                       fwd_tracks=hypothetical_contribs[key],
-                       rev_tracks=(([x[::-1, ::-1] for x in 
-                                     hypothetical_contribs[key]])
-                                   if revcomp else
-                                    None),
-                       has_pos_axis=True)
-                       for key in task_names]
-    onehot_track = core.DataTrack(
-                        name="sequence", fwd_tracks=one_hot,
-                        rev_tracks=([x[::-1, ::-1] for x in one_hot]
-                                    if revcomp else None),
-                        has_pos_axis=True)
+        make_data_track(name=key+"_hypothetical_contribs",
+                        tracks=hypothetical_contribs[key], revcomp=revcomp,
+                        block_size=block_size,
+                        max_cached_blocks=max_cached_blocks)
+        for key in task_names]
+    onehot_track = make_data_track(name="sequence", tracks=one_hot,
+                                   revcomp=revcomp, block_size=block_size,
+                                   max_cached_blocks=max_cached_blocks)
     track_set = core.TrackSet(
                     data_tracks=contrib_scores_tracks
                     +hypothetical_contribs_tracks+[onehot_track]+other_tracks)
@@ -169,6 +276,11 @@ class TfModiscoWorkflow(object):
                  min_passing_windows_frac=0.03,
                  max_passing_windows_frac=0.2,
                  separate_pos_neg_thresholds=False,
+                 threshold_histogram_bins=None,
+                 seqlet_creation_n_cores=1,
+                 seqlets_checkpoint_path=None,
+                 lazy_track_block_size=256,
+                 lazy_track_max_cached_blocks=64,
                  verbose=True,
                  min_seqlets_per_task=None):
 
@@ -192,6 +304,16 @@ class TfModiscoWorkflow(object):
         self.min_passing_windows_frac = min_passing_windows_frac
         self.max_passing_windows_frac = max_passing_windows_frac
         self.separate_pos_neg_thresholds = separate_pos_neg_thresholds
+        self.threshold_histogram_bins = threshold_histogram_bins
+        self.seqlet_creation_n_cores = seqlet_creation_n_cores
+        #if not None, the seqlet coordinates found in step 1 are saved
+        # there (see load_seqlets_checkpoint)
+        self.seqlets_checkpoint_path = seqlets_checkpoint_path
+        #tracks given as h5py datasets or memmaps are read lazily, keeping
+        # up to block_size*max_cached_blocks examples in memory per track
+        # (e.g. ~4MB a block for float32 1kb x 4, so ~256MB per track)
+        self.lazy_track_block_size = lazy_track_block_size
+        self.lazy_track_max_cached_blocks = lazy_track_max_cached_blocks
         self.verbose = verbose
 
         self.build()
@@ -230,6 +352,7 @@ class TfModiscoWorkflow(object):
             max_passing_windows_frac=self.max_passing_windows_frac,
             separate_pos_neg_thresholds=self.separate_pos_neg_thresholds,
             max_seqlets_total=None,
+            threshold_histogram_bins=self.threshold_histogram_bins,
             verbose=self.verbose) 
 
         track_set = prep_track_set(
@@ -238,7 +361,9 @@ class TfModiscoWorkflow(object):
                         hypothetical_contribs=hypothetical_contribs,
                         one_hot=one_hot,
                         revcomp=revcomp,
-                        other_tracks=other_tracks)
+                        other_tracks=other_tracks,
+                        block_size=self.lazy_track_block_size,
+                        max_cached_blocks=self.lazy_track_max_cached_blocks)
 
         if (per_position_contrib_scores is None):
             per_position_contrib_scores = OrderedDict([
@@ -247,10 +372,14 @@ class TfModiscoWorkflow(object):
 
         multitask_seqlet_creation_results = core.MultiTaskSeqletCreator(
             coord_producer=self.coord_producer,
-            overlap_resolver=self.overlap_resolver)(
+            overlap_resolver=self.overlap_resolver,
+            n_cores=self.seqlet_creation_n_cores)(
                 task_name_to_score_track=per_position_contrib_scores,
                 null_tracks=null_per_pos_scores,
-                track_set=track_set)
+                track_set=track_set,
+                #metaclustering only needs the contrib scores; the other
+                # tracks are added per metacluster, as they are needed
+                track_names=[x+"_contrib_scores" for x in task_names])
 
         #find the weakest transformed threshold used across all tasks
         
@@ -271,12 +400,13 @@ class TfModiscoWorkflow(object):
                   +" Consider dropping target_seqlet_fdr") 
         t2 = time.time()
         print("step1 completed in: %.2f s, current memory usage %.2f gb."%(t2-t1, return_memory()))
-        print("saving seqlets to seqlets.pickle")
-
-        # save seqlets to pickle
-        pickle_out = open("seqlets.pickle","wb")
-        pickle.dump(seqlets, pickle_out)
-        pickle_out.close()
+        if (self.seqlets_checkpoint_path is not None):
+            print("saving seqlet coordinates to "
+                  +self.seqlets_checkpoint_path)
+            seqlets_checkpoint = BackgroundSeqletsCheckpoint(
+                seqlets=seqlets, path=self.seqlets_checkpoint_path)
+        else:
+            seqlets_checkpoint = None
         
         print("")
         print("step2: metacluster assignment.")
@@ -370,14 +500,22 @@ class TfModiscoWorkflow(object):
             if (len(relevant_task_names) == 0):
                 assert False, "This should not happen"
                 sys.stdout.flush()
+
+            contrib_scores_track_names =\
+                [key+"_contrib_scores" for key in relevant_task_names]
+            hypothetical_contribs_track_names =\
+                [key+"_hypothetical_contribs" for key in relevant_task_names]
+            track_set.materialize_seqlets(
+                seqlets=metacluster_seqlets,
+                track_names=(["sequence"]+contrib_scores_track_names
+                             +hypothetical_contribs_track_names))
             
             seqlets_to_patterns = self.seqlets_to_patterns_factory(
                 track_set=track_set,
                 onehot_track_name="sequence",
-                contrib_scores_track_names =\
-                    [key+"_contrib_scores" for key in relevant_task_names],
+                contrib_scores_track_names=contrib_scores_track_names,
                 hypothetical_contribs_track_names=\
-                    [key+"_hypothetical_contribs" for key in relevant_task_names],
+                    hypothetical_contribs_track_names,
                 track_signs=relevant_task_signs,
                 other_comparison_track_names=[])
 
@@ -389,6 +527,14 @@ class TfModiscoWorkflow(object):
                     seqlets=metacluster_seqlets,
                     seqlets_to_patterns_result=seqlets_to_patterns_result)
 
+        if (seqlets_checkpoint is not None):
+            #a failed checkpoint shouldn't cost the results
+            try:
+                seqlets_checkpoint.join()
+            except Exception as e:
+                print("WARNING: could not save the seqlet coordinates to "
+                      +self.seqlets_checkpoint_path+": "+str(e))
+
         return TfModiscoResults(
                  task_names=task_names,
                  multitask_seqlet_creation_results=
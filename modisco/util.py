@@ -8,15 +8,21 @@ import traceback
 from sklearn.neighbors.kde import KernelDensity
 
 
-def load_patterns(grp, track_set):
-    from modisco.core import AggregatedSeqlet
+def load_patterns(grp, track_set, lazy=False):
+    from modisco.core import AggregatedSeqlet, LazyAggregatedSeqlet
+    if (grp.attrs.get("layout", None) == "packed"):
+        return load_packed_patterns(grp=grp, track_set=track_set, lazy=lazy)
     all_pattern_names = load_string_list(dset_name="all_pattern_names",
                                          grp=grp)
     patterns = []
     for pattern_name in all_pattern_names:
         pattern_grp = grp[pattern_name] 
-        patterns.append(AggregatedSeqlet.from_hdf5(grp=pattern_grp,
-                                                   track_set=track_set))
+        if (lazy):
+            patterns.append(LazyAggregatedSeqlet(grp=pattern_grp,
+                                                 track_set=track_set))
+        else:
+            patterns.append(AggregatedSeqlet.from_hdf5(grp=pattern_grp,
+                                                       track_set=track_set))
     return patterns
 
 
@@ -31,6 +37,51 @@ def save_patterns(patterns, grp):
                      grp=grp)
 
 
+def load_packed_patterns(grp, track_set, lazy=False):
+    from modisco.core import PackedLazyAggregatedSeqlet
+    patterns = [PackedLazyAggregatedSeqlet(grp=grp, pattern_idx=idx,
+                                           track_set=track_set)
+                for idx in range(len(grp["seqlet_offsets"])-1)]
+    if (lazy==False):
+        patterns = [x.materialize() for x in patterns]
+    return patterns
+
+
+def save_packed_patterns(patterns, grp):
+    """Alternative to save_patterns that concatenates the aggregated
+     tracks of all the patterns into one dataset per track and strand,
+     and their seqlets into one dataset, with offsets datasets indexing
+     each pattern's rows; load_patterns reads both layouts"""
+    from modisco.core import SeqletTable
+    grp.attrs["layout"] = "packed"
+    track_names = (list(patterns[0].track_name_to_snippet.keys())
+                   if len(patterns) > 0 else [])
+    save_string_list(track_names, dset_name="track_names", grp=grp)
+    tracks_grp = grp.create_group("tracks")
+    for track_name in track_names:
+        track_grp = tracks_grp.create_group(track_name)
+        snippets = [pattern[track_name] for pattern in patterns]
+        track_grp.attrs["has_pos_axis"] = snippets[0].has_pos_axis
+        track_grp.create_dataset("offsets", data=np.concatenate(
+            [[0], np.cumsum([len(x) for x in snippets])]).astype("int64"))
+        track_grp.create_dataset("fwd", data=np.concatenate(
+            [x.fwd for x in snippets], axis=0))
+        if (snippets[0].rev is not None):
+            track_grp.create_dataset("rev", data=np.concatenate(
+                [x.rev for x in snippets], axis=0))
+    seqlets_and_alnmts = [x for pattern in patterns
+                          for x in pattern.seqlets_and_alnmts]
+    grp.create_dataset("seqlet_offsets", data=np.concatenate(
+        [[0], np.cumsum([pattern.num_seqlets for pattern in patterns])]
+        ).astype("int64"))
+    save_coord_array(
+        coord_array=SeqletTable.get_coord_array(
+            [x.seqlet.coor for x in seqlets_and_alnmts]),
+        dset_name="seqlets", grp=grp)
+    grp.create_dataset("alnmts", data=np.array(
+        [x.alnmt for x in seqlets_and_alnmts], dtype="int64"))
+
+
 def load_string_list(dset_name, grp):
     return [x.decode("utf-8") for x in grp[dset_name][:]]
 
@@ -41,18 +92,50 @@ def save_string_list(string_list, dset_name, grp):
     dset[:] = string_list
 
 
-def load_seqlet_coords(dset_name, grp):
+def load_coord_array(dset_name, grp):
+    """Coordinates as a structured array with the fields of
+     SeqletTable.coord_dtype; also reads the older layout in which they
+     were saved as strings"""
+    from modisco.core import SeqletCoordinates, SeqletTable
+    dset = grp[dset_name]
+    if (dset.dtype.names is not None):
+        return np.array(dset[:], dtype=SeqletTable.coord_dtype)
+    return SeqletTable.get_coord_array(
+        [SeqletCoordinates.from_string(x.decode("utf-8"))
+         for x in dset[:]])
+
+
+def load_coords(dset_name, grp):
     from modisco.core import SeqletCoordinates
-    coords_strings = load_string_list(dset_name=dset_name, grp=grp)
-    return [SeqletCoordinates.from_string(x) for x in coords_strings] 
+    coord_array = load_coord_array(dset_name=dset_name, grp=grp)
+    return [SeqletCoordinates(example_idx=example_idx, start=start,
+                              end=end, is_revcomp=is_revcomp)
+            for (example_idx, start, end, is_revcomp)
+            in coord_array.tolist()]
 
 
-def save_seqlet_coords(seqlets, dset_name, grp):
-    coords_strings = [str(x.coor) for x in seqlets] 
-    save_string_list(string_list=coords_strings,
+def save_coords(coords, dset_name, grp):
+    from modisco.core import SeqletTable
+    save_coord_array(coord_array=SeqletTable.get_coord_array(coords),
                      dset_name=dset_name, grp=grp)
 
 
+def save_coord_array(coord_array, dset_name, grp):
+    #chunking (which compression needs) requires a non-empty dataset
+    grp.create_dataset(dset_name, data=coord_array,
+                       **(dict(compression="gzip", shuffle=True)
+                          if len(coord_array) > 0 else {}))
+
+
+def load_seqlet_coords(dset_name, grp):
+    return load_coords(dset_name=dset_name, grp=grp)
+
+
+def save_seqlet_coords(seqlets, dset_name, grp):
+    save_coords(coords=[x.coor for x in seqlets],
+                dset_name=dset_name, grp=grp)
+
+
 def factorial(val):
     to_return = 1
     for i in range(1,val+1):
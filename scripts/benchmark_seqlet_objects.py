@@ -0,0 +1,98 @@
+from __future__ import division, print_function, absolute_import
+import argparse
+import gc
+import time
+import tracemalloc
+import numpy as np
+from modisco import core
+from modisco.coordproducers import SeqletCoordsFWAP
+
+
+#__dict__-based versions of the slotted classes, for comparison
+
+class DictSnippet(object):
+
+    def __init__(self, fwd, rev, has_pos_axis):
+        self.fwd = fwd
+        self.rev = rev
+        self.has_pos_axis = has_pos_axis
+
+
+class DictSeqletCoordinates(object):
+
+    def __init__(self, example_idx, start, end, is_revcomp):
+        self.example_idx = example_idx
+        self.start = start
+        self.end = end
+        self.is_revcomp = is_revcomp
+
+
+class DictSeqletCoordsFWAP(DictSeqletCoordinates):
+
+    def __init__(self, example_idx, start, end, score):
+        self.score = score
+        super(DictSeqletCoordsFWAP, self).__init__(
+            example_idx=example_idx, start=start, end=end, is_revcomp=False)
+
+
+class DictSeqletAndAlignment(object):
+
+    def __init__(self, seqlet, alnmt):
+        self.seqlet = seqlet
+        self.alnmt = alnmt
+
+
+def make_objects(num_seqlets, snippet_class, coords_class, fwap_class,
+                 seqlet_and_alnmt_class):
+    data = np.zeros((21,4))
+    objects = []
+    for idx in range(num_seqlets):
+        coor = coords_class(example_idx=idx, start=10, end=31,
+                            is_revcomp=False)
+        objects.append((
+            coor,
+            fwap_class(example_idx=idx, start=10, end=31, score=1.0),
+            snippet_class(fwd=data, rev=data, has_pos_axis=True),
+            seqlet_and_alnmt_class(seqlet=coor, alnmt=0)))
+    return objects
+
+
+def benchmark(num_seqlets, **classes):
+    gc.collect()
+    start_time = time.time()
+    make_objects(num_seqlets=num_seqlets, **classes)
+    construction_time = time.time()-start_time
+    gc.collect()
+    tracemalloc.start()
+    objects = make_objects(num_seqlets=num_seqlets, **classes)
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objects
+    return construction_time, memory
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Memory and construction time of the per-seqlet"
+                    " objects, with and without __slots__")
+    parser.add_argument("--num_seqlets", type=int, default=500000)
+    args = parser.parse_args()
+
+    results = [
+        ("__dict__", benchmark(
+            num_seqlets=args.num_seqlets, snippet_class=DictSnippet,
+            coords_class=DictSeqletCoordinates,
+            fwap_class=DictSeqletCoordsFWAP,
+            seqlet_and_alnmt_class=DictSeqletAndAlignment)),
+        ("__slots__", benchmark(
+            num_seqlets=args.num_seqlets, snippet_class=core.Snippet,
+            coords_class=core.SeqletCoordinates,
+            fwap_class=SeqletCoordsFWAP,
+            seqlet_and_alnmt_class=core.SeqletAndAlignment))]
+    print("Per seqlet: one each of SeqletCoordinates, SeqletCoordsFWAP,"
+          " Snippet and SeqletAndAlignment; "+str(args.num_seqlets)
+          +" seqlets")
+    for name, (construction_time, memory) in results:
+        print(name+": "+("%.2f"%construction_time)+" s to construct, "
+              +("%.1f"%(memory/2**20))+" MB ("
+              +("%.0f"%(memory/args.num_seqlets))+" bytes per seqlet)")
@@ -23,6 +23,71 @@ class TestNormalizers(unittest.TestCase):
         np.testing.assert_almost_equal(np.mean(normalized), 0.0)
         np.testing.assert_almost_equal(np.linalg.norm(normalized), 1.0)
 
+    def test_batch_call(self):
+        from modisco.affinitymat import L1Normalizer
+        rand_arrays = np.random.RandomState(1).randn(5,10,4)
+        rand_arrays[2] = 0
+        for normalizer in [MeanNormalizer(), MagnitudeNormalizer(),
+                           L1Normalizer()]:
+            np.testing.assert_almost_equal(
+                normalizer.batch_call(rand_arrays),
+                [normalizer(x) for x in rand_arrays])
+
+
+class TestPatternComparisonSettings(unittest.TestCase):
+
+    def test_get_2d_data_is_cached(self):
+        fwd_tracks = np.random.RandomState(1).randn(3,10,4)
+        track_set = core.TrackSet(data_tracks=[
+            core.DataTrack(name="track", fwd_tracks=fwd_tracks,
+                           rev_tracks=fwd_tracks[:,::-1,::-1],
+                           has_pos_axis=True)])
+        seqlets = track_set.create_seqlets(coords=[
+            core.SeqletCoordinates(example_idx=i, start=i, end=i+5,
+                                   is_revcomp=(i==1)) for i in range(3)])
+        settings = PatternComparisonSettings(
+            track_names=["track"], track_transformer=MeanNormalizer(),
+            min_overlap=0.5)
+        fwd_data, rev_data = settings.get_2d_data(seqlets)
+        expected_fwd_data, expected_rev_data =\
+            core.get_2d_data_from_patterns_individually(
+                patterns=seqlets, track_names=["track"],
+                track_transformer=MeanNormalizer())
+        np.testing.assert_almost_equal(fwd_data, expected_fwd_data)
+        np.testing.assert_almost_equal(rev_data, expected_rev_data)
+        self.assertTrue(settings.get_2d_data(seqlets)[0] is fwd_data)
+        self.assertFalse(settings.get_2d_data(seqlets[:2])[0] is fwd_data)
+
+    def test_get_2d_data_is_cached_for_tables(self):
+        fwd_tracks = np.random.RandomState(1).randn(3,10,4)
+        track_set = core.TrackSet(data_tracks=[
+            core.DataTrack(name="track", fwd_tracks=fwd_tracks,
+                           rev_tracks=fwd_tracks[:,::-1,::-1],
+                           has_pos_axis=True)])
+        coords = [core.SeqletCoordinates(example_idx=i, start=i, end=i+5,
+                                         is_revcomp=(i==1))
+                  for i in range(3)]
+        table = core.SeqletTable.from_coords(coords=coords,
+                                             track_set=track_set)
+        settings = PatternComparisonSettings(
+            track_names=["track"], track_transformer=MeanNormalizer(),
+            min_overlap=0.5)
+        fwd_data, rev_data = settings.get_2d_data(table)
+        expected_fwd_data, expected_rev_data =\
+            core.get_2d_data_from_patterns_individually(
+                patterns=track_set.create_seqlets(coords=coords),
+                track_names=["track"], track_transformer=MeanNormalizer())
+        np.testing.assert_almost_equal(fwd_data, expected_fwd_data)
+        np.testing.assert_almost_equal(rev_data, expected_rev_data)
+        #a repeated call, and a call on an equal table, are cache hits
+        self.assertTrue(settings.get_2d_data(table)[0] is fwd_data)
+        self.assertTrue(settings.get_2d_data(
+            core.SeqletTable.from_coords(coords=coords,
+                                         track_set=track_set))[0]
+            is fwd_data)
+        self.assertEqual(len(settings._2d_data_cache), 1)
+        self.assertFalse(settings.get_2d_data(table[:2])[0] is fwd_data)
+
 
 class TestGappedKmerEmbedder(unittest.TestCase):
 
@@ -51,6 +116,130 @@ class TestGappedKmerEmbedder(unittest.TestCase):
         self.assertListEqual(list(np.nonzero(out.squeeze())[0]),[1,6,18,23])
 
 
+    def test_numpy_backend_embedding(self):
+        from modisco.backend import numpy_backend
+        rng = np.random.RandomState(1)
+        filters = (rng.rand(30,3,4) > 0.7).astype("float")
+        biases = -rng.randint(0,3,size=30).astype("float")
+        onehot = np.array([self.seq_to_onehot(seq) for seq in
+                           ["ACGTTGCA", "GGGATCCA", "TTACGAAC"]])
+        to_embed = rng.randn(3,8,4)
+        #valid 1d convolution, keeping positions where the onehot matches
+        expected = np.zeros((3,30))
+        for i in range(3):
+            for pos in range(6):
+                for j in range(30):
+                    if (np.sum(onehot[i,pos:pos+3]*filters[j])
+                        + biases[j] > 0):
+                        expected[i,j] += np.sum(to_embed[i,pos:pos+3]
+                                                *filters[j])
+        for n_jobs in [1, 2]:
+            func = numpy_backend.get_gapped_kmer_embedding_func(
+                filters=filters, biases=biases, require_onehot_match=True,
+                n_jobs=n_jobs)
+            np.testing.assert_almost_equal(
+                func(onehot=onehot, to_embed=to_embed, batch_size=2,
+                     progress_update=None), expected, decimal=5)
+
+    def test_sparse_embedding(self):
+        from modisco.backend import numpy_backend
+        from modisco.affinitymat import (get_sparse_gapped_kmer_embedding,
+                                         NumpyCosineSimilarity)
+        rng = np.random.RandomState(1)
+        onehot = np.array([self.seq_to_onehot(seq) for seq in
+                           ["ACGTTGCAAC", "GGGATCCATT", "TTACGAACGA"]])
+        #a position without a letter
+        onehot[0,4] = 0
+        to_embed = rng.randn(3,10,4)
+        for num_mismatches in [0, 1]:
+            gkmer_embedder = GappedKmerEmbedder(
+                alphabet_size=4, kmer_len=4, num_gaps=1,
+                num_mismatches=num_mismatches,
+                toscore_track_names_and_signs=[], normalizer=None,
+                batch_size=2, onehot_track_name="sequence")
+            dense = numpy_backend.get_gapped_kmer_embedding_func(
+                filters=gkmer_embedder.filters, biases=gkmer_embedder.biases,
+                require_onehot_match=True)(
+                    onehot=onehot, to_embed=to_embed, batch_size=2,
+                    progress_update=None)
+            sparse = get_sparse_gapped_kmer_embedding(
+                onehot=onehot, to_embed=to_embed,
+                nonzero_position_combos=
+                 gkmer_embedder.get_nonzero_position_combos(),
+                kmer_len=4, alphabet_size=4, num_mismatches=num_mismatches,
+                batch_size=2)
+            np.testing.assert_almost_equal(sparse.toarray(), dense,
+                                           decimal=5)
+            cosine_similarity = NumpyCosineSimilarity(
+                verbose=False, gpu_batch_size=None)
+            np.testing.assert_almost_equal(
+                cosine_similarity(vecs1=sparse, vecs2=sparse),
+                cosine_similarity(vecs1=dense, vecs2=dense), decimal=5)
+
+    def test_filter_bank_is_shared(self):
+        kwargs = dict(alphabet_size=4, kmer_len=5, num_gaps=2,
+                      num_mismatches=1, toscore_track_names_and_signs=[],
+                      normalizer=None, batch_size=2,
+                      onehot_track_name="sequence")
+        gkmer_embedder1 = GappedKmerEmbedder(**kwargs)
+        gkmer_embedder2 = GappedKmerEmbedder(**kwargs)
+        self.assertIs(gkmer_embedder1.filters, gkmer_embedder2.filters)
+        self.assertIs(gkmer_embedder1.gapped_kmer_embedding_func,
+                      gkmer_embedder2.gapped_kmer_embedding_func)
+        self.assertFalse(gkmer_embedder1.filters.flags.writeable)
+        #the reverse complement of a reverse complement is the filter
+        np.testing.assert_array_equal(
+            gkmer_embedder1.revcomp_filter_idxs[
+                gkmer_embedder1.revcomp_filter_idxs],
+            np.arange(len(gkmer_embedder1.filters)))
+
+    def test_revcomp_embedding(self):
+        rng = np.random.RandomState(1)
+        onehot = np.array([self.seq_to_onehot(seq) for seq in
+                           ["ACGTTGCAACGT", "GGGATCCATTAC", "TTACGAACGAGG"]])
+        to_embed = rng.randn(3,12,4)*onehot
+        for sparse in [False, True]:
+            gkmer_embedder = GappedKmerEmbedder(
+                alphabet_size=4, kmer_len=5, num_gaps=2, num_mismatches=1,
+                toscore_track_names_and_signs=[], normalizer=None,
+                batch_size=2, onehot_track_name="sequence", sparse=sparse)
+            embedding_rev = gkmer_embedder.get_revcomp_embedding(
+                embedding_fwd=gkmer_embedder.embed(
+                    onehot=onehot, to_embed=to_embed, sparse=sparse),
+                onehot_fwd=onehot, data_to_embed_fwd=to_embed,
+                sparse=sparse)
+            expected = gkmer_embedder.embed(
+                onehot=onehot[:,::-1,::-1], to_embed=to_embed[:,::-1,::-1],
+                sparse=sparse)
+            if (sparse):
+                embedding_rev = embedding_rev.toarray()
+                expected = expected.toarray()
+            np.testing.assert_almost_equal(embedding_rev, expected,
+                                           decimal=5)
+
+
+class TestTopCosineNeighbors(unittest.TestCase):
+
+    def test_top_cosine_neighbors(self):
+        from modisco.affinitymat import get_top_cosine_neighbors
+        rng = np.random.RandomState(1)
+        vecs = rng.randn(30,8)
+        rev_vecs = rng.randn(30,8)
+        normed = vecs/np.linalg.norm(vecs, axis=1)[:,None]
+        normed_rev = rev_vecs/np.linalg.norm(rev_vecs, axis=1)[:,None]
+        sims = np.maximum(np.dot(normed, normed.T),
+                          np.dot(normed, normed_rev.T))
+        expected_neighbors = np.argsort(-sims, axis=1)[:,:5]
+        #blocks of 2 rows
+        neighbors, neighbor_sims = get_top_cosine_neighbors(
+            vecs=vecs, other_vecs_list=[vecs, rev_vecs], num_neighbors=5,
+            max_entries_per_block=60)
+        np.testing.assert_array_equal(neighbors, expected_neighbors)
+        np.testing.assert_almost_equal(
+            neighbor_sims, np.take_along_axis(sims, expected_neighbors,
+                                              axis=1))
+
+
 class TestMaxCrossCorr(unittest.TestCase):
 
     def test_max_cross_corr(self):
@@ -5,6 +5,8 @@ import unittest
 from unittest import skip
 import sys
 import os
+import shutil
+import tempfile
 import numpy as np
 from modisco import core
 import time
@@ -117,3 +119,178 @@ class TestFixedWindowAroundChunks(unittest.TestCase):
         self.assertEqual(coords[2].end,10)
         self.assertEqual(coords[2].is_revcomp,False)
 
+
+
+class TestFixedWindowAroundChunksHistogram(unittest.TestCase):
+
+    def setUp(self):
+        #the score distributions are plotted to figures/ in the cwd
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.tmpdir)
+
+    def get_fwac(self, threshold_histogram_bins,
+                       separate_pos_neg_thresholds=False):
+        return coordproducers.FixedWindowAroundChunks(
+                sliding=11, flank=5, suppress=10, target_fdr=0.2,
+                min_passing_windows_frac=0.01, max_passing_windows_frac=0.5,
+                separate_pos_neg_thresholds=separate_pos_neg_thresholds,
+                verbose=False,
+                threshold_histogram_bins=threshold_histogram_bins)
+
+    def test_histogram_thresholds_match_isotonic(self):
+        rng = np.random.RandomState(1)
+        #spikes well clear of the noise, whose window sums stay within
+        # the range of the null's
+        score_track = rng.uniform(-0.01, 0.01, size=(200,100))
+        for example_idx in range(len(score_track)):
+            start = rng.randint(10, 85)
+            score_track[example_idx, start:start+5] += (
+                rng.choice([-1,1])*rng.uniform(1.5, 2.5))
+        score_track = list(score_track)
+        null_track = list(rng.uniform(-0.1, 0.1, size=(200,100)))
+        num_bins = 1000
+        bin_width = max([np.max(np.abs(coordproducers.get_packed_window_sums(
+                            tracks=core.PackedTracks.from_tracks(x),
+                            window_size=11).packed))
+                         for x in [score_track, null_track]])/num_bins
+        for separate_pos_neg_thresholds in [False, True]:
+            isotonic_result = self.get_fwac(
+                threshold_histogram_bins=None,
+                separate_pos_neg_thresholds=separate_pos_neg_thresholds)(
+                    score_track=score_track, null_track=null_track)
+            histogram_result = self.get_fwac(
+                threshold_histogram_bins=num_bins,
+                separate_pos_neg_thresholds=separate_pos_neg_thresholds)(
+                    score_track=score_track, null_track=null_track)
+            for attr in ["neg_threshold", "pos_threshold"]:
+                self.assertLessEqual(
+                    abs(getattr(histogram_result.tnt_results, attr)
+                        - getattr(isotonic_result.tnt_results, attr)),
+                    bin_width)
+            self.assertEqual(len(histogram_result.coords), 200)
+            self.assertEqual(
+                sorted([(x.example_idx, x.start, x.end, x.score)
+                        for x in histogram_result.coords]),
+                sorted([(x.example_idx, x.start, x.end, x.score)
+                        for x in isotonic_result.coords]))
+
+    def test_hdf5_round_trip(self):
+        import h5py
+        fwac = self.get_fwac(threshold_histogram_bins=1000)
+        fwac.percentile_sketch_size = 500
+        with h5py.File(os.path.join(self.tmpdir, "fwac.h5"), "w") as f:
+            fwac.save_hdf5(f.create_group("fwac"))
+            loaded = coordproducers.AbstractCoordProducer.from_hdf5(
+                        f["fwac"])
+        self.assertEqual(type(loaded).__name__, "FixedWindowAroundChunks")
+        self.assertEqual(loaded.threshold_histogram_bins, 1000)
+        self.assertEqual(loaded.percentile_sketch_size, 500)
+
+
+class TestWindowSums(unittest.TestCase):
+
+    def test_simple_window_sum_function(self):
+        window_sum_function = coordproducers.get_simple_window_sum_function(3)
+        arrs = [np.array([1,2,3,4,5]).astype("float"),
+                np.array([0.5,-1,2]).astype("float")]
+        sums = window_sum_function(arrs)
+        np.testing.assert_almost_equal(sums[0], [6,9,12])
+        np.testing.assert_almost_equal(sums[1], [1.5])
+
+    def test_packed_window_sums(self):
+        tracks = core.PackedTracks.from_tracks(
+            [np.array([1,2,3,4,5]).astype("float"),
+             np.array([1.0]), np.array([0.5,-1,2]).astype("float")])
+        sums = coordproducers.get_packed_window_sums(tracks=tracks,
+                                                     window_size=3)
+        np.testing.assert_equal(sums.offsets, [0,3,3,4])
+        np.testing.assert_almost_equal(sums.packed, [6,9,12,1.5])
+        np.testing.assert_almost_equal(sums[2], [1.5])
+
+    def test_chunked_window_sums(self):
+        arrs = [np.array([1,2,3,4,5]).astype("float"), np.array([1.0]),
+                np.array([0.5,-1,2]).astype("float")]
+        for tracks in [arrs, core.PackedTracks.from_tracks(arrs)]:
+            chunks = list(coordproducers.iter_chunked_window_sums(
+                tracks=tracks, window_size=3, examples_per_chunk=2))
+            self.assertEqual(len(chunks), 2)
+            np.testing.assert_almost_equal(chunks[0], [6,9,12])
+            np.testing.assert_almost_equal(chunks[1], [1.5])
+
+    def test_get_first_passing_val(self):
+        vals = np.array([1.0, 2.0, 3.0, 4.0])
+        self.assertEqual(coordproducers.get_first_passing_val(
+            vals=vals, passing=np.array([False, False, True, True])), 3.0)
+        self.assertEqual(coordproducers.get_first_passing_val(
+            vals=vals, passing=np.array([False, False, False, False])), 4.0)
+
+
+class TestGreedyPeaks(unittest.TestCase):
+
+    def test_get_greedy_peaks(self):
+        score_tracks = [
+            np.array([5,1,2,3,4,5,4,3.1,2,1,0]).astype("float"),
+            np.array([-np.inf,1,2,2,1,-np.inf]).astype("float")]
+        example_idxs, positions = coordproducers.get_greedy_peaks(
+            score_tracks=score_tracks, flank=1, suppress=1)
+        #the peak at position 0 of the first track is within the flank;
+        # ties are broken in favour of the earlier position
+        self.assertEqual(example_idxs, [0,0,0,0,0,1,1])
+        self.assertEqual(positions, [5,7,3,1,9,2,4])
+
+
+class TestAbsBinnedHistogram(unittest.TestCase):
+
+    def test_quantiles_and_sketch(self):
+        rng = np.random.RandomState(1234)
+        vals = rng.normal(size=100000)
+        hist = coordproducers.AbsBinnedHistogram(
+                    max_abs_val=np.max(np.abs(vals)), num_bins=10000)
+        #adding in chunks should be the same as adding all at once
+        for chunk in np.array_split(vals, 7):
+            hist.add(chunk)
+        self.assertEqual(np.sum(hist.pos_counts), np.sum(vals >= 0))
+        self.assertEqual(np.sum(hist.neg_counts), np.sum(vals < 0))
+        np.testing.assert_almost_equal(
+            hist.get_quantiles(counts=hist.abs_counts, quantiles=0.9),
+            np.percentile(np.abs(vals), 90), decimal=2)
+        sketch = hist.get_sketch(counts=hist.abs_counts, sketch_size=1000)
+        self.assertEqual(len(sketch), 1000)
+        np.testing.assert_almost_equal(
+            np.searchsorted(sketch, 1.0)/1000.0,
+            np.mean(np.abs(vals) < 1.0), decimal=2)
+
+
+class TestNullDists(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(1234)
+        self.score_track = [rng.laplace(size=length)
+                            for length in rng.randint(50,100,size=50)]
+        self.summed_score_track =\
+            coordproducers.get_simple_window_sum_function(5)(
+                self.score_track)
+
+    def test_laplace_null_dist_is_seed_stable(self):
+        null_dist = coordproducers.LaplaceNullDist(num_to_samp=10000,
+                                                   verbose=False)
+        null_vals1 = null_dist(
+            score_track=self.score_track, windowsize=5,
+            original_summed_score_track=self.summed_score_track)
+        null_vals2 = null_dist(
+            score_track=self.score_track, windowsize=5,
+            original_summed_score_track=self.summed_score_track)
+        self.assertEqual(len(null_vals1), 10000)
+        np.testing.assert_almost_equal(null_vals1, null_vals2)
+
+    def test_flip_sign_null_dist_is_seed_stable(self):
+        null_dist = coordproducers.FlipSignNullDist(num_seq_to_samp=100)
+        null_vals1 = null_dist(
+            score_track=self.score_track, windowsize=5,
+            original_summed_score_track=self.summed_score_track)
+        null_vals2 = null_dist(
+            score_track=self.score_track, windowsize=5,
+            original_summed_score_track=None)
+        np.testing.assert_almost_equal(null_vals1, null_vals2)
@@ -6,11 +6,22 @@ from unittest import skip
 import sys
 import os
 import numpy as np
+import shutil
+import tempfile
 from modisco import core
 import time
+from collections import OrderedDict
 from nose.tools import raises
 
 
+class TmpDirTestCase(unittest.TestCase):
+
+    #self.tmpdir is removed when the test finishes
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+
 class TestSnippet(unittest.TestCase):
 
     def test_snippet_basic(self): 
@@ -22,6 +33,17 @@ class TestSnippet(unittest.TestCase):
         np.testing.assert_almost_equal(snippet.fwd, rev_snippet.rev)
         np.testing.assert_almost_equal(snippet.rev, rev_snippet.fwd)
 
+    def test_snippet_revcomp_shares_memory(self):
+        fwd = np.array([1.0,2.0,3.0,4.0])
+        rev = np.array([-4.0,-3.0,-2.0,-1.0])
+        rev_snippet = core.Snippet(fwd=fwd, rev=rev,
+                                   has_pos_axis=True).revcomp()
+        self.assertTrue(np.shares_memory(rev_snippet.fwd, rev))
+        self.assertFalse(rev_snippet.fwd.flags.writeable)
+        writeable_fwd = core.get_writeable(rev_snippet.fwd)
+        writeable_fwd[0] = 10.0
+        self.assertEqual(rev[0], -4.0)
+
     @raises(AssertionError)
     def test_snippet_length_tracks_error(self): 
         fwd = [1,2,3,4,5] 
@@ -29,7 +51,7 @@ class TestSnippet(unittest.TestCase):
         snippet = core.Snippet(fwd=fwd, rev=rev, has_pos_axis=False)
 
 
-class TestSeqletCoordinates(unittest.TestCase):
+class TestSeqletCoordinates(TmpDirTestCase):
 
     def test_seqlet_coordinates_core(self):
         seqlet_coordinates = core.SeqletCoordinates(
@@ -38,6 +60,29 @@ class TestSeqletCoordinates(unittest.TestCase):
         self.assertEqual(len(seqlet_coordinates), 10)
 
 
+    def test_seqlet_coordinates_hdf5(self):
+        import h5py
+        from modisco import util
+        coords = [core.SeqletCoordinates(example_idx=example_idx, start=start,
+                                         end=start+10, is_revcomp=is_revcomp)
+                  for (example_idx, start, is_revcomp)
+                  in [(3, 5, False), (0, 100, True), (2**40, 7, True)]]
+        with h5py.File(os.path.join(self.tmpdir, "coords.h5"), "w") as f:
+            util.save_coords(coords=coords, dset_name="coords", grp=f)
+            util.save_coords(coords=[], dset_name="no_coords", grp=f)
+            #the layout in which coordinates used to be saved
+            util.save_string_list(string_list=[str(x) for x in coords],
+                                  dset_name="coord_strings", grp=f)
+            self.assertEqual(f["coords"].compression, "gzip")
+            for dset_name in ["coords", "coord_strings"]:
+                self.assertEqual(
+                    [str(x) for x in util.load_coords(dset_name=dset_name,
+                                                      grp=f)],
+                    [str(x) for x in coords])
+            self.assertEqual(util.load_coords(dset_name="no_coords",
+                                              grp=f), [])
+
+
 class TestDataTrack(unittest.TestCase):
 
     def setUp(self):
@@ -119,4 +164,364 @@ class TestSeqlet(unittest.TestCase):
         np.testing.assert_almost_equal(
             seqlet["track_no_pos_axis"].fwd, -self.fwd_tracks[1][::-1])
 
+    def test_seqlet_identity_key(self):
+        seqlet = core.Seqlet(coor=core.SeqletCoordinates(
+            example_idx=3, start=1, end=5, is_revcomp=False))
+        same_coords_seqlet = core.Seqlet(coor=core.SeqletCoordinates(
+            example_idx=3, start=1, end=5, is_revcomp=True))
+        other_seqlet = core.Seqlet(coor=core.SeqletCoordinates(
+            example_idx=1, start=3, end=5, is_revcomp=False))
+        self.assertEqual(seqlet.identity_key, same_coords_seqlet.identity_key)
+        self.assertNotEqual(seqlet.identity_key, other_seqlet.identity_key)
+        seqlets_and_alnmts = core.SeqletsAndAlignments()
+        seqlets_and_alnmts.append(
+            core.SeqletAndAlignment(seqlet=seqlet, alnmt=0))
+        self.assertTrue(same_coords_seqlet in seqlets_and_alnmts)
+        self.assertFalse(other_seqlet in seqlets_and_alnmts)
+
+
+
+
+class TestPackTracks(unittest.TestCase):
+
+    def test_packed_tracks(self):
+        tracks = [np.arange(3), np.arange(5)+10, np.arange(0)]
+        packed_tracks = core.PackedTracks.from_tracks(tracks)
+        self.assertIs(core.PackedTracks.from_tracks(packed_tracks),
+                      packed_tracks)
+        np.testing.assert_equal(packed_tracks.offsets, [0,3,8,8])
+        np.testing.assert_equal(packed_tracks.lengths, [3,5,0])
+        np.testing.assert_equal(packed_tracks.example_idxs,
+                                [0,0,0,1,1,1,1,1])
+        self.assertEqual(len(packed_tracks), 3)
+        for orig, new in zip(tracks, packed_tracks):
+            np.testing.assert_equal(orig, new)
+        #examples are views into the packed buffer
+        self.assertIs(packed_tracks[1].base, packed_tracks.packed)
+        self.assertEqual(len(core.PackedTracks.from_tracks([])), 0)
+
+
+class TestSeqletsOverlapResolver(unittest.TestCase):
+
+    def test_overlap_resolution_keeps_order(self):
+        from modisco import value_provider
+        from modisco.coordproducers import SeqletCoordsFWAP
+        resolver = core.SeqletsOverlapResolver(
+            overlap_detector=core.CoordOverlapDetector(0.5),
+            seqlet_comparator=core.SeqletComparator(
+                value_provider=value_provider.CoorScoreValueProvider()))
+        coords = [(0,0,10,3.0), (0,4,14,5.0), (1,0,10,1.0),
+                  (0,20,30,2.0), (0,16,26,1.0), (1,4,14,2.0)]
+        seqlets = [core.Seqlet(coor=SeqletCoordsFWAP(
+                    example_idx=example_idx, start=start, end=end,
+                    score=score))
+                   for (example_idx, start, end, score) in coords]
+        final_seqlets = resolver(seqlets)
+        self.assertEqual([(x.coor.example_idx, x.coor.start)
+                          for x in final_seqlets],
+                         [(0,4), (0,20), (1,4)])
+
+
+class TestMultiTaskSeqletCreator(TmpDirTestCase):
+
+    def test_parallel_matches_serial(self):
+        from modisco import coordproducers
+        from modisco import value_provider
+        rng = np.random.RandomState(1)
+        task_name_to_score_track = OrderedDict()
+        for task_name in ["task0", "task1", "task2"]:
+            task_name_to_score_track[task_name] = [
+                rng.laplace(size=200)*0.3 + (rng.uniform(size=200) < 0.01)*3
+                for i in range(50)]
+        track_set = core.TrackSet(data_tracks=[
+            core.DataTrack(name="scores", fwd_tracks=np.array(
+                list(task_name_to_score_track.values())).transpose((1,2,0)),
+                rev_tracks=None, has_pos_axis=True)])
+        #the coord producer saves its plots in the working directory
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.tmpdir)
+        all_seqlets = []
+        for n_cores in [1, 2]:
+            multitask_seqlet_creator = core.MultiTaskSeqletCreator(
+                coord_producer=coordproducers.FixedWindowAroundChunks(
+                    sliding=11, flank=5, suppress=10, target_fdr=0.2,
+                    min_passing_windows_frac=0.01,
+                    max_passing_windows_frac=0.2, verbose=False),
+                overlap_resolver=core.SeqletsOverlapResolver(
+                    overlap_detector=core.CoordOverlapDetector(0.5),
+                    seqlet_comparator=core.SeqletComparator(
+                        value_provider=
+                         value_provider.CoorScoreValueProvider())),
+                verbose=False, n_cores=n_cores)
+            all_seqlets.append(multitask_seqlet_creator(
+                task_name_to_score_track=task_name_to_score_track,
+                null_tracks=coordproducers.LaplaceNullDist(
+                    num_to_samp=1000, verbose=False),
+                track_set=track_set).final_seqlets)
+        serial_seqlets, parallel_seqlets = all_seqlets
+        self.assertGreater(len(serial_seqlets), 0)
+        self.assertEqual(
+            [(x.coor.example_idx, x.coor.start, x.coor.end, x.coor.score)
+             for x in serial_seqlets],
+            [(x.coor.example_idx, x.coor.start, x.coor.end, x.coor.score)
+             for x in parallel_seqlets])
+
+
+class TestTrackSet(unittest.TestCase):
+
+    def setUp(self):
+        self.fwd_tracks = np.arange(90).reshape((10,9))
+        self.track_set = core.TrackSet(data_tracks=[
+            core.DataTrack(name="track1", fwd_tracks=self.fwd_tracks,
+                           rev_tracks=-self.fwd_tracks[:,::-1],
+                           has_pos_axis=True),
+            core.DataTrack(name="track2", fwd_tracks=2*self.fwd_tracks,
+                           rev_tracks=None, has_pos_axis=True)])
+
+    def test_materialize_seqlets(self):
+        coords = [core.SeqletCoordinates(example_idx=1, start=1, end=5,
+                                         is_revcomp=False)]
+        seqlets = self.track_set.create_seqlets(coords=coords,
+                                                track_names=[])
+        self.assertEqual(len(seqlets[0].track_name_to_snippet), 0)
+        self.track_set.materialize_seqlets(seqlets=seqlets,
+                                           track_names=["track2"])
+        self.assertEqual(list(seqlets[0].track_name_to_snippet.keys()),
+                         ["track2"])
+        self.track_set.materialize_seqlets(seqlets=seqlets)
+        self.assertEqual(list(seqlets[0].track_name_to_snippet.keys()),
+                         ["track2", "track1"])
+        np.testing.assert_almost_equal(seqlets[0]["track1"].fwd,
+                                       self.fwd_tracks[1, 1:5])
+
+
+class TestLazyDataTrack(TmpDirTestCase):
+
+    def test_lazy_data_track_matches_in_memory(self):
+        import h5py
+        arr = np.random.RandomState(1).randn(7,10,4)
+        in_memory = core.DataTrack(name="track", fwd_tracks=arr,
+                                   rev_tracks=arr[:,::-1,::-1],
+                                   has_pos_axis=True)
+        with h5py.File(os.path.join(self.tmpdir, "tracks.h5"), "w") as f:
+            f.create_dataset("track", data=arr)
+            lazy = core.LazyDataTrack(name="track", source=f["track"],
+                                      has_pos_axis=True, block_size=2,
+                                      max_cached_blocks=2)
+            self.assertEqual(len(lazy), 7)
+            self.assertEqual(lazy.get_example_len(3), 10)
+            for example_idx in [0, 6, 3, 0, 5]:
+                for is_revcomp in [False, True]:
+                    coor = core.SeqletCoordinates(
+                        example_idx=example_idx, start=2, end=7,
+                        is_revcomp=is_revcomp)
+                    lazy_snippet = lazy.get_snippet(coor)
+                    snippet = in_memory.get_snippet(coor)
+                    np.testing.assert_almost_equal(lazy_snippet.fwd,
+                                                   snippet.fwd)
+                    np.testing.assert_almost_equal(lazy_snippet.rev,
+                                                   snippet.rev)
+            self.assertEqual(len(lazy.fwd_tracks._block_cache), 2)
+
+    def test_lazy_snippets_do_not_pin_cached_blocks(self):
+        import h5py
+        import tracemalloc
+        arr = np.random.RandomState(1).randn(256,100,4)
+        with h5py.File(os.path.join(self.tmpdir, "tracks.h5"), "w") as f:
+            f.create_dataset("track", data=arr)
+            lazy = core.LazyDataTrack(name="track", source=f["track"],
+                                      has_pos_axis=True, block_size=8,
+                                      max_cached_blocks=2)
+            tracemalloc.start()
+            try:
+                before = tracemalloc.get_traced_memory()[0]
+                snippets = [lazy.get_snippet(core.SeqletCoordinates(
+                                example_idx=example_idx, start=10, end=15,
+                                is_revcomp=(example_idx%2==1)))
+                            for example_idx in range(len(arr))]
+                lazy.fwd_tracks._block_cache.clear()
+                retained = tracemalloc.get_traced_memory()[0] - before
+            finally:
+                tracemalloc.stop()
+        for snippet in snippets:
+            for window in [snippet.fwd, snippet.rev]:
+                base = (window if window.base is None else window.base)
+                self.assertEqual(base.nbytes, window.nbytes)
+        #every block was loaded and evicted; the snippets alone should
+        # be a small fraction of the source
+        self.assertLess(retained, arr.nbytes/4)
+
+
+class TestSeqletTable(unittest.TestCase):
+
+    def setUp(self):
+        fwd_tracks = np.random.RandomState(1).randn(5,20,4)
+        self.track_set = core.TrackSet(data_tracks=[
+            core.DataTrack(name="track", fwd_tracks=fwd_tracks,
+                           rev_tracks=fwd_tracks[:,::-1,::-1],
+                           has_pos_axis=True)])
+        self.coords = [
+            core.SeqletCoordinates(example_idx=example_idx, start=start,
+                                   end=start+6, is_revcomp=is_revcomp)
+            for (example_idx, start, is_revcomp) in
+            [(0,2,False), (3,10,True), (1,0,True), (4,14,False)]]
+        self.seqlets = self.track_set.create_seqlets(coords=self.coords)
+
+    def test_seqlet_table_matches_seqlets(self):
+        for seqlet_table in [
+            core.SeqletTable.from_coords(coords=self.coords,
+                                         track_set=self.track_set),
+            core.SeqletTable.from_coords(coords=self.coords,
+                                         track_set=self.track_set,
+                                         materialize=True),
+            core.SeqletTable.from_seqlets(self.seqlets)]:
+            self.assertEqual(len(seqlet_table), 4)
+            for seqlet, table_seqlet in zip(self.seqlets, seqlet_table):
+                self.assertEqual(str(seqlet.coor), str(table_seqlet.coor))
+                np.testing.assert_almost_equal(seqlet["track"].fwd,
+                                               table_seqlet["track"].fwd)
+                np.testing.assert_almost_equal(seqlet["track"].rev,
+                                               table_seqlet["track"].rev)
+            fwd_data, rev_data = core.get_2d_data_from_patterns(
+                patterns=seqlet_table[np.array([1,3])],
+                track_names=["track"], track_transformer=None)
+            expected_fwd_data, expected_rev_data =\
+                core.get_2d_data_from_patterns(
+                    patterns=[self.seqlets[1], self.seqlets[3]],
+                    track_names=["track"], track_transformer=None)
+            np.testing.assert_almost_equal(fwd_data, expected_fwd_data)
+            np.testing.assert_almost_equal(rev_data, expected_rev_data)
+
+
+class TestAggregatedSeqlet(TmpDirTestCase):
+
+    def setUp(self):
+        super(TestAggregatedSeqlet, self).setUp()
+        fwd_tracks = np.random.RandomState(1).randn(6,20,4)
+        self.track_set = core.TrackSet(data_tracks=[
+            core.DataTrack(name="track", fwd_tracks=fwd_tracks,
+                           rev_tracks=fwd_tracks[:,::-1,::-1],
+                           has_pos_axis=True)])
+        self.seqlets = self.track_set.create_seqlets(coords=[
+            core.SeqletCoordinates(example_idx=example_idx, start=5,
+                                   end=11, is_revcomp=False)
+            for example_idx in range(6)])
+
+    def test_extending_with_padding(self):
+        #each seqlet is placed one position before or after the last
+        alnmts = [-1, 7, -1, 9, -1]
+        agg_seqlet = core.AggregatedSeqlet.from_seqlet(self.seqlets[0])
+        for seqlet, alnmt in zip(self.seqlets[1:], alnmts):
+            agg_seqlet.add_pattern(
+                pattern=seqlet,
+                aligner=lambda parent_pattern, child_pattern, alnmt=alnmt:
+                    (alnmt, False, 0.0))
+        self.assertEqual(len(agg_seqlet), 16)
+        self.assertGreaterEqual(agg_seqlet._capacity, 16)
+        expected_sum = np.zeros((16,4))
+        expected_counts = np.zeros(16)
+        for seqlet_and_alnmt in agg_seqlet.seqlets_and_alnmts:
+            alnmt = seqlet_and_alnmt.alnmt
+            expected_sum[alnmt:alnmt+6] += seqlet_and_alnmt.seqlet["track"].fwd
+            expected_counts[alnmt:alnmt+6] += 1
+        np.testing.assert_almost_equal(agg_seqlet.per_position_counts,
+                                       expected_counts)
+        np.testing.assert_almost_equal(agg_seqlet["track"].fwd,
+                                       expected_sum/expected_counts[:,None])
+        np.testing.assert_almost_equal(agg_seqlet["track"].rev,
+                                       agg_seqlet["track"].fwd[::-1,::-1])
+        #the reverse complement matches one aggregated from scratch
+        rev_agg_seqlet = agg_seqlet.revcomp()
+        from_scratch = core.AggregatedSeqlet(
+            seqlets_and_alnmts_arr=list(rev_agg_seqlet.seqlets_and_alnmts))
+        np.testing.assert_almost_equal(rev_agg_seqlet["track"].fwd,
+                                       from_scratch["track"].fwd)
+        np.testing.assert_almost_equal(rev_agg_seqlet.per_position_counts,
+                                       from_scratch.per_position_counts)
+
+    def test_copy_is_copy_on_write(self):
+        agg_seqlet = core.AggregatedSeqlet(seqlets_and_alnmts_arr=[
+            core.SeqletAndAlignment(seqlet=seqlet, alnmt=idx)
+            for idx, seqlet in enumerate(self.seqlets[:3])])
+        the_copy = agg_seqlet.copy()
+        self.assertIs(the_copy.seqlets_and_alnmts,
+                      agg_seqlet.seqlets_and_alnmts)
+        expected_fwd = np.array(agg_seqlet["track"].fwd)
+        the_copy.add_pattern(
+            pattern=self.seqlets[3],
+            aligner=lambda parent_pattern, child_pattern: (-2, False, 0.0))
+        #the original is unaffected by extending the copy
+        self.assertEqual(len(agg_seqlet), 8)
+        self.assertEqual([x.alnmt for x in agg_seqlet.seqlets_and_alnmts],
+                         [0, 1, 2])
+        np.testing.assert_almost_equal(agg_seqlet["track"].fwd,
+                                       expected_fwd)
+        self.assertEqual(len(the_copy), 10)
+        self.assertEqual([x.alnmt for x in the_copy.seqlets_and_alnmts],
+                         [2, 3, 4, 0])
+        from_scratch = core.AggregatedSeqlet(
+            seqlets_and_alnmts_arr=list(the_copy.seqlets_and_alnmts))
+        np.testing.assert_almost_equal(the_copy["track"].fwd,
+                                       from_scratch["track"].fwd)
+
+    def test_lazy_load_patterns(self):
+        import h5py
+        from modisco import util
+        agg_seqlet = core.AggregatedSeqlet(seqlets_and_alnmts_arr=[
+            core.SeqletAndAlignment(seqlet=seqlet, alnmt=idx)
+            for idx, seqlet in enumerate(self.seqlets[:3])])
+        with h5py.File(os.path.join(self.tmpdir, "patterns.h5"), "w") as f:
+            util.save_patterns(patterns=[agg_seqlet], grp=f)
+            lazy_pattern = util.load_patterns(grp=f, track_set=self.track_set,
+                                              lazy=True)[0]
+            self.assertEqual(len(lazy_pattern.track_name_to_snippet), 0)
+            self.assertEqual(len(lazy_pattern), len(agg_seqlet))
+            self.assertEqual(lazy_pattern.num_seqlets, 3)
+            np.testing.assert_almost_equal(lazy_pattern["track"].fwd,
+                                           agg_seqlet["track"].fwd)
+            self.assertEqual(list(lazy_pattern.alnmts), [0, 1, 2])
+            for seqlet, lazy_seqlet in zip(agg_seqlet.seqlets,
+                                           lazy_pattern.seqlets):
+                self.assertEqual(seqlet.identity_key,
+                                 lazy_seqlet.identity_key)
+                np.testing.assert_almost_equal(seqlet["track"].fwd,
+                                               lazy_seqlet["track"].fwd)
+            np.testing.assert_almost_equal(
+                lazy_pattern.materialize()["track"].fwd,
+                agg_seqlet["track"].fwd)
 
+    def test_packed_patterns(self):
+        import h5py
+        from modisco import util
+        patterns = [
+            core.AggregatedSeqlet(seqlets_and_alnmts_arr=[
+                core.SeqletAndAlignment(seqlet=seqlet, alnmt=idx)
+                for idx, seqlet in enumerate(self.seqlets[:3])]),
+            core.AggregatedSeqlet.from_seqlet(self.seqlets[3]),
+            core.AggregatedSeqlet(seqlets_and_alnmts_arr=[
+                core.SeqletAndAlignment(seqlet=self.seqlets[4], alnmt=0),
+                core.SeqletAndAlignment(seqlet=self.seqlets[5], alnmt=4)])]
+        with h5py.File(os.path.join(self.tmpdir, "patterns.h5"), "w") as f:
+            util.save_packed_patterns(patterns=patterns, grp=f)
+            self.assertEqual(f["tracks"]["track"]["fwd"].shape, (24,4))
+            #a single pattern can be read without the others
+            pattern = core.PackedLazyAggregatedSeqlet(
+                grp=f, pattern_idx=2, track_set=self.track_set)
+            self.assertEqual(len(pattern), 10)
+            self.assertEqual(pattern.num_seqlets, 2)
+            self.assertEqual(list(pattern.alnmts), [0, 4])
+            np.testing.assert_almost_equal(pattern["track"].fwd,
+                                           patterns[2]["track"].fwd)
+            np.testing.assert_almost_equal(pattern["track"].rev,
+                                           patterns[2]["track"].rev)
+            self.assertEqual(
+                [x.identity_key for x in pattern.seqlets],
+                [x.identity_key for x in patterns[2].seqlets])
+            for loaded_pattern, expected_pattern in zip(
+                    util.load_patterns(grp=f, track_set=self.track_set),
+                    patterns):
+                self.assertEqual(type(loaded_pattern).__name__,
+                                 "AggregatedSeqlet")
+                np.testing.assert_almost_equal(
+                    loaded_pattern["track"].fwd,
+                    expected_pattern["track"].fwd)
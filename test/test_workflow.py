@@ -0,0 +1,74 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+from modisco import core
+from modisco.coordproducers import SeqletCoordsFWAP
+from modisco.tfmodisco_workflow import workflow
+
+
+class TestSeqletsCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        fwd_tracks = np.random.RandomState(1).randn(5,20,4)
+        self.track_set = core.TrackSet(data_tracks=[
+            core.DataTrack(name="track", fwd_tracks=fwd_tracks,
+                           rev_tracks=fwd_tracks[:,::-1,::-1],
+                           has_pos_axis=True)])
+        self.seqlets = self.track_set.create_seqlets(coords=[
+            SeqletCoordsFWAP(example_idx=example_idx, start=start,
+                             end=start+6, score=score)
+            for (example_idx, start, score) in
+            [(0,2,1.5), (3,10,-2.0), (1,0,0.25), (4,14,3.0)]])
+
+    def test_background_checkpoint_round_trip(self):
+        path = os.path.join(self.tmpdir, "seqlets.h5")
+        checkpoint = workflow.BackgroundSeqletsCheckpoint(
+                        seqlets=self.seqlets, path=path)
+        checkpoint.join()
+        for lazy in [False, True]:
+            loaded_seqlets = workflow.load_seqlets_checkpoint(
+                path=path, track_set=self.track_set, lazy=lazy)
+            self.assertEqual(len(loaded_seqlets), len(self.seqlets))
+            for seqlet, loaded_seqlet in zip(self.seqlets, loaded_seqlets):
+                self.assertEqual(str(seqlet.coor), str(loaded_seqlet.coor))
+                self.assertEqual(seqlet.coor.score, loaded_seqlet.coor.score)
+                np.testing.assert_almost_equal(seqlet["track"].fwd,
+                                               loaded_seqlet["track"].fwd)
+                np.testing.assert_almost_equal(seqlet["track"].rev,
+                                               loaded_seqlet["track"].rev)
+
+    def test_background_checkpoint_reraises_write_error(self):
+        checkpoint = workflow.BackgroundSeqletsCheckpoint(
+            seqlets=self.seqlets,
+            path=os.path.join(self.tmpdir, "no_such_dir", "seqlets.h5"))
+        with self.assertRaises((IOError, OSError)):
+            checkpoint.join()
+
+
+class TestPrepTrackSet(unittest.TestCase):
+
+    def test_lazy_track_cache_params_are_passed_on(self):
+        import h5py
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        arr = np.random.RandomState(1).randn(6,20,4)
+        with h5py.File(os.path.join(tmpdir, "tracks.h5"), "w") as f:
+            f.create_dataset("contrib", data=arr)
+            track_set = workflow.prep_track_set(
+                task_names=["task0"], contrib_scores={"task0": f["contrib"]},
+                hypothetical_contribs={"task0": arr}, one_hot=arr,
+                block_size=3, max_cached_blocks=1)
+            lazy_track = track_set.track_name_to_data_track[
+                            "task0_contrib_scores"]
+            self.assertEqual(type(lazy_track).__name__, "LazyDataTrack")
+            self.assertEqual(lazy_track.fwd_tracks.block_size, 3)
+            self.assertEqual(lazy_track.fwd_tracks.max_cached_blocks, 1)
+            self.assertEqual(type(track_set.track_name_to_data_track[
+                "sequence"]).__name__, "DataTrack")